@@ -1,29 +1,35 @@
 # Simple Bot => Objective is to implement llms into the graph
-from typing import TypedDict, List
-from langchain_core.messages import HumanMessage
+import argparse
+from typing import TypedDict, Annotated, Sequence
+from langchain_core.messages import BaseMessage, HumanMessage
 # In LangChain, HumanMessage is a class used to represent a message sent by a human in a conversation, typically as part of a chat interaction with a language model.
 from langchain_openai import ChatOpenAI
 from langgraph.graph import StateGraph,START,END
+from langgraph.graph.message import add_messages
 from dotenv import load_dotenv 
+from streaming import print_stream_reply
+from checkpointing import get_checkpointer, session_config
+from instrumentation import instrument_graph
 #env file is used to store secrets and keys and stuff.
 
 
 load_dotenv()
 class AgentState(TypedDict):
-    messages : List[HumanMessage]
+    messages : Annotated[Sequence[BaseMessage], add_messages] # new messages are added to the saved history instead of replacing it
 
 llm = ChatOpenAI(model='gpt-4o')
 
 def process(state : AgentState)->AgentState:
     response = llm.invoke(state['messages'])
-    print(f"\nAI: {response.content}")
-    return state
+    # The reply is printed by the loop below, token by token when streaming is on
+    return {'messages': [response]}
 
 graph=StateGraph(AgentState)
 graph.add_node("process",process)
 graph.add_edge(START,"process")
 graph.add_edge("process",END)
-agent=graph.compile()
+instrument_graph(graph, "agent-1") # times every node run, see instrumentation.py
+agent=graph.compile(checkpointer=get_checkpointer()) # the state of every thread_id is saved, see checkpointing.py
 
 
 # user_input=input("Enter:")
@@ -31,10 +37,22 @@ agent=graph.compile()
 
 
 #now making it like a chatbot 
+parser = argparse.ArgumentParser()
+parser.add_argument("--no-stream", action="store_true", help="print the reply only when it is complete")
+parser.add_argument("--thread-id", default="agent-1", help="session whose state is saved by the checkpointer")
+args = parser.parse_args()
+config = session_config(args.thread_id)
+
 user_input=input("Enter: ")
 while user_input!="exit":
-    agent.invoke({'messages':[HumanMessage(content=user_input)]})
+    if args.no_stream:
+        result = agent.invoke({'messages':[HumanMessage(content=user_input)]}, config)
+        print(f"\nAI: {result['messages'][-1].content}")
+    else:
+        # Shows every token as soon as the model produces it instead of waiting for the whole reply
+        print_stream_reply(agent, {'messages':[HumanMessage(content=user_input)]}, config)
     user_input=input("Enter: ")
 
 #now the biggest problem with this is that it doesnt have any memory allocated to it , for example if i just say my name is bob and ask who am I it wont be able to tell that it is bob  
 # the main reason is that the api calls were independent that why 
+#=> the checkpointer saves the state of the thread_id and add_messages adds every new message to it, so the bot now remembers the conversation (and resumes it with --thread-id)
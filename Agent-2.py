@@ -18,6 +18,7 @@ LangChain allows you to pass structured chat history to chat-based LLMs. You can
     ]
 """
 
+import argparse
 import os
 from typing import TypedDict, List,Union
 """
@@ -31,11 +32,24 @@ from langchain_core.messages import HumanMessage, AIMessage
 from langchain_openai import ChatOpenAI
 from langgraph.graph import StateGraph,START,END
 from dotenv import load_dotenv 
+from streaming import print_stream_reply
+from conversation_memory import ConversationMemory
+from conversation_store import ConversationStore
+from checkpointing import get_checkpointer, session_config
+from instrumentation import instrument_graph
 
 load_dotenv()
 
+parser = argparse.ArgumentParser()
+parser.add_argument("--no-stream", action="store_true", help="print the reply only when it is complete")
+parser.add_argument("--memory-tokens", type=int, default=2000, help="token budget for the recent messages sent word for word")
+parser.add_argument("--memory-turns", type=int, default=10, help="most recent turns kept word for word")
+parser.add_argument("--conversation-id", default="default", help="which conversation to resume")
+args = parser.parse_args()
+
 
 def load_conversation_history(file_path: str):
+    """Reads the old plain text log, only used to migrate it into the conversation store"""
     history = []
     if not os.path.exists(file_path):
         return history
@@ -52,51 +66,73 @@ def load_conversation_history(file_path: str):
 
 class AgentState(TypedDict):
     messages: List[Union[HumanMessage,AIMessage]]
+    summary: str # everything that fell out of the window of recent messages, folded into a few sentences
 
 llm =ChatOpenAI(model="gpt-4o")
 
+# Keeps the last turns word for word within a token budget and summarizes the rest, so every turn costs about the same
+memory = ConversationMemory(llm, max_tokens=args.memory_tokens, max_turns=args.memory_turns)
+
+def manage_memory(state: AgentState)->AgentState:
+    """This node trims the messages to the window and folds the older ones into the summary"""
+    messages, summary = memory.update(state['messages'], state.get('summary', ""))
+    return {'messages': messages, 'summary': summary}
+
 def process(state: AgentState)->AgentState:
     """This node will solce the request of the input"""
-    response=llm.invoke(state['messages'])
+    response=llm.invoke(memory.summary_message(state.get('summary', "")) + state['messages'])
     state['messages'].append(AIMessage(content=response.content))
-    print(f"\nAI:{response.content}")
+    if args.no_stream: # when streaming, the tokens have already been printed while they arrived
+        print(f"\nAI:{response.content}")
 
     print("CURRENT STATE: ",state['messages'])
     return state
 
 graph=StateGraph(AgentState)
+graph.add_node("memory",manage_memory)
 graph.add_node("process",process)
-graph.add_edge(START,"process")
+graph.add_edge(START,"memory")
+graph.add_edge("memory","process")
 graph.add_edge("process",END)
-agent=graph.compile()
+instrument_graph(graph, "agent-2") # times every node run, see instrumentation.py
+agent=graph.compile(checkpointer=get_checkpointer()) # the state of every conversation id is saved as a LangGraph thread, see checkpointing.py
+config = session_config(args.conversation_id)
 
-conversation_history = load_conversation_history("logging.txt")
+# Every message is written to the store as soon as it happens, and on start only the summary + the window is loaded
+store = ConversationStore("conversations.sqlite3")
+if os.path.exists("logging.txt") and not store.imported("logging.txt"):
+    # One time migration of the old text log into the "default" conversation, never into a new conversation id.
+    # The store remembers that it ran, the file itself is left alone
+    history = load_conversation_history("logging.txt") if store.count("default") == 0 else []
+    store.import_messages("default", history, source="logging.txt")
+
+conversation_history, summary = store.load_window(args.conversation_id)
 
 user_input = input("Enter: ")
 while user_input!="exit":
     conversation_history.append(HumanMessage(content=user_input))
+    store.append(args.conversation_id, conversation_history[-1])
     #We use the HumanMessage so that , the langchain can understand the wrapper around knows it is a human message 
-    result = agent.invoke({'messages':conversation_history})
+    inputs = {'messages':conversation_history, 'summary':summary}
+    if args.no_stream:
+        result = agent.invoke(inputs, config)
+    else:
+        # only the tokens of the reply are shown, not the ones of the summary
+        result = print_stream_reply(agent, inputs, config, nodes={"process"}, prefix="\nAI:")
 
     print(result['messages'])
 
     conversation_history=result['messages']
+    summary=result['summary']
+    store.append(args.conversation_id, conversation_history[-1])
+    store.save_summary(args.conversation_id, summary, window_start=int(conversation_history[0].id))
     user_input = input("Enter: ")
 
 #Now the major issue is that the moment i exit from the code the entire histroy is wiped out , so instead we write into a text file and read the context from there
+#=> logging.txt was rewritten only on exit, so a crash lost the session. Now every message goes to conversations.sqlite3 the moment it happens (conversation_store.py)
 
-with open("logging.txt","w") as file:
-    file.write("This is the conversational log for agent-2\n")
-
-    for message in conversation_history:
-        if isinstance(message,HumanMessage):
-            file.write(f"You: {message.content}\n")
-        elif isinstance(message,AIMessage):
-            file.write(f"AI: {message.content}\n")
-        else:
-            file.write("End of the conversation")
-
-print("Conversation has been saved to logging.txt")
+print(f"Conversation '{args.conversation_id}' has been saved to conversations.sqlite3")
 
 
-#To prevent the conversation_history to get too long and keep on increasing in size what we can do is remove the last message from the conversation history when the size is like 5 or 10
\ No newline at end of file
+#To prevent the conversation_history to get too long and keep on increasing in size what we can do is remove the last message from the conversation history when the size is like 5 or 10
+#=> this is what the memory node does now, it keeps the last turns within a token budget and summarizes the older ones (conversation_memory.py)
\ No newline at end of file
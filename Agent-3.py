@@ -15,19 +15,26 @@ This is ReAct Agent as the tools always goes back to the agent and not the end
 
 The llm decides how the tool does the work and till when is it needed 
 """
+import argparse
+import os
+import uuid
 from typing import Annotated, Sequence, TypedDict
 from dotenv import load_dotenv
 from langchain_core.messages import BaseMessage  # The foundational class for all message types in LangGraph
 from langchain_core.messages import ToolMessage  # Passes data back to LLM after it calls a tool such as the content and the tool_call_id
 from langchain_core.messages import SystemMessage  # Message for providing instructions to the LLM
-from langchain_openai import ChatOpenAI
 from langchain_core.tools import tool
 from langgraph.graph.message import add_messages
 from langgraph.graph import StateGraph, END
-from langgraph.prebuilt import ToolNode
+from tool_execution import parallel_tool_node
+from checkpointing import get_checkpointer, session_config
+from instrumentation import instrument_graph
+from lazy_resources import LazyResources
 
 load_dotenv()
 
+resources = LazyResources() # the model is created the first time it is needed, not when the script is imported
+
 """
 Annotated => gives more context to the variable without affecting the variable type, for example email that needs like abc@email.com.
 email = Annotated[str,"This has to be a valid email format]
@@ -100,11 +107,21 @@ def multiply(a:int,b:int):
 
 tools = [add,subtract,multiply] #The doc string is needed else without it the llm wont know what the tool has to do  
 
-model = ChatOpenAI(model='gpt-4o').bind_tools(tools) #this bind tools command is done so that the model, will understand what all tools it can access
+# Opt-in: temperature=0 makes the answers repeatable, so the cache can answer the same prompt (with the same tools) again
+# without calling OpenAI. By default the model keeps its own temperature and the cache leaves those calls alone (see llm_cache.py)
+deterministic = os.getenv("REACT_DETERMINISTIC", "0") == "1"
+
+@resources.register("model")
+def make_model():
+    from langchain_openai import ChatOpenAI # importing langchain_openai alone takes more than a second, so it happens here
+    from llm_cache import LLMCache
+
+    settings = {"temperature": 0} if deterministic else {}
+    return ChatOpenAI(model='gpt-4o', cache=LLMCache(cache_path="LLMCache.sqlite3"), **settings).bind_tools(tools) #this bind tools command is done so that the model, will understand what all tools it can access
 
 def model_call (state:AgentState)->AgentState:
     system_promt = SystemMessage(content= "You are my AI Assistant, please answer my query to the best of your ability.")
-    response=model.invoke([system_promt]+state["messages"]) #The state messages is used so that the query given by the user is also added to the model response 
+    response=resources.get("model").invoke([system_promt]+state["messages"]) #The state messages is used so that the query given by the user is also added to the model response 
     return {'messages':[response]} #what this does is that it updates message with the response 
 
 """
@@ -126,24 +143,32 @@ def should_continue(state: AgentState):
         return "continue"
     
 # defining the graph
-graph =StateGraph(AgentState)
-graph.add_node("our_agent",model_call)
+def build_app(checkpointer=None):
+    """The script runs it with the checkpointer below, benchmarks.py compiles its own copy"""
+    graph =StateGraph(AgentState)
+    graph.add_node("our_agent",model_call)
 
-tool_node = ToolNode(tools=tools) 
-graph.add_node("tools",tool_node) #this is to create a 
-graph.set_entry_point("our_agent")
-graph.add_conditional_edges(
-    "our_agent",
-    should_continue,
-    {
-        "continue":"tools",
-        "end":END
-    }
-)
+    tool_node = parallel_tool_node(tools=tools) # works like ToolNode but when the model asks for several tools at once they run at the same time
+    graph.add_node("tools",tool_node) #this is to create a 
+    graph.set_entry_point("our_agent")
+    graph.add_conditional_edges(
+        "our_agent",
+        should_continue,
+        {
+            "continue":"tools",
+            "end":END
+        }
+    )
 
-graph.add_edge("tools","our_agent") #this is done to re-route from the node to the agent 
+    graph.add_edge("tools","our_agent") #this is done to re-route from the node to the agent 
 
-app = graph.compile()
+    instrument_graph(graph, "react") # wall time, tokens and tool calls of every node, see instrumentation.py
+    return graph.compile(checkpointer=checkpointer)
+
+# Compiled (and the checkpointer opened) on first use, not at import. The state of a run is saved under its thread_id, see checkpointing.py
+resources.register("app", lambda: build_app(checkpointer=get_checkpointer()))
+
+__getattr__ = resources.module_getattr(__name__) # `module.app` and `module.model` still work
 
 def print_stream(stream):
     for s in stream:
@@ -153,8 +178,20 @@ def print_stream(stream):
         else:
             message.pretty_print()
 
-inputs ={"messages":[("user","add 40 + 12 and then multiply the result by 5 and then tell me a joke as well")]}
-print_stream(app.stream(inputs,stream_mode="values"))
+if __name__ == "__main__":
+    inputs ={"messages":[("user","add 40 + 12 and then multiply the result by 5 and then tell me a joke as well")]}
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--thread-id", default=str(uuid.uuid4()), help="run again with the same id to continue that session")
+    parser.add_argument("--warmup", action="store_true", help="create the model in the background while the graph starts")
+    parser.add_argument("--deterministic", action="store_true", help="temperature=0, so repeated prompts are answered from the LLM cache")
+    args = parser.parse_args()
+    deterministic = deterministic or args.deterministic
+    print(f"Thread: {args.thread_id}")
+
+    if args.warmup:
+        resources.warmup()
+
+    print_stream(resources.get("app").stream(inputs,session_config(args.thread_id),stream_mode="values"))
 
 """
 python .\Agent-3.py
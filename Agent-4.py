@@ -19,69 +19,154 @@ This is different from ReAct agent as the Tools is able to end the graph compila
 
 """
 
-from typing import TypedDict,Annotated,Sequence
+import argparse
+import uuid
+from typing import Dict,TypedDict,Annotated,List,Sequence
 from dotenv import load_dotenv
 from langchain_core.messages import BaseMessage,HumanMessage,AIMessage,ToolMessage,SystemMessage
-from langchain_openai import ChatOpenAI
-from langchain_core.tools import tool
-from langgraph.graph.message import add_messages
+from langchain_core.tools import tool, InjectedToolCallId
+from langchain_core.runnables import RunnableConfig
+import operator # operator.add is plain list concatenation, the nodes only return new messages
 from langgraph.graph import StateGraph,END
-from langgraph.prebuilt import ToolNode
+from langgraph.types import Command
+from checkpointing import get_checkpointer, session_config
+from document_model import DraftDocument
+from prompt_builder import PromptBuilder
+from instrumentation import instrument_graph
+from lazy_resources import LazyResources
 
 load_dotenv()
 
-document_content =""
+resources = LazyResources() # the model and the graph are created on first use, so the drafter starts right away
+
+def newest_draft(current: dict, update: dict) -> dict:
+    """Reducer of the draft: every edit tool of a turn sends its copy, the highest version wins"""
+    if not current or update["version"] >= current["version"]:
+        return update
+    return current
 
 class AgentState(TypedDict):
-    messages: Annotated[Sequence[BaseMessage],add_messages]
+    messages: Annotated[Sequence[BaseMessage],operator.add]
+    saved: bool # set by the save tool, so ending the session doesn't need to search the messages
+    draft: Annotated[dict, newest_draft] # {"text", "version"} of the document, checkpointed so a resumed session gets its draft back
+
+
+# The draft is a list of lines with a version history, the tools below change it with small patches (see document_model.py)
+# Every session (thread_id) edits its own draft, it is rebuilt from the checkpointed state when a session is resumed
+documents: Dict[str, DraftDocument] = {}
+
+def session_of(config: RunnableConfig) -> str:
+    return config.get("configurable", {}).get("thread_id", "default")
+
+def document_for(config: RunnableConfig, state: dict = None) -> DraftDocument:
+    session = session_of(config)
+    if session not in documents:
+        draft = (state or {}).get("draft") or {}
+        documents[session] = DraftDocument(draft.get("text", ""))
+        documents[session].version = draft.get("version", 0)
+    return documents[session]
+
+
+def edited(document: DraftDocument, edit, tool_call_id: str) -> Command:
+    """Shows the human what changed (printing costs no tokens), gives the model a one line confirmation and checkpoints the draft"""
+    if edit.inserted:
+        print(f"\n Document version {edit.version}:\n{document.render(edit.start, edit.start + len(edit.inserted) - 1)}")
+    return Command(update={
+        "draft": {"text": document.text, "version": document.version},
+        "messages": [ToolMessage(content=document.describe(edit), tool_call_id=tool_call_id)],
+    })
 
 @tool
-def update(content: str)->str: #So the parameters that are passed they are given by the llm itself 
-    """Updates the document with the providede content"""
-    global document_content
-    document_content=content
+def update(content: str, config: RunnableConfig, tool_call_id: Annotated[str, InjectedToolCallId]): #So the parameters that are passed they are given by the llm itself 
+    """Replaces the whole document. Only for the first draft or a complete rewrite, use the other tools to change a part of it"""
+    document = document_for(config)
+    return edited(document, document.set_text(content), tool_call_id)
 
-    return f"Document has been update successfully! The current content is: \n{document_content}"
+@tool
+def replace_lines(first_line: int, last_line: int, content: str, config: RunnableConfig, tool_call_id: Annotated[str, InjectedToolCallId]):
+    """Replaces lines first_line to last_line (both included) with the content, an empty content deletes them"""
+    document = document_for(config)
+    return edited(document, document.replace_lines(first_line, last_line, content), tool_call_id)
 
 @tool
-def save(filename: str)-> str: # the llm will need to give an appropriate file name and also take care of the logic to save the file as well
+def replace_section(section: int, content: str, config: RunnableConfig, tool_call_id: Annotated[str, InjectedToolCallId]):
+    """Replaces a whole section (numbered like in the outline) with the content"""
+    document = document_for(config)
+    return edited(document, document.replace_section(section, content), tool_call_id)
+
+@tool
+def insert_lines(after_line: int, content: str, config: RunnableConfig, tool_call_id: Annotated[str, InjectedToolCallId]):
+    """Inserts the content after the given line, after_line=0 inserts at the top"""
+    document = document_for(config)
+    return edited(document, document.insert_lines(after_line, content), tool_call_id)
+
+@tool
+def append(content: str, config: RunnableConfig, tool_call_id: Annotated[str, InjectedToolCallId]):
+    """Adds the content at the end of the document as a new section"""
+    document = document_for(config)
+    return edited(document, document.append(content), tool_call_id)
+
+@tool
+def show_sections(sections: List[int], config: RunnableConfig)->str:
+    """Returns the text of these sections with their line numbers, use it before editing a section you can't see"""
+    return document_for(config).show(sections)
+
+@tool
+def undo(config: RunnableConfig, tool_call_id: Annotated[str, InjectedToolCallId]):
+    """Reverts the last change to the document"""
+    document = document_for(config)
+    edit = document.undo()
+    return edited(document, edit, tool_call_id) if edit else "There is nothing to undo."
+
+@tool
+def save(filename: str, config: RunnableConfig, tool_call_id: Annotated[str, InjectedToolCallId]): # the llm will need to give an appropriate file name and also take care of the logic to save the file as well
     """
          Saves the current document to a text file and finish the process
             Args:
                 filename: The name for the text file
     """
 
-    global document_content
-    
     if not filename.endswith('.txt'): #So ideally the llm should save the file name as a txt and incase it doesnt this code will handle it
         filename=f"{filename}.txt"
 
 
     try:
         with open(filename,'w') as file:
-            file.write(document_content)
+            file.write(document_for(config).text)
         print(f"\n Document has been save to : {filename}")
-        return f"Document has been successfully saved to '{filename}'."
+        # A Command lets the tool set the saved flag in the state next to its ToolMessage
+        return Command(update={
+            "saved": True,
+            "messages": [ToolMessage(content=f"Document has been successfully saved to '{filename}'.", tool_call_id=tool_call_id)],
+        })
     
     except Exception as e :
         return f"Error saving the document: {str(e)}" 
     
-tools = [update,save]
+tools = [update,replace_lines,replace_section,insert_lines,append,show_sections,undo,save]
  
-model = ChatOpenAI(model='gpt-4o').bind_tools(tools)
+@resources.register("model")
+def make_model():
+    from langchain_openai import ChatOpenAI # slow import, only paid when the model is needed
+
+    return ChatOpenAI(model='gpt-4o').bind_tools(tools)
 
 #Agent is a node and the function behind it is what we define
 
-def our_agent(state:AgentState)->AgentState:
-    system_promt = SystemMessage(content=f"""
+# The instructions never change, so they are built once. The document changes with every edit, so it goes at the very
+# end of the prompt: everything before it is the same as in the last call and OpenAI can reuse it (see prompt_builder.py)
+prompt = PromptBuilder("""
     You are a drafter, a helpful writing assistant. You are going to help th euser update and modify documents.
     
-    - If the user wants to update or modify content, use the 'update' tool with the complete updated content.
+    - Change only what the user asks for: use 'replace_lines', 'replace_section', 'insert_lines' or 'append' with just the new text.
+    - Use 'update' with the complete content only to write the first draft or to rewrite everything.
+    - If you need to see a section that is not shown in the current document, use 'show_sections'. 'undo' reverts the last change.
     - If the user wants to save and finish, you need to use the 'save' tool.
-    - Make sure to always show the current document state after nodifications.
-                    
-    The current document content is:{document_content} 
-                                 """)
+    - The user sees every change, don't repeat the document in your answer.
+    - The current document comes last, after the user's request.
+""", tools, name="drafter")
+
+def our_agent(state:AgentState, config:RunnableConfig)->AgentState:
 
     if not state["messages"]:
         user_input ="Im ready to help you update a document , what would you like to create?"
@@ -92,30 +177,25 @@ def our_agent(state:AgentState)->AgentState:
         print(f"\n USER:{user_input}")
         user_message = HumanMessage(content=user_input)
 
-    all_messages = [system_promt]+list(state['messages'])+[user_message]
-    response = model.invoke(all_messages)
+    # Only an outline and the sections being worked on are sent for a long draft, not the whole document every turn
+    document = document_for(config, state)
+    current_document = f"The current document (line numbers on the left are not part of the text):\n{document.prompt_view()}"
+    all_messages = prompt.build([*state['messages'], user_message], volatile=current_document, session=session_of(config))
+    response = resources.get("model").invoke(all_messages)
 
     print(f"\n AI: {response.content}")
     if hasattr(response,"tool_call") and response.tool_calls:
         print(f" Using TOOLS: {[tc['name'] for tc in response.tool_calls]}")
 
-    return {"messages":list(state['messages'])+[user_message, response]}
+    # Only the new messages, operator.add appends them to the history (returning the whole list made it merge everything again every turn)
+    return {"messages":[user_message, response]}
 
 
 def should_continue (state: AgentState)-> str:
     """Determine if we should continue or end the conversation"""
-    messages = state["messages"]
+    if state.get("saved"):
+        return "end" # the save tool succeeded, the drafting session is over
 
-    if not messages:
-        return "continue"
-
-    # this is used to check the latest tool usage
-    for message in reversed(messages):
-        if (isinstance(message,ToolMessage) and 
-            "saved" in message.content.lower() and 
-            "document" in message.content.lower()):
-            return "end" #If the key word saved document is there then it should take us to the end node
-        
     return "continue"
 
 def print_messages(messages):
@@ -127,38 +207,62 @@ def print_messages(messages):
         if isinstance(message, ToolMessage):
             print(f"\n TOOL Result: {message.content}")
 
-graph = StateGraph(AgentState)
+def build_app(checkpointer=None):
+    """The graph of the drafter, compiled on first use below (benchmarks.py compiles its own copy)"""
+    from langgraph.prebuilt import ToolNode # langgraph.prebuilt is heavy too
 
-graph.add_node("agent", our_agent)
-graph.add_node("tools", ToolNode(tools))
+    graph = StateGraph(AgentState)
 
-graph.set_entry_point("agent")
-graph.add_edge("agent", "tools")
+    graph.add_node("agent", our_agent)
+    graph.add_node("tools", ToolNode(tools))
 
-graph.add_conditional_edges(
-    "tools",
-    should_continue,
-    {
-        "continue": "agent",
-        "end": END,
-    }
-)
+    graph.set_entry_point("agent")
+    graph.add_edge("agent", "tools")
 
-app = graph.compile()
+    graph.add_conditional_edges(
+        "tools",
+        should_continue,
+        {
+            "continue": "agent",
+            "end": END,
+        }
+    )
 
-def run_document_agent():
+    instrument_graph(graph, "drafter") # wall time, tokens and tool calls of every node, see instrumentation.py
+    return graph.compile(checkpointer=checkpointer)
+
+
+resources.register("app", lambda: build_app(checkpointer=get_checkpointer())) # saves the drafting session under its thread_id, see checkpointing.py
+
+
+__getattr__ = resources.module_getattr(__name__) # `module.app` and `module.model` still work
+
+def run_document_agent(thread_id: str):
     print("\n ===== DRAFTER =====")
+    print(f" Session: {thread_id}")
     
-    state = {"messages": []}
+    state = {"messages": [], "saved": False} # saved is reset, so a continued session doesn't end right away
     
-    for step in app.stream(state, stream_mode="values"):
+    # Every edit is two steps of the graph, LangGraph's default limit of 25 steps would end a session after 12 edits
+    # The whole session is one run (input() is inside our_agent), so every step is checkpointed, not only the end of the
+    # run: a Ctrl-C or a crash keeps the draft and --thread-id continues from it
+    config = {**session_config(thread_id, batch_writes=False), "recursion_limit": 10_000}
+    for step in resources.get("app").stream(state, config, stream_mode="values"):
         if "messages" in step:
             print_messages(step["messages"])
     
     print("\n ===== DRAFTER FINISHED =====")
 
 if __name__ == "__main__":
-    run_document_agent()
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--thread-id", default=str(uuid.uuid4()), help="id of a previous session to continue")
+    parser.add_argument("--warmup", action="store_true", help="create the model in the background while you type your first request")
+    args = parser.parse_args()
+
+    if args.warmup:
+        resources.warmup()
+
+    run_document_agent(args.thread_id)
 
 
 """
@@ -15,109 +15,192 @@
 """
 
 from dotenv import load_dotenv
+import argparse
 import os
-from langgraph.graph import StateGraph, END
-from typing import TypedDict, Annotated, Sequence
-from langchain_core.messages import BaseMessage, SystemMessage, HumanMessage, ToolMessage
+import uuid
+from typing import TypedDict, Annotated, Optional, Sequence
+from langchain_core.messages import BaseMessage, SystemMessage, HumanMessage, AIMessage, ToolMessage
 from operator import add as add_messages
-from langchain_openai import ChatOpenAI, OpenAIEmbeddings
-from langchain_community.document_loaders import PyPDFLoader
-from langchain.text_splitter import RecursiveCharacterTextSplitter
-from langchain_chroma import Chroma
 from langchain_core.tools import tool
+from langchain_core.runnables import RunnableConfig
+from tool_execution import run_tool_calls, arun_tool_calls
+from streaming import print_stream_reply
+from checkpointing import get_checkpointer, session_config
+from instrumentation import instrument_graph, metrics, record_cache, format_summary
+from context_packing import ContextPacker, format_documents
+from prompt_builder import PromptBuilder
+from lazy_resources import LazyResources
 
 load_dotenv()
 
-llm = ChatOpenAI(
-    model="gpt-4o", temperature = 0) # I want to minimize hallucination - temperature = 0 makes the model output more deterministic 
+# Nothing heavy happens at import anymore: the models, the index and the graph are created the first time they are
+# needed (or in the background with --warmup), and the big libraries are only imported inside their factories
+resources = LazyResources()
 
-# Our Embedding Model - has to also be compatible with the LLM
-embeddings = OpenAIEmbeddings(
-    model="text-embedding-3-small",
-)
 
+@resources.register("llm_cache")
+def make_llm_cache():
+    from llm_cache import LLMCache
 
-pdf_path = "Stock_Market_Performance_2024.pdf"
+    # Same prompt + same tools + temperature 0 => same answer, so repeated calls are answered from disk (see llm_cache.py)
+    return LLMCache(cache_path=os.path.join(os.getcwd(), "LLMCache.sqlite3"))
 
 
-# Safety measure I have put for debugging purposes :)
-if not os.path.exists(pdf_path):
-    raise FileNotFoundError(f"PDF file not found: {pdf_path}")
+@resources.register("llm")
+def make_llm():
+    from langchain_openai import ChatOpenAI
+    from http_clients import shared_http_client, shared_async_http_client
 
-pdf_loader = PyPDFLoader(pdf_path) # This loads the PDF
+    # All the OpenAI calls go through one pooled HTTP client, so connections are reused across questions (see http_clients.py)
+    llm = ChatOpenAI(
+        model="gpt-4o", temperature = 0, # I want to minimize hallucination - temperature = 0 makes the model output more deterministic 
+        http_client=shared_http_client(),
+        http_async_client=shared_async_http_client(),
+        cache=resources.get("llm_cache"),
+    )
+    return llm.bind_tools(tools)
 
 
-# Checks if the PDF is there
-try:
-    pages = pdf_loader.load()
-    print(f"PDF has been loaded and has {len(pages)} pages")
-except Exception as e:
-    print(f"Error loading PDF: {e}")
-    raise
+@resources.register("embeddings")
+def make_embeddings():
+    from langchain_openai import OpenAIEmbeddings
+    from embedding_cache import CachedEmbeddings
+    from http_clients import shared_http_client
 
-# Chunking Process
-text_splitter = RecursiveCharacterTextSplitter(
-    chunk_size=1000,
-    chunk_overlap=200
-)
+    # Our Embedding Model - has to also be compatible with the LLM
+    # It is wrapped in a cache so the same chunk or the same question is never embedded twice, even across restarts
+    # (no shared async client here: ingestion embeds inside its own short lived event loop)
+    return CachedEmbeddings(
+        OpenAIEmbeddings(model="text-embedding-3-small", http_client=shared_http_client()),
+        cache_path=os.path.join(os.getcwd(), "EmbeddingCache.sqlite3"),
+    )
 
 
-pages_split = text_splitter.split_documents(pages) # We now apply this to our pages
+pdf_path = "Stock_Market_Performance_2024.pdf"
 
+# Where the chunk vectors live: "chroma" (default), "numpy", the in-process index from vector_index.py
+# that opens instantly and is faster for a corpus of this size, or "ivf", the approximate index from ann_index.py
+# for when the whole archive is indexed. RAG_VECTOR_BACKEND=numpy python Agent-5.py
+vector_backend = os.getenv("RAG_VECTOR_BACKEND", "chroma")
 
 # persist_directory = r"D:\LangGraph\ChromaDB"
-persist_directory = os.path.join(os.getcwd(), "ChromaDB") #this code will create the directory where the code is being executed
-collection_name = "stock_market"
-
-# If our collection does not exist in the directory, we create using the os command
-if not os.path.exists(persist_directory):
-    os.makedirs(persist_directory)
-
-
-text = "This is a test string."
-embedding = embeddings.embed_query(text)
-
-try:
-    # Here, we actually create the chroma database using our embeddigns model
-    vectorstore = Chroma.from_documents(
-    documents=pages_split,
-    embedding=embeddings,
-    persist_directory=persist_directory,
-)
-
-except Exception as e:
-    print(f"Error setting up ChromaDB: {str(e)}")
-    raise
-
-
-# Now we create our retriever 
-retriever = vectorstore.as_retriever(
-    search_type="similarity",
-    search_kwargs={"k": 5} # K is the amount of chunks to return
-)
-
-@tool
-def retriever_tool(query: str) -> str:
+persist_directory = os.path.join(os.getcwd(), "ChromaDB" if vector_backend == "chroma" else "VectorIndex") #this code will create the directory where the code is being executed
+collection_name = "stock_market" # the collection of our PDF, the reports ingested with rag_ingestion.py --collection ... sit next to it
+
+
+@resources.register("lexical_index")
+def make_lexical_index():
+    from hybrid_retrieval import BM25Index
+
+    # Keyword index of the same chunks, it catches the tickers, numbers and names dense search misses (see hybrid_retrieval.py)
+    os.makedirs(persist_directory, exist_ok=True)
+    return BM25Index(os.path.join(persist_directory, f"{collection_name}.bm25.sqlite3"))
+
+
+@resources.register("vectorstore")
+def make_vectorstore():
+    from langchain.text_splitter import RecursiveCharacterTextSplitter
+    from rag_ingestion import sync_sources, manifest_path_for
+    from vector_index import open_vectorstore
+
+    # Safety measure I have put for debugging purposes :)
+    if not os.path.exists(pdf_path):
+        raise FileNotFoundError(f"PDF file not found: {pdf_path}")
+
+    # Chunking Process
+    text_splitter = RecursiveCharacterTextSplitter(
+        chunk_size=1000,
+        chunk_overlap=200,
+        add_start_index=True # The offset of every chunk inside its page is part of the chunk id used by the ingestion manifest
+    )
+
+    embeddings = resources.get("embeddings")
+    try:
+        # We attach to the existing collection instead of building a new one on every start
+        vectorstore = open_vectorstore(vector_backend, embeddings, persist_directory, collection_name)
+
+        # Only new or changed chunks get embedded, when the PDF did not change this just reads the manifest
+        report = sync_sources(
+            vectorstore,
+            [pdf_path],
+            text_splitter,
+            manifest_path_for(persist_directory, collection_name),
+            settings={
+                "collection": collection_name,
+                "embedding_model": embeddings.model,
+                "chunk_size": 1000,
+                "chunk_overlap": 200,
+            },
+            prune=False, # Keeps the PDFs that were added with `python rag_ingestion.py --dir ...`
+            lexical_index=resources.get("lexical_index"),
+        )
+        print(f"Index is up to date: {report['added']} chunks embedded, {report['deleted']} removed, {report['total_chunks']} in total")
+
+    except Exception as e:
+        print(f"Error setting up the vector store: {str(e)}")
+        raise
+    return vectorstore
+
+
+@resources.register("retriever")
+def make_retriever():
+    from hybrid_retrieval import BM25Index, HybridRetriever, overlap_reranker
+    from collection_router import CollectionRouter, RoutedRetriever, collection_names
+    from vector_index import open_vectorstore
+
+    # Every collection gets its own retriever: our PDF is synced into its collection above, the other collections
+    # are opened as rag_ingestion.py left them
+    stores = {collection_name: (resources.get("vectorstore"), resources.get("lexical_index"))}
+    for name in collection_names(persist_directory):
+        if name not in stores:
+            stores[name] = (
+                open_vectorstore(vector_backend, resources.get("embeddings"), persist_directory, name),
+                BM25Index(os.path.join(persist_directory, f"{name}.bm25.sqlite3")),
+            )
+
+    # Now we create our retriever 
+    # Dense and keyword search both propose 20 chunks, they are fused and reranked, and only the best 4 go to the model
+    retrievers = {
+        name: HybridRetriever(
+            vectorstore=vectorstore,
+            lexical_index=lexical_index,
+            k=4, # K is the amount of chunks to return
+            fetch_k=20,
+            reranker=overlap_reranker(lexical_index),
+        )
+        for name, (vectorstore, lexical_index) in stores.items()
+    }
+    # The router sends every query only to the collections that can answer it (see collection_router.py)
+    router = CollectionRouter({name: lexical_index for name, (_, lexical_index) in stores.items()})
+    return RoutedRetriever(retrievers=retrievers, router=router, k=4)
+
+@tool(response_format="content_and_artifact") # the documents themselves travel as the artifact, the context packer needs them
+def retriever_tool(query: str, source: Optional[str] = None, year: Optional[int] = None, section: Optional[str] = None, page: Optional[int] = None):
     """
-    This tool searches and returns the information from the Stock Market Performance 2024 document.
+    This tool searches and returns the information from the Stock Market Performance 2024 document and the other ingested reports.
+    Leave the filters empty to search everything. source, year, section and page (written exactly as in the earlier results)
+    only search the passages that match all of them, e.g. section="Tesla, Inc. (TSLA) - 2024 Performance".
     """
+    from collection_router import search_filter
+
+    filter = search_filter(source=source, year=year, section=section, page=page)
+    retriever = resources.get("retriever")
+    docs = retriever.invoke(query, filter=filter) if filter else retriever.invoke(query)
+    return retriever_result(docs, filter)
 
-    docs = retriever.invoke(query)
 
+def retriever_result(docs, filter=None):
+    """What retriever_tool sends back, also used for the searches that were prefetched (see take_action)"""
     if not docs:
-        return "I found no relevant information in the Stock Market Performance 2024 document."
-    
-    results = []
-    for i, doc in enumerate(docs):
-        results.append(f"Document {i+1}:\n{doc.page_content}")
+        if filter:
+            return f"I found no relevant information matching {filter}, try the search again with fewer filters.", []
+        return "I found no relevant information in the Stock Market Performance 2024 document.", []
     
-    return "\n\n".join(results)
+    return format_documents(docs), docs
 
 
 tools = [retriever_tool]
 
-llm = llm.bind_tools(tools)
-
 class AgentState(TypedDict):
     messages: Annotated[Sequence[BaseMessage], add_messages]
 
@@ -132,78 +215,257 @@ system_prompt = """
 You are an intelligent AI assistant who answers questions about Stock Market Performance in 2024 based on the PDF document loaded into your knowledge base.
 Use the retriever tool available to answer questions about the stock market performance data. You can make multiple calls if needed.
 If you need to look up some information before asking a follow up question, you are allowed to do that!
+When a question is about one company, section or year, use the filters of the retriever tool to search only those passages.
 Please always cite the specific parts of the documents you use in your answers.
 """
 
 
 tools_dict = {our_tool.name: our_tool for our_tool in tools} # Creating a dictionary of our tools
 
+# Merges overlapping chunks, drops the ones already in the conversation and keeps a turn under 2000 tokens of context
+context_packer = ContextPacker(max_tokens=2000)
+
 # LLM Agent
-def call_llm(state: AgentState) -> AgentState:
+# Instructions and tools first, then the history, so every call starts with the prompt of the call before it
+# and OpenAI serves that part from its prompt cache (see prompt_builder.py)
+prompt = PromptBuilder(system_prompt, tools, name="rag")
+
+# Opt-in: the search for the question starts while the model is still deciding what to search for,
+# its results answer the tool call when the model's query is close to the question (see speculative_retrieval.py)
+speculative_retrieval = os.getenv("RAG_SPECULATIVE_RETRIEVAL", "0") == "1"
+
+
+@resources.register("speculative")
+def make_speculative():
+    from speculative_retrieval import SpeculativeRetrieval
+
+    return SpeculativeRetrieval(lambda question: resources.get("retriever").invoke(question), weight=resources.get("lexical_index").idf)
+
+
+def session_of(config: RunnableConfig) -> str:
+    return config.get("configurable", {}).get("thread_id", "default")
+
+
+def call_llm(state: AgentState, config: RunnableConfig) -> AgentState:
     """Function to call the LLM with the current state."""
-    messages = list(state['messages'])
-    messages = [SystemMessage(content=system_prompt)] + messages
-    message = llm.invoke(messages)
+    if speculative_retrieval and isinstance(state['messages'][-1], HumanMessage):
+        resources.get("speculative").start(session_of(config), state['messages'][-1].content)
+    messages = prompt.build(state['messages'], session=session_of(config))
+    message = resources.get("llm").invoke(messages)
     return {'messages': [message]}
 
 
-# Retriever Agent
-def take_action(state: AgentState) -> AgentState:
-    """Execute tool calls from the LLM's response."""
+async def acall_llm(state: AgentState, config: RunnableConfig) -> AgentState:
+    """Same as call_llm but awaits the model with the async HTTP client, used by rag_agent.ainvoke / astream.
+    A sync node would run in the event loop's default thread pool, so only a handful of questions could wait on OpenAI at once"""
+    if speculative_retrieval and isinstance(state['messages'][-1], HumanMessage):
+        resources.get("speculative").start(session_of(config), state['messages'][-1].content)
+    messages = prompt.build(state['messages'], session=session_of(config))
+    message = await resources.get("llm").ainvoke(messages)
+    return {'messages': [message]}
 
-    tool_calls = state['messages'][-1].tool_calls
-    results = []
+
+# Retriever Agent
+def announce_tool_calls(tool_calls):
     for t in tool_calls:
         print(f"Calling Tool: {t['name']} with query: {t['args'].get('query', 'No query provided')}")
-        
         if not t['name'] in tools_dict: # Checks if a valid tool is present
             print(f"\nTool: {t['name']} does not exist.")
-            result = "Incorrect Tool Name, Please Retry and Select tool from List of Available tools."
-        
-        else:
-            result = tools_dict[t['name']].invoke(t['args'].get('query', ''))
-            print(f"Result length: {len(str(result))}")
-            
 
-        # Appends the Tool Message
-        results.append(ToolMessage(tool_call_id=t['id'], name=t['name'], content=str(result)))
+
+def prefetch_candidates(tool_calls):
+    """The retriever_tool calls with their filter, the ones a prefetched search may answer"""
+    from collection_router import search_filter
+
+    for t in tool_calls:
+        if t['name'] == retriever_tool.name:
+            args = t['args']
+            yield t, args.get('query', ''), search_filter(**{key: args.get(key) for key in ('source', 'year', 'section', 'page')})
+
+
+def prefetched_message(t, docs) -> ToolMessage:
+    content, artifact = retriever_result(docs)
+    return ToolMessage(content=content, artifact=artifact, tool_call_id=t['id'], name=t['name'])
+
+
+def in_call_order(tool_calls, served, results):
+    """The prefetched results and the searched ones back in the order of the tool calls"""
+    searched = iter(results)
+    return [served[t['id']] if t['id'] in served else next(searched) for t in tool_calls]
+
+
+def take_action(state: AgentState, config: RunnableConfig) -> AgentState:
+    """Execute tool calls from the LLM's response."""
+
+    tool_calls = state['messages'][-1].tool_calls
+    announce_tool_calls(tool_calls)
+
+    served = {}
+    if speculative_retrieval:
+        for t, query, filter in prefetch_candidates(tool_calls):
+            docs = resources.get("speculative").take(session_of(config), query, filter)
+            if docs is not None:
+                served[t['id']] = prefetched_message(t, docs)
+
+    # All the queries of one turn run at the same time, so the turn takes as long as the slowest search
+    remaining = [t for t in tool_calls if t['id'] not in served]
+    results = run_tool_calls(remaining, tools_dict, timeout=30, max_concurrency=5, config=config) if remaining else []
+    results = context_packer.pack_messages(in_call_order(tool_calls, served, results), state['messages'])
+    for result in results:
+        print(f"Result length: {len(str(result.content))}")
+
+    print("Tools Execution Complete. Back to the model!")
+    return {'messages': results}
+
+
+async def atake_action(state: AgentState, config: RunnableConfig) -> AgentState:
+    """Same as take_action but on the event loop, used by rag_agent.ainvoke / astream"""
+
+    tool_calls = state['messages'][-1].tool_calls
+    announce_tool_calls(tool_calls)
+
+    served = {}
+    if speculative_retrieval:
+        for t, query, filter in prefetch_candidates(tool_calls):
+            docs = await resources.get("speculative").atake(session_of(config), query, filter)
+            if docs is not None:
+                served[t['id']] = prefetched_message(t, docs)
+
+    remaining = [t for t in tool_calls if t['id'] not in served]
+    results = await arun_tool_calls(remaining, tools_dict, timeout=30, max_concurrency=5, config=config) if remaining else []
+    results = context_packer.pack_messages(in_call_order(tool_calls, served, results), state['messages'])
+    for result in results:
+        print(f"Result length: {len(str(result.content))}")
 
     print("Tools Execution Complete. Back to the model!")
     return {'messages': results}
 
 
-graph = StateGraph(AgentState)
-graph.add_node("llm", call_llm)
-graph.add_node("retriever_agent", take_action)
+def build_rag_agent(checkpointer=None):
+    """Compiles the RAG graph, the server passes an async checkpointer here"""
+    from langgraph.graph import StateGraph, END
+    from langchain_core.runnables import RunnableLambda
+
+    graph = StateGraph(AgentState)
+    graph.add_node("llm", RunnableLambda(call_llm, afunc=acall_llm))
+    graph.add_node("retriever_agent", RunnableLambda(take_action, afunc=atake_action))
+
+    graph.add_conditional_edges(
+        "llm",
+        should_continue,
+        {True: "retriever_agent", False: END}
+    )
+    graph.add_edge("retriever_agent", "llm")
+    graph.set_entry_point("llm")
+
+    instrument_graph(graph, "rag") # wall time, tokens, retrieved chunks and cache hits of every node, see instrumentation.py
+    return graph.compile(checkpointer=checkpointer)
 
-graph.add_conditional_edges(
-    "llm",
-    should_continue,
-    {True: "retriever_agent", False: END}
-)
-graph.add_edge("retriever_agent", "llm")
-graph.set_entry_point("llm")
 
-rag_agent = graph.compile()
+# every thread_id keeps its own conversation, see checkpointing.py
+resources.register("rag_agent", lambda: build_rag_agent(checkpointer=get_checkpointer()))
 
 
-def running_agent():
+@resources.register("response_cache")
+def make_response_cache():
+    from rag_ingestion import manifest_path_for, fingerprint_reader
+    from collection_router import collection_names
+    from response_cache import SemanticResponseCache
+
+    # Questions that were answered before (or nearly the same ones) are served from memory, see response_cache.py
+    # The cache is emptied whenever the manifest of any collection changes, so answers never outlive the chunks they cite
+    return SemanticResponseCache(
+        resources.get("embeddings"),
+        threshold=0.92,
+        ttl=24 * 3600,
+        max_entries=1000,
+        fingerprint=fingerprint_reader(*(manifest_path_for(persist_directory, name) for name in sorted({collection_name, *collection_names(persist_directory)}))),
+    )
+
+
+# `rag.rag_agent`, `rag.response_cache`, ... still work for the code that loads this script (rag_server.py)
+__getattr__ = resources.module_getattr(__name__)
+
+
+def cited_chunks(messages) -> list:
+    """The tool results of the last question, this is what the answer was built from"""
+    citations = []
+    for message in reversed(messages):
+        if isinstance(message, HumanMessage):
+            break
+        if isinstance(message, ToolMessage):
+            citations.append(message.content)
+    return list(reversed(citations))
+
+
+def answer_question(question: str, config: dict, stream: bool = True) -> str:
+    """Runs one question through the cache and, on a miss, through the graph"""
+    rag_agent = resources.get("rag_agent")
+    response_cache = resources.get("response_cache")
+
+    # Only the first question of a session goes through the cache, a follow up question depends on what came before it,
+    # so it is neither answered from the cache nor stored in it
+    standalone = not rag_agent.get_state(config).values.get("messages")
+    cached = response_cache.lookup(question) if standalone else None
+    if standalone:
+        record_cache("response", bool(cached))
+    if cached:
+        # The cached answer is still written into the session, so follow up questions see it
+        rag_agent.update_state(config, {"messages": [HumanMessage(content=question), AIMessage(content=cached["answer"])]}, as_node="llm")
+        print(f"\n=== ANSWER (cached, similar to: {cached['question']!r}) ===")
+        print(cached["answer"])
+        return cached["answer"]
+
+    messages = [HumanMessage(content=question)] # converts back to a HumanMessage type
+
+    if stream:
+        # The answer is printed token by token while gpt-4o writes it, the tool calling step has no text so nothing shows up for it
+        result = print_stream_reply(rag_agent, {"messages": messages}, config, nodes={"llm"}, prefix="\n=== ANSWER ===\n")
+    else:
+        result = rag_agent.invoke({"messages": messages}, config)
+        
+        print("\n=== ANSWER ===")
+        print(result['messages'][-1].content)
+
+    answer = result['messages'][-1].content
+    if standalone:
+        response_cache.store(question, answer, cited_chunks(result['messages']))
+    return answer
+
+
+def running_agent(stream: bool = True, thread_id: str = "default", metrics_path: str = None):
     print("\n=== RAG AGENT===")
+    print(f"Session: {thread_id}")
+    config = session_config(thread_id) # the messages of earlier questions in this session are restored by the checkpointer
     
     while True:
         user_input = input("\nWhat is your question: ")
         if user_input.lower() in ['exit', 'quit']:
             break
-            
-        messages = [HumanMessage(content=user_input)] # converts back to a HumanMessage type
 
-        result = rag_agent.invoke({"messages": messages})
-        
-        print("\n=== ANSWER ===")
-        print(result['messages'][-1].content)
+        answer_question(user_input, config, stream)
+
+    print(f"Response cache: {resources.get('response_cache').stats()}")
+    print(f"LLM cache: {resources.get('llm_cache').stats()}")
+    print(format_summary(metrics.summary())) # which node the time went to
+    if metrics_path:
+        metrics.write_prometheus(metrics_path)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--no-stream", action="store_true", help="print the answer only when it is complete")
+    parser.add_argument("--thread-id", default=str(uuid.uuid4()), help="id of a previous session to continue")
+    parser.add_argument("--warmup", action="store_true", help="load the models and sync the index in the background while you type")
+    parser.add_argument("--metrics", default=None, help="write the node metrics to this file (Prometheus text format) on exit")
+    parser.add_argument("--speculative", action="store_true", help="start the search for every question while the model decides what to search for")
+    args = parser.parse_args()
+    speculative_retrieval = speculative_retrieval or args.speculative
 
+    if args.warmup:
+        resources.warmup(["llm", "retriever", "rag_agent", "response_cache"] + (["speculative"] if speculative_retrieval else []))
 
-running_agent()
+    running_agent(stream=not args.no_stream, thread_id=args.thread_id, metrics_path=args.metrics)
 
 """
 Output:
@@ -0,0 +1,32 @@
+"""
+The agents live in scripts like Agent-5.py, and a dash is not allowed in a module name,
+so `import Agent-5` doesn't work. load_agent imports such a script by its file name instead:
+
+    rag = load_agent("Agent-5.py")
+    rag.rag_agent.invoke(...)
+
+The script only runs its interactive loop under `if __name__ == "__main__"`, so loading it is safe.
+"""
+
+import importlib.util
+import os
+import sys
+from types import ModuleType
+
+ROOT = os.path.dirname(os.path.abspath(__file__))
+
+
+def load_agent(script: str) -> ModuleType:
+    name = os.path.splitext(script)[0].replace("-", "_").lower()  # Agent-5.py => agent_5
+    if name in sys.modules:
+        return sys.modules[name]
+
+    spec = importlib.util.spec_from_file_location(name, os.path.join(ROOT, script))
+    module = importlib.util.module_from_spec(spec)
+    sys.modules[name] = module
+    try:
+        spec.loader.exec_module(module)
+    except BaseException:
+        del sys.modules[name]
+        raise
+    return module
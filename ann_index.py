@@ -0,0 +1,214 @@
+"""
+Approximate nearest neighbour index for large corpora
+
+The flat index in vector_index.py scores every chunk for every question, fine for one PDF, slow once the
+whole research archive is in there. IVFVectorStore is the same store with an inverted file index on top:
+
+    - training => spherical k-means splits the vectors into `nlist` clusters (about sqrt(n) by default)
+    - search   => the question is compared with the cluster centroids first, and only the chunks of the
+                  `nprobe` closest clusters are scored, so a search touches a few % of the corpus
+    - int8     => every vector is also kept as int8 codes with one scale per row (4x smaller than float32),
+                  the candidates are scored on those codes
+    - rerank   => the best k * rerank candidates are scored again with the exact float32 vectors
+                  (rerank=0 skips that and never pages in the float matrix)
+    - inserts  => new chunks are quantized and assigned to their nearest cluster right away, the clusters are
+                  trained once `min_train_rows` chunks are in and trained again when the index grew `retrain_growth` times
+    - disk     => codes, scales and cluster of every row are memory-mapped next to the float matrix, the centroids
+                  are a small .npy file, so reopening the index doesn't retrain anything
+
+nprobe and rerank are the recall / latency knobs, `python benchmarks.py ann` measures both against exact search.
+Until it is trained (small collections) the store searches exactly, like NumpyVectorStore. A metadata filter that
+keeps only a small part of the corpus is searched exactly too: scoring those rows is cheaper than probing clusters
+that may hold none of them.
+
+    store = open_vectorstore("ivf", embeddings, "VectorIndex", "research_archive")
+    store.search_vectors(query_vectors, k=10, nprobe=16)
+"""
+
+import os
+from typing import List, Optional, Tuple
+
+import numpy as np
+from langchain_core.embeddings import Embeddings
+
+from vector_index import BLOCK_ROWS, NumpyVectorStore, grow_array, normalize_rows, top_k
+
+
+def quantize(vectors: np.ndarray) -> Tuple[np.ndarray, np.ndarray]:
+    """int8 codes and the scale of every row, vector ~= codes * scale"""
+    scales = np.abs(vectors).max(axis=1) / 127.0
+    scales[scales == 0] = 1.0
+    codes = np.round(vectors / scales[:, None]).astype(np.int8)
+    return codes, scales.astype(np.float32)
+
+
+def nearest_centroid(vectors: np.ndarray, centroids: np.ndarray) -> np.ndarray:
+    labels = np.empty(len(vectors), dtype=np.int32)
+    for start in range(0, len(vectors), BLOCK_ROWS):
+        block = np.asarray(vectors[start:start + BLOCK_ROWS], dtype=np.float32)
+        labels[start:start + len(block)] = np.argmax(block @ centroids.T, axis=1)
+    return labels
+
+
+def spherical_kmeans(data: np.ndarray, clusters: int, iterations: int = 10, seed: int = 0) -> np.ndarray:
+    """k-means on the unit sphere (cosine similarity), the centroids come back normalized"""
+    rng = np.random.default_rng(seed)
+    centroids = data[rng.choice(len(data), clusters, replace=False)].copy()
+    for _ in range(iterations):
+        labels = nearest_centroid(data, centroids)
+        sums = np.zeros_like(centroids)
+        np.add.at(sums, labels, data)
+        empty = np.bincount(labels, minlength=clusters) == 0
+        if empty.any():
+            # A cluster that lost all its points restarts from a random point
+            sums[empty] = data[rng.choice(len(data), int(empty.sum()))]
+        centroids = normalize_rows(sums)
+    return centroids
+
+
+class IVFVectorStore(NumpyVectorStore):
+    def __init__(
+        self,
+        embedding: Embeddings,
+        persist_directory: Optional[str] = None,
+        collection_name: str = "default",
+        nlist: Optional[int] = None,
+        nprobe: int = 8,
+        rerank: int = 4,
+        min_train_rows: int = 4096,
+        retrain_growth: float = 4.0,
+        sample_per_cluster: int = 32,
+        exact_filter_share: float = 0.1,
+    ):
+        self.nlist = nlist
+        self.nprobe = nprobe
+        self.rerank = rerank
+        self.min_train_rows = min_train_rows
+        self.retrain_growth = retrain_growth
+        self.sample_per_cluster = sample_per_cluster
+        self.exact_filter_share = exact_filter_share  # filters keeping up to this share of the rows are searched exactly
+
+        # These are grown by _map together with the float matrix, so they have to exist before the store opens
+        self._codes: Optional[np.ndarray] = None
+        self._scales: Optional[np.ndarray] = None
+        self._assign: Optional[np.ndarray] = None
+        self._centroids: Optional[np.ndarray] = None
+        self._trained_rows = 0
+        self._lists = None  # (rows sorted by cluster, start of every cluster), rebuilt after writes
+        self._paths = dict.fromkeys(("codes", "scales", "assign", "centroids"))
+        if persist_directory:
+            base = os.path.join(persist_directory, collection_name)
+            self._paths = {"codes": f"{base}.i8", "scales": f"{base}.scale", "assign": f"{base}.ivf", "centroids": f"{base}.centroids.npy"}
+
+        super().__init__(embedding, persist_directory=persist_directory, collection_name=collection_name)
+
+        if self._paths["centroids"] and os.path.exists(self._paths["centroids"]):
+            self._centroids = np.load(self._paths["centroids"])
+            row = self._conn.execute("SELECT value FROM settings WHERE key = 'ivf_trained_rows'").fetchone()
+            self._trained_rows = int(row[0]) if row else len(self)
+
+    @property
+    def trained(self) -> bool:
+        return self._centroids is not None
+
+    # ---- storage ----
+
+    def _map(self, capacity: int) -> None:
+        super()._map(capacity)
+        self._codes = grow_array(self._codes, self._paths["codes"], capacity, self.dim, np.int8)
+        self._scales = grow_array(self._scales, self._paths["scales"], capacity, 1, np.float32)
+        self._assign = grow_array(self._assign, self._paths["assign"], capacity, 1, np.int32)
+
+    def _written(self, rows: np.ndarray, vectors: np.ndarray) -> None:
+        codes, scales = quantize(vectors)
+        self._codes[rows] = codes
+        self._scales[rows, 0] = scales
+        if self.trained:
+            self._assign[rows, 0] = nearest_centroid(vectors, self._centroids)
+        self._lists = None
+        for array in (self._codes, self._scales, self._assign):
+            if isinstance(array, np.memmap):
+                array.flush()
+
+        if not self.trained and len(self) >= self.min_train_rows:
+            self.train()
+        elif self.trained and len(self) > self._trained_rows * self.retrain_growth:
+            # The clusters were fit on a much smaller corpus, they are getting too big to be selective
+            self.train()
+
+    # ---- index ----
+
+    def train(self, iterations: int = 10) -> None:
+        """Fits the clusters on a sample of the live vectors and assigns every row to its cluster"""
+        with self._lock:
+            rows = np.flatnonzero(self._alive[: self._size])
+            if len(rows) == 0:
+                return
+            clusters = min(self.nlist or max(1, int(np.sqrt(len(rows)))), len(rows))
+            sample_size = min(len(rows), clusters * self.sample_per_cluster)
+            sample = np.sort(np.random.default_rng(0).choice(rows, sample_size, replace=False))
+            centroids = spherical_kmeans(np.asarray(self._vectors[sample]), clusters, iterations)
+
+            self._assign[: self._size, 0] = nearest_centroid(self._vectors[: self._size], centroids)
+            if isinstance(self._assign, np.memmap):
+                self._assign.flush()
+            self._centroids = centroids
+            self._trained_rows = len(rows)
+            self._lists = None
+            if self._paths["centroids"]:
+                np.save(self._paths["centroids"], centroids)
+            self._conn.execute("INSERT OR REPLACE INTO settings (key, value) VALUES ('ivf_trained_rows', ?)", (str(len(rows)),))
+            self._conn.commit()
+
+    def _inverted_lists(self) -> Tuple[np.ndarray, np.ndarray]:
+        if self._lists is None:
+            rows = np.flatnonzero(self._alive[: self._size])
+            labels = self._assign[rows, 0]
+            order = np.argsort(labels, kind="stable")
+            bounds = np.searchsorted(labels[order], np.arange(len(self._centroids) + 1))
+            self._lists = (rows[order], bounds)
+        return self._lists
+
+    # ---- search ----
+
+    def search_vectors(
+        self, queries, k: int = 4, nprobe: Optional[int] = None, rerank: Optional[int] = None, rows: Optional[np.ndarray] = None
+    ) -> List[List[Tuple[int, float]]]:
+        if not self.trained or (rows is not None and len(rows) <= self.exact_filter_share * len(self)):
+            return super().search_vectors(queries, k, rows=rows)
+        nprobe = nprobe or self.nprobe
+        rerank = self.rerank if rerank is None else rerank
+        queries = normalize_rows(queries)
+        with self._lock:
+            rows_by_cluster, bounds = self._inverted_lists()
+            centroids, codes, scales, vectors, alive = self._centroids, self._codes, self._scales, self._vectors, self._alive
+        if rows is not None:
+            allowed = np.zeros(len(alive), dtype=bool)
+            allowed[rows] = True
+            alive = alive & allowed
+
+        results = []
+        for query, clusters in zip(queries, top_k(queries @ centroids.T, nprobe)):
+            candidates = np.concatenate([rows_by_cluster[bounds[c]:bounds[c + 1]] for c in clusters])
+            candidates = candidates[alive[candidates]]  # rows deleted since the lists were built
+            if len(candidates) == 0:
+                results.append([])
+                continue
+
+            approx = (codes[candidates].astype(np.float32) @ query) * scales[candidates, 0]
+            shortlist = top_k(approx[None, :], k * rerank if rerank else k)[0]
+            if rerank:
+                shortlisted = candidates[shortlist]
+                exact = np.asarray(vectors[shortlisted]) @ query
+                best = top_k(exact[None, :], k)[0]
+                results.append([(int(shortlisted[i]), float(exact[i])) for i in best])
+            else:
+                results.append([(int(candidates[i]), float(approx[i])) for i in shortlist])
+        return results
+
+    def close(self) -> None:
+        with self._lock:
+            for array in (self._codes, self._scales, self._assign):
+                if isinstance(array, np.memmap):
+                    array.flush()
+        super().close()
@@ -0,0 +1,404 @@
+"""
+Offline benchmarks, nothing in here talks to OpenAI
+
+    python benchmarks.py ingest --pages 2000 --latency 0.2 --concurrency 1 4 16
+
+ingest => runs the streaming ingestion pipeline (rag_ingestion.py) over a synthetic corpus
+          with the fake HashEmbeddings backend and an upsert that only counts,
+          and reports chunks per second and peak memory for every concurrency level
+ann    => recall@k and latency of the IVF index (ann_index.py) for every nprobe,
+          against exact search over the same vectors (vector_index.py)
+
+    python benchmarks.py ann --rows 200000 --dim 256 --nprobe 1 4 16 64
+
+The graphs run with ScriptedChatModel (fake_models.py) in place of gpt-4o, so what is measured is the orchestration:
+LangGraph, the checkpointer, tool execution, retrieval and packing. --latency adds a simulated model round trip.
+
+react   => Agent-3's add / multiply chain, a growing conversation of --turns questions in one thread
+drafter => Agent-4, --edits patches of the document and a save, per user turn (--start-lines for a long draft),
+           the median turn of the first and the last 10% of a session shows whether turns get slower as it grows
+rag     => for every corpus size: ingestion into the numpy index + BM25 (chunks/s), the hybrid retriever
+           alone, the retriever with a metadata filter that keeps a tenth of the pages, and whole questions
+           through Agent-5's graph (two retriever_tool calls, then the answer), without and with speculative
+           retrieval (speculative_retrieval.py), --latency shows how much of the search it hides behind the model call
+all     => all three with their defaults, a quick check for regressions before a commit
+
+    python benchmarks.py react --turns 1 10 50
+    python benchmarks.py rag --pages 100 1000 --queries 200
+
+Latencies are measured first, peak memory (tracemalloc) in a second run of the same workload,
+tracemalloc would slow the first one down.
+"""
+
+import argparse
+import asyncio
+import contextlib
+import io
+import os
+import random
+import tempfile
+import time
+import tracemalloc
+import uuid
+from typing import Callable, Iterator, List, Tuple
+
+os.environ.setdefault("CHECKPOINT_URL", "memory")  # before the agents are loaded, they compile their graph with it
+os.environ.setdefault("OPENAI_API_KEY", "not-used")
+
+from langchain_core.documents import Document
+from langchain_core.messages import AIMessage, HumanMessage, ToolMessage
+
+import numpy as np
+
+from agent_loader import load_agent
+from fake_models import HashEmbeddings, ScriptedChatModel, tool_call
+from rag_ingestion import batch_by_tokens, embed_and_upsert, iter_chunks
+
+WORDS = (
+    "market stocks index returns nasdaq earnings revenue growth inflation rates federal reserve "
+    "technology semiconductor energy bonds yield dividend volatility quarter investors rally"
+).split()
+
+
+def synthetic_pages(count: int, words_per_page: int = 600, seed: int = 0) -> Iterator[Document]:
+    """Pages are generated lazily so the corpus itself never sits in memory"""
+    rng = random.Random(seed)
+    for page in range(count):
+        text = " ".join(rng.choice(WORDS) for _ in range(words_per_page))
+        yield Document(page_content=text, metadata={"page": page})
+
+
+def bench_ingest(args) -> None:
+    from langchain.text_splitter import RecursiveCharacterTextSplitter
+
+    splitter = RecursiveCharacterTextSplitter(chunk_size=1000, chunk_overlap=200, add_start_index=True)
+    print(f"{'concurrency':>11} {'chunks':>8} {'seconds':>8} {'chunks/s':>9} {'peak MB':>8}")
+
+    for concurrency in args.concurrency:
+        embeddings = HashEmbeddings(size=args.dim, latency=args.latency)
+        upserted = 0
+
+        def upsert(ids, texts, metadatas, vectors):
+            nonlocal upserted
+            upserted += len(ids)
+
+        chunks = iter_chunks(synthetic_pages(args.pages), splitter, "synthetic.pdf")
+        batches = batch_by_tokens(chunks, max_tokens=args.batch_tokens)
+
+        tracemalloc.start()
+        start = time.perf_counter()
+        asyncio.run(embed_and_upsert(batches, embeddings, upsert, concurrency=concurrency))
+        elapsed = time.perf_counter() - start
+        _, peak = tracemalloc.get_traced_memory()
+        tracemalloc.stop()
+
+        print(f"{concurrency:>11} {upserted:>8} {elapsed:>8.2f} {upserted / elapsed:>9.0f} {peak / 1e6:>8.1f}")
+
+
+def clustered_vectors(centers: np.ndarray, rows: int, rng, noise: float = 1.0) -> np.ndarray:
+    """
+    Embeddings of real text are clustered by topic (`centers`), uniform random vectors would make every index look bad.
+    With noise=1 the noise is as large as the centers, so many true neighbours sit in another cluster
+    """
+    picked = centers[rng.integers(0, len(centers), rows)]
+    return (picked + rng.normal(scale=noise, size=picked.shape)).astype(np.float32)
+
+
+def percentiles(seconds) -> str:
+    p50, p95 = np.percentile(np.asarray(seconds) * 1000, [50, 95])
+    return f"{p50:>8.3f} {p95:>8.3f}"
+
+
+def bench_ann(args) -> None:
+    from ann_index import IVFVectorStore
+    from vector_index import NumpyVectorStore
+
+    rng = np.random.default_rng(0)
+    centers = rng.normal(size=(args.clusters, args.dim))
+    vectors = clustered_vectors(centers, args.rows, rng)
+    queries = clustered_vectors(centers, args.queries, rng)  # new questions about the same topics
+    ids = [str(i) for i in range(args.rows)]
+    texts = [""] * args.rows
+    embeddings = HashEmbeddings(size=args.dim)
+
+    exact = NumpyVectorStore(embeddings)
+    ivf = IVFVectorStore(embeddings, nlist=args.nlist, min_train_rows=args.rows + 1)  # trained once below, not while loading
+    for start in range(0, args.rows, 10000):
+        exact.upsert_embeddings(ids[start:start + 10000], texts[start:start + 10000], None, vectors[start:start + 10000])
+        ivf.upsert_embeddings(ids[start:start + 10000], texts[start:start + 10000], None, vectors[start:start + 10000])
+    start = time.perf_counter()
+    ivf.train()
+    print(f"{args.rows} vectors of {args.dim} dims, {len(ivf._centroids)} clusters trained in {time.perf_counter() - start:.1f}s")
+    print(f"memory per vector: float32 {args.dim * 4} bytes, int8 codes {args.dim + 4} bytes\n")
+
+    def run(search):
+        found, seconds = [], []
+        for query in queries:
+            start = time.perf_counter()
+            found.append({row for row, _ in search(query)[0]})
+            seconds.append(time.perf_counter() - start)
+        return found, seconds
+
+    truth, seconds = run(lambda query: exact.search_vectors([query], args.k))
+    print(f"{'index':>16} {'recall@' + str(args.k):>10} {'p50 ms':>8} {'p95 ms':>8}")
+    print(f"{'exact':>16} {1.0:>10.3f} {percentiles(seconds)}")
+    for rerank in (0, args.rerank):
+        for nprobe in args.nprobe:
+            found, seconds = run(lambda query: ivf.search_vectors([query], args.k, nprobe=nprobe, rerank=rerank))
+            recall = np.mean([len(f & t) / args.k for f, t in zip(found, truth)])
+            print(f"{f'ivf p={nprobe} r={rerank}':>16} {recall:>10.3f} {percentiles(seconds)}")
+
+
+def measured(workload: Callable[[], List[float]]) -> Tuple[List[float], float]:
+    """Latencies of one run of the workload, and the peak MB of a second run under tracemalloc"""
+    seconds = workload()
+    tracemalloc.start()
+    workload()
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    return seconds, peak / 1e6
+
+
+def report(label, seconds: List[float], peak_mb: float, extra: str = "") -> None:
+    print(f"{label:>10} {len(seconds):>6} {len(seconds) / sum(seconds):>8.1f} {percentiles(seconds)} {peak_mb:>8.1f}{extra}")
+
+
+HEADER = f"{'runs':>6} {'per s':>8} {'p50 ms':>8} {'p95 ms':>8} {'peak MB':>8}"
+
+
+def quiet():
+    """The agents print every step, that would be most of what gets measured"""
+    return contextlib.redirect_stdout(io.StringIO())
+
+
+def react_script():
+    """What gpt-4o does for "add 40 + 12 and then multiply the result by 5": add, multiply with the sum, answer"""
+    return [
+        AIMessage(content="", tool_calls=[tool_call("add", a=40, b=12)]),
+        lambda messages: AIMessage(content="", tool_calls=[tool_call("multiply", a=int(messages[-1].content), b=5)]),
+        lambda messages: AIMessage(content=f"40 + 12 is 52, and 52 times 5 is {messages[-1].content}. Why don't scientists trust atoms? Because they make up everything!"),
+    ]
+
+
+def bench_react(args) -> None:
+    from langgraph.checkpoint.memory import MemorySaver
+
+    react = load_agent("Agent-3.py")
+    react.resources.set("model", ScriptedChatModel(script=react_script(), latency=args.latency).bind_tools(react.tools))
+    print(f"{'turns':>10} {HEADER}")
+
+    for turns in args.turns:
+        def workload():
+            app = react.build_app(checkpointer=MemorySaver())  # the history of the thread grows with every question
+            config = {"configurable": {"thread_id": str(uuid.uuid4())}}
+            seconds = []
+            for _ in range(turns):
+                start = time.perf_counter()
+                app.invoke({"messages": [("user", "add 40 + 12 and then multiply the result by 5 and then tell me a joke as well")]}, config)
+                seconds.append(time.perf_counter() - start)
+            return seconds
+
+        report(turns, *measured(workload))
+
+
+def drafter_script(messages):
+    """Saves when asked to, otherwise appends the request to the document as a new section"""
+    request = next(message.content for message in reversed(messages) if isinstance(message, HumanMessage))
+    if "save" in request:
+        return AIMessage(content="", tool_calls=[tool_call("save", filename="benchmark_draft")])
+    return AIMessage(content="Added it.", tool_calls=[tool_call("append", content=request)])
+
+
+def bench_drafter(args) -> None:
+    drafter = load_agent("Agent-4.py")
+    drafter.resources.set("model", ScriptedChatModel(script=[drafter_script], latency=args.latency).bind_tools(drafter.tools))
+    app = drafter.build_app()
+    # A long draft to start from shows that a turn costs the size of the edit, not the size of the document
+    existing = "\n\n".join(f"Paragraph {i}: " + " ".join(WORDS) for i in range(args.start_lines))
+    print(f"{'edits':>10} {HEADER} {'first 10%':>10} {'last 10%':>9}")
+
+    for edits in args.edits:
+        sessions = []
+
+        def workload():
+            seconds = []
+            for _ in range(args.sessions):
+                start = len(seconds)
+                requests = iter([f"add paragraph {i} about the quarterly results" for i in range(edits)] + ["now save it"])
+                last = [time.perf_counter()]
+
+                def user_turn(prompt=""):
+                    # our_agent asks input() for every turn, the time between two questions is one turn of the graph
+                    now = time.perf_counter()
+                    seconds.append(now - last[0])
+                    last[0] = now
+                    return next(requests)
+
+                drafter.input = user_turn  # shadows the builtin inside Agent-4
+                # Every session is its own thread, its draft starts from the long document
+                draft = {"text": existing, "version": 0}
+                config = {"configurable": {"thread_id": str(uuid.uuid4())}, "recursion_limit": 4 * edits + 10}
+                app.invoke({"messages": [], "saved": False, "draft": draft}, config)
+                drafter.documents.clear()
+                if not tracemalloc.is_tracing():  # the turns of the timed run, not the one measuring memory
+                    sessions.append(seconds[start:])
+            return seconds
+
+        with tempfile.TemporaryDirectory() as directory, quiet():
+            cwd = os.getcwd()
+            os.chdir(directory)  # the save tool writes the draft to the working directory
+            try:
+                result = measured(workload)
+            finally:
+                os.chdir(cwd)
+        # A turn late in a long session should cost what an early one does, the history must not be processed again every turn
+        tenth = max(1, (edits + 1) // 10)
+        first = np.median([turn for session in sessions for turn in session[:tenth]]) * 1000
+        last = np.median([turn for session in sessions for turn in session[-tenth:]]) * 1000
+        report(edits, *result, extra=f" {first:>10.3f} {last:>9.3f}")
+
+
+def rag_script():
+    """Two searches for every question, like gpt-4o does for most of them, then the answer"""
+    def search(messages):
+        question = messages[-1].content
+        return AIMessage(content="", tool_calls=[tool_call("retriever_tool", query=question), tool_call("retriever_tool", query=f"{question} returns")])
+
+    def answer(messages):
+        results = [message for message in messages if isinstance(message, ToolMessage)]
+        return AIMessage(content=f"Based on {len(results)} searches, the market rallied in 2024 (Document 1).")
+
+    return [search, answer]
+
+
+def bench_rag(args) -> None:
+    from hybrid_retrieval import BM25Index, HybridRetriever, overlap_reranker
+    from langchain.text_splitter import RecursiveCharacterTextSplitter
+    from speculative_retrieval import SpeculativeRetrieval
+    from vector_index import NumpyVectorStore
+
+    rag = load_agent("Agent-5.py")
+    splitter = RecursiveCharacterTextSplitter(chunk_size=1000, chunk_overlap=200, add_start_index=True)
+    rng = random.Random(1)
+    questions = [" ".join(rng.choice(WORDS) for _ in range(rng.randint(3, 6))) for _ in range(args.queries)]
+    print(f"{'pages':>6} {'path':>10} {HEADER}")
+
+    for pages in args.pages:
+        embeddings = HashEmbeddings(size=args.dim)
+        vectorstore = NumpyVectorStore(embeddings)
+        lexical_index = BM25Index()
+
+        def upsert(ids, texts, metadatas, vectors):
+            vectorstore.upsert_embeddings(ids, texts, metadatas, vectors)
+            lexical_index.upsert(ids, texts, metadatas)
+
+        tracemalloc.start()
+        start = time.perf_counter()
+        chunks = iter_chunks(synthetic_pages(pages), splitter, "synthetic.pdf")
+        asyncio.run(embed_and_upsert(batch_by_tokens(chunks, max_tokens=4000), embeddings, upsert, concurrency=4))
+        elapsed = time.perf_counter() - start
+        _, peak = tracemalloc.get_traced_memory()
+        tracemalloc.stop()
+        print(f"{pages:>6} {'ingest':>10} {len(vectorstore):>6} {len(vectorstore) / elapsed:>8.0f} {'':>8} {'':>8} {peak / 1e6:>8.1f}  (chunks)")
+
+        retriever = HybridRetriever(vectorstore=vectorstore, lexical_index=lexical_index, k=4, fetch_k=20, reranker=overlap_reranker(lexical_index))
+
+        def retrieval(**kwargs):
+            seconds = []
+            for question in questions:
+                start = time.perf_counter()
+                retriever.invoke(question, **kwargs)
+                seconds.append(time.perf_counter() - start)
+            return seconds
+
+        print(f"{pages:>6} ", end="")
+        report("retrieve", *measured(retrieval))
+        print(f"{pages:>6} ", end="")
+        report("filtered", *measured(lambda: retrieval(filter={"page": list(range(max(pages // 10, 1)))})))
+
+        rag.resources.set("retriever", retriever)
+        rag.resources.set("llm", ScriptedChatModel(script=rag_script(), latency=args.latency).bind_tools(rag.tools))
+        app = rag.build_rag_agent()
+
+        def questions_through_graph():
+            seconds = []
+            for question in questions:
+                start = time.perf_counter()
+                app.invoke({"messages": [HumanMessage(content=question)]})
+                seconds.append(time.perf_counter() - start)
+            return seconds
+
+        with quiet():
+            result = measured(questions_through_graph)
+        print(f"{pages:>6} ", end="")
+        report("graph", *result)
+
+        # The same questions with the search for every question started next to the first model call
+        rag.resources.set("speculative", SpeculativeRetrieval(retriever.invoke, weight=lexical_index.idf))
+        rag.speculative_retrieval = True
+        with quiet():
+            result = measured(questions_through_graph)
+        rag.speculative_retrieval = False
+        print(f"{pages:>6} ", end="")
+        report("prefetch", *result)
+
+        vectorstore.close()
+        lexical_index.close()
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description="Offline benchmarks for the agents")
+    subparsers = parser.add_subparsers(dest="command", required=True)
+
+    ingest = subparsers.add_parser("ingest", help="streaming ingestion pipeline")
+    ingest.add_argument("--pages", type=int, default=500)
+    ingest.add_argument("--dim", type=int, default=256)
+    ingest.add_argument("--latency", type=float, default=0.1, help="simulated seconds per embedding request")
+    ingest.add_argument("--batch-tokens", type=int, default=4000)
+    ingest.add_argument("--concurrency", type=int, nargs="+", default=[1, 4, 16])
+    ingest.set_defaults(func=bench_ingest)
+
+    ann = subparsers.add_parser("ann", help="recall@k vs latency of the IVF index")
+    ann.add_argument("--rows", type=int, default=100000)
+    ann.add_argument("--dim", type=int, default=256)
+    ann.add_argument("--clusters", type=int, default=500, help="topics in the synthetic corpus")
+    ann.add_argument("--queries", type=int, default=200)
+    ann.add_argument("--k", type=int, default=10)
+    ann.add_argument("--nlist", type=int, default=None, help="IVF clusters, sqrt(rows) by default")
+    ann.add_argument("--nprobe", type=int, nargs="+", default=[1, 4, 16, 64])
+    ann.add_argument("--rerank", type=int, default=4, help="shortlist of k * rerank rescored with float32")
+    ann.set_defaults(func=bench_ann)
+
+    react = subparsers.add_parser("react", help="Agent-3's tool calling loop with a scripted model")
+    react.add_argument("--turns", type=int, nargs="+", default=[1, 10, 50], help="questions asked in one thread")
+    react.add_argument("--latency", type=float, default=0.0, help="simulated seconds per model call")
+    react.set_defaults(func=bench_react)
+
+    drafter = subparsers.add_parser("drafter", help="Agent-4's drafting loop with a scripted model")
+    drafter.add_argument("--edits", type=int, nargs="+", default=[1, 5, 20], help="updates before the document is saved")
+    drafter.add_argument("--sessions", type=int, default=10)
+    drafter.add_argument("--start-lines", type=int, default=0, help="paragraphs already in the draft")
+    drafter.add_argument("--latency", type=float, default=0.0, help="simulated seconds per model call")
+    drafter.set_defaults(func=bench_drafter)
+
+    rag = subparsers.add_parser("rag", help="ingestion, hybrid retrieval and Agent-5's graph over a synthetic corpus")
+    rag.add_argument("--pages", type=int, nargs="+", default=[100, 1000], help="corpus sizes")
+    rag.add_argument("--dim", type=int, default=256)
+    rag.add_argument("--queries", type=int, default=100)
+    rag.add_argument("--latency", type=float, default=0.0, help="simulated seconds per model call")
+    rag.set_defaults(func=bench_rag)
+
+    subparsers.add_parser("all", help="react, drafter and rag with their defaults")
+
+    args = parser.parse_args()
+    if args.command == "all":
+        for command in ("react", "drafter", "rag"):
+            print(f"\n=== {command} ===")
+            defaults = subparsers.choices[command].parse_args([])
+            defaults.func(defaults)
+        return
+    args.func(args)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,143 @@
+"""
+Persistent, thread scoped state for the compiled graphs
+
+Without a checkpointer the state of a graph only lives in the Python variables of the `while` loop, so one process
+serves one user and everything is gone when it stops. With a checkpointer LangGraph saves the state of every run
+under the `thread_id` from the config, and a later run with the same thread_id picks it up again:
+
+    app = graph.compile(checkpointer=get_checkpointer())
+    app.invoke({"messages": [HumanMessage(content="hi")]}, session_config("bob"))
+    app.invoke({"messages": [HumanMessage(content="what did I just say?")]}, session_config("bob"))
+
+The backend is picked from a url (or the CHECKPOINT_URL environment variable), so it can be swapped without touching the agents:
+    sqlite:///checkpoints.sqlite3  => local SQLite file, the default
+    memory                         => in process only, handy for tests and benchmarks
+
+Writes are batched: session_config turns off checkpointing after every step, so a run writes its checkpoint once
+at the end instead of once per node. compact_checkpoints drops all but the newest checkpoints of every thread.
+"""
+
+import os
+import sqlite3
+from typing import Optional
+
+from langgraph.checkpoint.memory import MemorySaver
+from langgraph.constants import CONFIG_KEY_CHECKPOINT_DURING
+
+DEFAULT_CHECKPOINT_URL = "sqlite:///checkpoints.sqlite3"
+
+
+def checkpoint_url(url: Optional[str] = None) -> str:
+    return url or os.getenv("CHECKPOINT_URL", DEFAULT_CHECKPOINT_URL)
+
+
+def _sqlite_path(url: str) -> str:
+    if not url.startswith("sqlite:///"):
+        raise ValueError(f"Unsupported checkpoint url: {url} (use sqlite:///<path> or memory)")
+    return url[len("sqlite:///"):]
+
+
+def _connect(path: str) -> sqlite3.Connection:
+    conn = sqlite3.connect(path, check_same_thread=False)
+    conn.execute("PRAGMA journal_mode=WAL")
+    conn.execute("PRAGMA synchronous=NORMAL")  # WAL + NORMAL is durable against process crashes and much faster than FULL
+    return conn
+
+
+def get_checkpointer(url: Optional[str] = None):
+    """Checkpointer for graph.invoke / graph.stream"""
+    url = checkpoint_url(url)
+    if url == "memory":
+        return MemorySaver()
+
+    from langgraph.checkpoint.sqlite import SqliteSaver
+
+    return SqliteSaver(_connect(_sqlite_path(url)))
+
+
+async def aget_checkpointer(url: Optional[str] = None):
+    """Checkpointer for graph.ainvoke / graph.astream, the sync SqliteSaver doesn't implement the async methods"""
+    url = checkpoint_url(url)
+    if url == "memory":
+        return MemorySaver()
+
+    import aiosqlite
+    from langgraph.checkpoint.sqlite.aio import AsyncSqliteSaver
+
+    conn = await aiosqlite.connect(_sqlite_path(url))
+    await conn.execute("PRAGMA journal_mode=WAL")
+    await conn.execute("PRAGMA synchronous=NORMAL")
+    return AsyncSqliteSaver(conn)
+
+
+def session_config(thread_id: str, batch_writes: bool = True, **configurable) -> dict:
+    """
+    Config for one session. With batch_writes the graph only checkpoints when the run is over,
+    which means one write per question instead of one per node (a crash mid-run re-runs that question).
+    """
+    config = {"configurable": {"thread_id": thread_id, **configurable}}
+    if batch_writes:
+        config["configurable"][CONFIG_KEY_CHECKPOINT_DURING] = False
+    return config
+
+
+def list_threads(url: Optional[str] = None) -> list:
+    url = checkpoint_url(url)
+    if url == "memory":
+        return []
+    path = _sqlite_path(url)
+    if not os.path.exists(path):
+        return []
+    conn = _connect(path)
+    try:
+        return [row[0] for row in conn.execute("SELECT DISTINCT thread_id FROM checkpoints ORDER BY thread_id")]
+    except sqlite3.OperationalError:  # the saver hasn't created its tables yet
+        return []
+    finally:
+        conn.close()
+
+
+def compact_checkpoints(url: Optional[str] = None, keep_last: int = 3) -> int:
+    """
+    Deletes everything but the newest `keep_last` checkpoints of every thread (and their pending writes).
+    Resuming a thread only ever needs its latest checkpoint, the older ones are only there for time travel.
+    Checkpoint ids are time ordered, so the newest ones sort last.
+    """
+    url = checkpoint_url(url)
+    if url == "memory":
+        return 0
+    path = _sqlite_path(url)
+    if not os.path.exists(path):
+        return 0
+
+    conn = _connect(path)
+    try:
+        stale = conn.execute(
+            """
+            SELECT thread_id, checkpoint_ns, checkpoint_id FROM (
+                SELECT thread_id, checkpoint_ns, checkpoint_id,
+                       ROW_NUMBER() OVER (PARTITION BY thread_id, checkpoint_ns ORDER BY checkpoint_id DESC) AS position
+                FROM checkpoints
+            ) WHERE position > ?
+            """,
+            (keep_last,),
+        ).fetchall()
+        conn.executemany("DELETE FROM writes WHERE thread_id = ? AND checkpoint_ns = ? AND checkpoint_id = ?", stale)
+        conn.executemany("DELETE FROM checkpoints WHERE thread_id = ? AND checkpoint_ns = ? AND checkpoint_id = ?", stale)
+        conn.commit()
+        return len(stale)
+    except sqlite3.OperationalError:
+        return 0
+    finally:
+        conn.close()
+
+
+if __name__ == "__main__":
+    import argparse
+
+    parser = argparse.ArgumentParser(description="Maintenance of the checkpoint database")
+    parser.add_argument("--url", default=None)
+    parser.add_argument("--keep-last", type=int, default=3)
+    args = parser.parse_args()
+
+    print(f"{len(list_threads(args.url))} threads, {compact_checkpoints(args.url, args.keep_last)} old checkpoints removed")
@@ -0,0 +1,148 @@
+"""
+Routing queries to the right collections
+
+Agent-5 searched one pool of chunks for every query. With every kind of report ingested as its own collection
+(python rag_ingestion.py --dir reports/earnings --collection earnings), most collections have nothing to say about
+a given query, and searching them anyway costs time and fills the top k with near misses.
+
+CollectionRouter picks the collections a query goes to before any vector is scored, only with what the BM25 index
+of every collection already has:
+
+    - facets => the sources and years of a collection (read from the metadata indexes), a filter on source or year
+                skips the collections that can't match without searching them
+    - terms  => for every query term, how many chunks of a collection contain it (one lookup in the postings index),
+                weighted by how rare the term is over all the collections: "Nvidia" or "2023" decide, "performance"
+                hardly counts
+    - the best collection is always searched, the next ones only if they score at least `min_share` of the best,
+      and never more than `max_collections`. A query none of whose terms is known anywhere goes to every collection
+
+RoutedRetriever runs the query (and its filter) on the chosen collections at the same time and fuses the rankings:
+
+    router = CollectionRouter({"stock_market": stock_market_bm25, "earnings": earnings_bm25})
+    retriever = RoutedRetriever(retrievers={"stock_market": stock_market_hybrid, "earnings": earnings_hybrid}, router=router)
+    retriever.invoke("Nvidia revenue", filter={"year": 2024})
+"""
+
+import math
+import os
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from dataclasses import dataclass, field
+from typing import Any, Dict, List, Optional, Sequence
+
+from langchain_core.callbacks import CallbackManagerForRetrieverRun
+from langchain_core.documents import Document
+from langchain_core.retrievers import BaseRetriever
+
+from hybrid_retrieval import reciprocal_rank_fusion, tokenize
+from instrumentation import metrics
+from rag_ingestion import MANIFEST_SUFFIX
+
+FACET_FIELDS = ("source", "year")  # few distinct values per collection, cheap to keep in memory
+
+
+def collection_names(persist_directory: str) -> List[str]:
+    """The collections ingested into a directory, every one has its manifest there"""
+    if not os.path.isdir(persist_directory):
+        return []
+    return sorted(name[: -len(MANIFEST_SUFFIX)] for name in os.listdir(persist_directory) if name.endswith(MANIFEST_SUFFIX))
+
+
+def search_filter(source: Optional[str] = None, year: Optional[int] = None, section: Optional[str] = None, page: Optional[int] = None) -> Optional[dict]:
+    """The metadata filter for the arguments the model gave, pages are numbered from 1 for the model and from 0 in the index"""
+    filter = {"source": source, "year": year, "section": section, "page": page - 1 if page else None}
+    filter = {key: value for key, value in filter.items() if value is not None}
+    return filter or None
+
+
+@dataclass
+class CollectionProfile:
+    chunks: int
+    facets: Dict[str, set] = field(default_factory=dict)
+
+
+class CollectionRouter:
+    def __init__(self, lexical_indexes: Dict[str, Any], max_collections: int = 2, min_share: float = 0.5):
+        self.lexical_indexes = dict(lexical_indexes)  # collection => hybrid_retrieval.BM25Index
+        self.max_collections = max_collections
+        self.min_share = min_share
+        self._lock = threading.Lock()
+        self._profiles: Dict[str, CollectionProfile] = {}
+
+    def profile(self, name: str) -> CollectionProfile:
+        index = self.lexical_indexes[name]
+        with self._lock:
+            profile = self._profiles.get(name)
+            if profile is None or profile.chunks != len(index):  # built the first time, again once the collection changed
+                profile = self._profiles[name] = CollectionProfile(len(index), {facet: index.facets(facet) for facet in FACET_FIELDS})
+        return profile
+
+    def can_match(self, name: str, filter: Optional[dict]) -> bool:
+        facets = self.profile(name).facets
+        for key, value in (filter or {}).items():
+            if key in facets:
+                values = set(value) if isinstance(value, (list, tuple, set)) else {value}
+                if not values & facets[key]:
+                    return False
+        return True
+
+    def scores(self, query: str, names: Sequence[str]) -> Dict[str, float]:
+        terms = list(dict.fromkeys(tokenize(query)))
+        frequencies = {name: self.lexical_indexes[name].document_frequencies(terms) for name in names}
+        sizes = {name: max(len(self.lexical_indexes[name]), 1) for name in names}
+        total = sum(sizes.values())
+
+        scores = dict.fromkeys(names, 0.0)
+        for term in terms:
+            df = sum(frequencies[name][term] for name in names)
+            if not df:
+                continue
+            idf = math.log(1 + (total - df + 0.5) / (df + 0.5))
+            for name in names:
+                # Saturates once about 1% of the collection's chunks have the term, so a big collection doesn't win by its size
+                found = frequencies[name][term]
+                scores[name] += idf * found / (found + max(1.0, 0.01 * sizes[name]))
+        return scores
+
+    def route(self, query: str, filter: Optional[dict] = None) -> List[str]:
+        """The collections to search for this query, best first"""
+        names = [name for name in self.lexical_indexes if self.can_match(name, filter)]
+        if len(names) > 1:
+            scores = self.scores(query, names)
+            names.sort(key=lambda name: -scores[name])
+            best = scores[names[0]]
+            if best > 0:
+                names = [name for name in names[: self.max_collections] if scores[name] >= self.min_share * best]
+
+        metrics.inc("agent_routed_queries_total")
+        for name in names:
+            metrics.inc("agent_collection_searches_total", collection=name)
+        return names
+
+
+class RoutedRetriever(BaseRetriever):
+    retrievers: Dict[str, Any]  # collection => retriever of that collection (hybrid_retrieval.HybridRetriever)
+    router: Any
+    k: int = 4
+    rrf_k: int = 60
+
+    def _search(self, name: str, query: str, filter: Optional[dict]) -> List[Document]:
+        documents = self.retrievers[name].invoke(query, filter=filter) if filter else self.retrievers[name].invoke(query)
+        for document in documents:
+            document.metadata["collection"] = name
+        return documents
+
+    def _get_relevant_documents(
+        self, query: str, *, run_manager: CallbackManagerForRetrieverRun, filter: Optional[dict] = None
+    ) -> List[Document]:
+        names = self.router.route(query, filter)
+        if len(names) <= 1:
+            return self._search(names[0], query, filter)[: self.k] if names else []
+
+        with ThreadPoolExecutor(max_workers=len(names)) as executor:
+            results = list(executor.map(lambda name: self._search(name, query, filter), names))
+
+        # The same chunk id can exist in two collections (the same PDF ingested twice), so the collection is part of the key
+        found = {f"{document.metadata['collection']}/{document.id}": document for documents in results for document in documents}
+        rankings = [[f"{document.metadata['collection']}/{document.id}" for document in documents] for documents in results]
+        return [found[key] for key, _ in reciprocal_rank_fusion(rankings, self.rrf_k)[: self.k]]
@@ -0,0 +1,150 @@
+"""
+Context packing for the retrieved chunks
+
+retriever_tool used to paste every chunk it found into its ToolMessage, so one turn could send the model:
+    - the same text twice, because neighbouring chunks of a page overlap by chunk_overlap (200) characters
+    - the same chunk several times, when two queries of the turn (or an earlier question) found it already
+    - more chunks than the answer needs, every one of them paid for on every later call of the conversation
+
+ContextPacker sits between the tool and the state (Agent-5's take_action):
+
+    - overlapping or touching chunks of the same page are merged into one passage
+    - chunks that an earlier ToolMessage of the conversation already contains are dropped,
+      every packed ToolMessage keeps the ids of its chunks in `artifact` for exactly this
+    - what is left is packed best first, taking the best chunk of every query before the second best of any,
+      until `max_tokens` for the whole turn is used
+
+The tool returns its documents as the artifact (response_format="content_and_artifact"), the packer rewrites the
+content and replaces the documents by their ids, so the checkpoints don't store every chunk twice.
+"""
+
+from typing import Dict, Iterable, List, Sequence, Set, Tuple
+
+from langchain_core.documents import Document
+from langchain_core.messages import BaseMessage, ToolMessage
+
+from conversation_memory import count_text_tokens
+
+ALREADY_RETRIEVED = "Everything this search found was already retrieved earlier in this conversation, see the previous tool results."
+OVER_BUDGET = "The other searches of this turn already filled the context budget, ask a narrower query to get different passages."
+
+
+def chunk_ids(document: Document) -> List[str]:
+    """The ids a (possibly merged) document covers"""
+    return document.metadata.get("chunk_ids") or [document.id or document.metadata.get("chunk_id")]
+
+
+def _join(documents: Sequence[Document]) -> Document:
+    """One passage out of chunks of the same page sorted by start_index, each overlapping or touching the ones before"""
+    first = documents[0]
+    text = first.page_content
+    end = first.metadata["start_index"] + len(text)
+    for document in documents[1:]:
+        start = document.metadata["start_index"]
+        text += document.page_content[end - start:]
+        end = max(end, start + len(document.page_content))
+    return Document(id=first.id, page_content=text, metadata={**first.metadata, "chunk_ids": [i for d in documents for i in chunk_ids(d)]})
+
+
+def merge_overlapping(documents: Sequence[Document]) -> List[Document]:
+    """
+    Joins chunks of the same page whose text overlaps or touches (by start_index), keeping best-first order:
+    a merged passage takes the place of its best chunk
+    """
+    pages: Dict[tuple, List[int]] = {}
+    for position, document in enumerate(documents):
+        if document.metadata.get("start_index") is None:
+            pages[("unknown", position)] = [position]
+        else:
+            pages.setdefault((document.metadata.get("source"), document.metadata.get("page")), []).append(position)
+
+    passages = []  # (position of the best chunk, passage)
+    for positions in pages.values():
+        positions.sort(key=lambda position: documents[position].metadata.get("start_index", 0))
+        runs = [[positions[0]]]
+        end = documents[positions[0]].metadata.get("start_index", 0) + len(documents[positions[0]].page_content)
+        for position in positions[1:]:
+            start = documents[position].metadata["start_index"]
+            if start > end:
+                runs.append([])  # a gap between the two chunks, a new passage starts
+                end = start
+            runs[-1].append(position)
+            end = max(end, start + len(documents[position].page_content))
+        for run in runs:
+            passage = documents[run[0]] if len(run) == 1 else _join([documents[position] for position in run])
+            passages.append((min(run), passage))
+
+    return [passage for _, passage in sorted(passages, key=lambda item: item[0])]
+
+
+def seen_chunk_ids(messages: Iterable[BaseMessage]) -> Set[str]:
+    seen = set()
+    for message in messages:
+        if isinstance(message, ToolMessage) and isinstance(message.artifact, dict):
+            seen.update(message.artifact.get("chunk_ids", []))
+    return seen
+
+
+def cite(document: Document) -> str:
+    """Where a passage comes from, the model can cite it and narrow a search to it (retriever_tool's filters)"""
+    metadata = document.metadata
+    parts = [metadata["source"]] if metadata.get("source") else []
+    if isinstance(metadata.get("page"), int):
+        parts.append(f"page {metadata['page'] + 1}")
+    if metadata.get("section"):
+        parts.append(f'section "{metadata["section"]}"')
+    return f" ({', '.join(parts)})" if parts else ""
+
+
+def format_documents(documents: Sequence[Document]) -> str:
+    return "\n\n".join(f"Document {i + 1}{cite(document)}:\n{document.page_content}" for i, document in enumerate(documents))
+
+
+class ContextPacker:
+    def __init__(self, max_tokens: int = 2000, model: str = "gpt-4o"):
+        self.max_tokens = max_tokens
+        self.model = model
+
+    def pack(self, results: Sequence[Sequence[Document]], seen: Set[str]) -> List[List[Document]]:
+        """The documents every query keeps, `results` holds the documents of every query best first"""
+        seen = set(seen)
+        candidates = []
+        for query, documents in enumerate(results):
+            fresh = [document for document in documents if not set(chunk_ids(document)) & seen]
+            for rank, document in enumerate(merge_overlapping(fresh)):
+                candidates.append((rank, query, document))
+
+        kept: List[List[Document]] = [[] for _ in results]
+        used = 0
+        # Rank first: the best chunk of every query before the second best of any query
+        for rank, query, document in sorted(candidates, key=lambda candidate: (candidate[0], candidate[1])):
+            ids = set(chunk_ids(document))
+            if ids & seen:
+                continue  # another query of this turn already has it
+            cost = count_text_tokens(document.page_content, self.model)
+            if used + cost > self.max_tokens:
+                continue  # a shorter chunk further down may still fit
+            kept[query].append(document)
+            seen |= ids
+            used += cost
+        return kept
+
+    def pack_messages(self, tool_messages: Sequence[ToolMessage], history: Sequence[BaseMessage]) -> List[ToolMessage]:
+        """Rewrites the ToolMessages of one turn whose artifact is a list of documents"""
+        positions = [i for i, message in enumerate(tool_messages) if isinstance(message.artifact, list) and message.status != "error"]
+        seen = seen_chunk_ids(history)
+        packed = self.pack([tool_messages[i].artifact for i in positions], seen)
+
+        messages = list(tool_messages)
+        for i, documents in zip(positions, packed):
+            if documents:
+                content = format_documents(documents)
+            elif not tool_messages[i].artifact:
+                content = tool_messages[i].content  # the tool's own "nothing found"
+            elif all(set(chunk_ids(document)) & seen for document in tool_messages[i].artifact):
+                content = ALREADY_RETRIEVED
+            else:
+                content = OVER_BUDGET
+            ids = [chunk_id for document in documents for chunk_id in chunk_ids(document)]
+            messages[i] = tool_messages[i].model_copy(update={"content": content, "artifact": {"chunk_ids": ids}})
+        return messages
@@ -0,0 +1,111 @@
+"""
+Bounded conversation memory
+
+Sending the whole conversation to the model on every turn means the prompt, the latency and the cost
+all keep growing with the length of the chat. ConversationMemory keeps it flat:
+
+    - the last turns are kept word for word, as many as fit in `max_tokens` (and at most `max_turns`)
+    - everything older is folded into one running summary
+    - the summary is updated incrementally: only the turns that just fell out of the window are sent
+      to the model together with the old summary, never the whole history
+
+A turn is one HumanMessage plus everything that answers it.
+"""
+
+from functools import lru_cache
+from typing import List, Sequence, Tuple
+
+from langchain_core.messages import BaseMessage, HumanMessage, SystemMessage
+
+
+@lru_cache(maxsize=None)
+def _encoding(model: str):
+    try:
+        import tiktoken
+
+        return tiktoken.encoding_for_model(model)
+    except Exception:
+        # tiktoken is missing, or can't download its tables while offline
+        return None
+
+
+def count_text_tokens(text: str, model: str = "gpt-4o") -> int:
+    encoding = _encoding(model)
+    return len(encoding.encode(text)) if encoding else len(text) // 4 + 1
+
+
+def count_tokens(messages: Sequence[BaseMessage], model: str = "gpt-4o") -> int:
+    total = 0
+    for message in messages:
+        text = message.content if isinstance(message.content, str) else str(message.content)
+        # every message has a few tokens of overhead for its role
+        total += 4 + count_text_tokens(text, model)
+    return total
+
+
+def split_turns(messages: Sequence[BaseMessage]) -> List[List[BaseMessage]]:
+    turns: List[List[BaseMessage]] = []
+    for message in messages:
+        if isinstance(message, HumanMessage) or not turns:
+            turns.append([message])
+        else:
+            turns[-1].append(message)
+    return turns
+
+
+SUMMARY_PROMPT = """You keep a running summary of a conversation between a user and an AI assistant.
+Extend the current summary with the new lines of the conversation. Keep every fact about the user (names, preferences, decisions)
+and keep it short. Reply with the new summary only.
+
+Current summary:
+{summary}
+
+New lines:
+{lines}
+"""
+
+
+class ConversationMemory:
+    def __init__(self, llm, max_tokens: int = 2000, max_turns: int = 10, model: str = "gpt-4o"):
+        self.llm = llm
+        self.max_tokens = max_tokens
+        self.max_turns = max_turns
+        self.model = model
+
+    def window(self, messages: Sequence[BaseMessage]) -> Tuple[List[BaseMessage], List[BaseMessage]]:
+        """Splits the messages into (older messages to fold, recent messages to keep)"""
+        turns = split_turns(messages)
+        kept: List[List[BaseMessage]] = []
+        used = 0
+        for turn in reversed(turns):
+            cost = count_tokens(turn, self.model)
+            # The newest turn is always kept, even if it alone is over the budget
+            if kept and (used + cost > self.max_tokens or len(kept) >= self.max_turns):
+                break
+            kept.append(turn)
+            used += cost
+
+        keep_from = len(turns) - len(kept)
+        folded = [message for turn in turns[:keep_from] for message in turn]
+        recent = [message for turn in turns[keep_from:] for message in turn]
+        return folded, recent
+
+    def summarize(self, summary: str, folded: Sequence[BaseMessage]) -> str:
+        lines = "\n".join(
+            f"{'User' if isinstance(message, HumanMessage) else 'AI'}: {message.content}" for message in folded
+        )
+        response = self.llm.invoke(SUMMARY_PROMPT.format(summary=summary or "(empty)", lines=lines))
+        return response.content.strip()
+
+    def update(self, messages: Sequence[BaseMessage], summary: str = "") -> Tuple[List[BaseMessage], str]:
+        """Returns the messages to keep and the summary that covers everything that was dropped"""
+        folded, recent = self.window(messages)
+        if folded:
+            summary = self.summarize(summary, folded)
+        return recent, summary
+
+    @staticmethod
+    def summary_message(summary: str) -> List[SystemMessage]:
+        if not summary:
+            return []
+        return [SystemMessage(content=f"Summary of the earlier conversation: {summary}")]
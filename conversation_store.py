@@ -0,0 +1,123 @@
+"""
+Append-only conversation store for the chat agents
+
+Agent-2 used to read the whole logging.txt at start and rewrite it on exit, so a crash lost the whole
+session and replies spanning several lines were cut to their first line. ConversationStore keeps the
+messages in SQLite (WAL mode) instead:
+
+    - every message is written (and committed) the moment it happens, a crash loses at most that one message
+    - many conversations live in the same file, each with its own conversation_id
+    - the (conversation_id, id) index lets a session load only the tail it needs for the active window,
+      so starting up costs O(window) and not O(everything ever said)
+    - the running summary of the memory window is stored too, with the id of the first message it doesn't cover
+    - an imported history (logging.txt) is recorded in the migrations table, so it is imported once and the file stays where it is
+
+    store = ConversationStore("conversations.sqlite3")
+    store.append("bob", HumanMessage(content="hi"))
+    messages, summary = store.load_window("bob")
+"""
+
+import sqlite3
+import time
+from typing import List, Optional, Tuple
+
+from langchain_core.messages import AIMessage, BaseMessage, HumanMessage, SystemMessage
+
+ROLES = {"human": HumanMessage, "ai": AIMessage, "system": SystemMessage}
+
+
+class ConversationStore:
+    def __init__(self, path: str = "conversations.sqlite3"):
+        self.conn = sqlite3.connect(path, check_same_thread=False)
+        self.conn.execute("PRAGMA journal_mode=WAL")
+        self.conn.execute("PRAGMA synchronous=NORMAL")
+        self.conn.executescript(
+            """
+            CREATE TABLE IF NOT EXISTS messages (
+                id INTEGER PRIMARY KEY AUTOINCREMENT,
+                conversation_id TEXT NOT NULL,
+                role TEXT NOT NULL,
+                content TEXT NOT NULL,
+                created_at REAL NOT NULL
+            );
+            CREATE INDEX IF NOT EXISTS messages_by_conversation ON messages(conversation_id, id);
+
+            CREATE TABLE IF NOT EXISTS summaries (
+                conversation_id TEXT PRIMARY KEY,
+                summary TEXT NOT NULL,
+                window_start INTEGER NOT NULL
+            );
+
+            CREATE TABLE IF NOT EXISTS migrations (
+                source TEXT PRIMARY KEY,
+                conversation_id TEXT NOT NULL,
+                imported_at REAL NOT NULL
+            );
+            """
+        )
+        self.conn.commit()
+
+    def append(self, conversation_id: str, message: BaseMessage) -> int:
+        """Writes one message right away, the id of the row is also set as the id of the message"""
+        cursor = self.conn.execute(
+            "INSERT INTO messages (conversation_id, role, content, created_at) VALUES (?, ?, ?, ?)",
+            (conversation_id, message.type, message.content if isinstance(message.content, str) else str(message.content), time.time()),
+        )
+        self.conn.commit()
+        message.id = str(cursor.lastrowid)
+        return cursor.lastrowid
+
+    def count(self, conversation_id: str) -> int:
+        return self.conn.execute("SELECT COUNT(*) FROM messages WHERE conversation_id = ?", (conversation_id,)).fetchone()[0]
+
+    def tail(self, conversation_id: str, limit: int, since_id: int = 0) -> List[BaseMessage]:
+        """The last `limit` messages of a conversation (with id >= since_id), oldest first"""
+        rows = self.conn.execute(
+            "SELECT id, role, content FROM messages WHERE conversation_id = ? AND id >= ? ORDER BY id DESC LIMIT ?",
+            (conversation_id, since_id, limit),
+        ).fetchall()
+        return [ROLES.get(role, HumanMessage)(content=content, id=str(row_id)) for row_id, role, content in reversed(rows)]
+
+    def save_summary(self, conversation_id: str, summary: str, window_start: int) -> None:
+        """`summary` covers every message before `window_start`, the ones from there on are kept word for word"""
+        self.conn.execute(
+            "INSERT OR REPLACE INTO summaries (conversation_id, summary, window_start) VALUES (?, ?, ?)",
+            (conversation_id, summary, window_start),
+        )
+        self.conn.commit()
+
+    def load_window(self, conversation_id: str, limit: int = 200) -> Tuple[List[BaseMessage], str]:
+        """The summary plus the messages it doesn't cover, which is all a new session needs"""
+        row = self.conn.execute(
+            "SELECT summary, window_start FROM summaries WHERE conversation_id = ?", (conversation_id,)
+        ).fetchone()
+        summary, window_start = row if row else ("", 0)
+        return self.tail(conversation_id, limit, since_id=window_start), summary
+
+    def conversations(self) -> List[Tuple[str, int]]:
+        return self.conn.execute(
+            "SELECT conversation_id, COUNT(*) FROM messages GROUP BY conversation_id ORDER BY MAX(id) DESC"
+        ).fetchall()
+
+    def imported(self, source: str) -> bool:
+        return self.conn.execute("SELECT 1 FROM migrations WHERE source = ?", (source,)).fetchone() is not None
+
+    def import_messages(self, conversation_id: str, messages: List[BaseMessage], source: Optional[str] = None) -> None:
+        """
+        One time migration of an old history (e.g. logging.txt) into the store.
+        With a source the import is recorded in the same transaction, see imported()
+        """
+        now = time.time()
+        with self.conn:
+            self.conn.executemany(
+                "INSERT INTO messages (conversation_id, role, content, created_at) VALUES (?, ?, ?, ?)",
+                [(conversation_id, message.type, message.content, now) for message in messages],
+            )
+            if source is not None:
+                self.conn.execute(
+                    "INSERT OR REPLACE INTO migrations (source, conversation_id, imported_at) VALUES (?, ?, ?)",
+                    (source, conversation_id, now),
+                )
+
+    def close(self) -> None:
+        self.conn.close()
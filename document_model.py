@@ -0,0 +1,207 @@
+"""
+Versioned document for the Drafter (Agent-4)
+
+The drafter used to keep the draft in one string: gpt-4o had to write the whole document again for every edit
+(update(content)), the whole document was pasted into the system prompt of every turn, and the tool echoed it
+once more into the message history. Three copies of the draft per edit, so a long draft got slow and expensive.
+
+DraftDocument keeps the draft as a list of lines and changes it with patches:
+
+    - replace_lines / insert_lines / append / replace_section => only the changed lines travel, the work is a
+      list splice, so an edit costs the size of the change and not the size of the document
+    - every edit is kept with the lines it removed, so there is a version number and undo()
+    - sections are the blocks between blank lines (a markdown heading or "Subject:" starts a new one too)
+    - prompt_view() is what the model sees: a short draft in full, a long one as an outline (one line per section)
+      plus the sections under edit, meaning the ones the last edits touched or the model asked for (show_sections)
+
+Lines and sections are numbered from 1 for the model:
+
+    document = DraftDocument("Subject: Meeting\n\nHi Bob,\nI can't make it.")
+    document.replace_lines(4, 4, "I can't make it at 10 AM.")
+    document.undo()
+"""
+
+import re
+from dataclasses import dataclass
+from typing import Iterable, List, Optional, Tuple
+
+HEADING = re.compile(r"^(#{1,6}\s|Subject:)")
+
+
+@dataclass(frozen=True)
+class Edit:
+    version: int  # the version this edit produced
+    start: int  # first line replaced, 0 based
+    removed: Tuple[str, ...]
+    inserted: Tuple[str, ...]
+
+
+def _lines_of(content: str) -> List[str]:
+    return content.splitlines()
+
+
+class DraftDocument:
+    def __init__(self, text: str = "", working_set: int = 3, full_text_chars: int = 2000):
+        self.lines: List[str] = _lines_of(text)
+        self.version = 0
+        self.history: List[Edit] = []
+        self.working_set = working_set  # how many recently edited places count as "under edit"
+        self.full_text_chars = full_text_chars  # drafts up to this size are shown in full, an outline costs about as much
+        self._anchors: List[int] = []  # lines of the places under edit, most recent last, kept in line with the edits
+        self._sections: Optional[List[Tuple[int, int]]] = None  # cached for the current version
+
+    @property
+    def text(self) -> str:
+        return "\n".join(self.lines)
+
+    def __len__(self) -> int:
+        return len(self.lines)
+
+    # ---- sections ----
+
+    def sections(self) -> List[Tuple[int, int]]:
+        """(first, last) line of every section, 0 based and inclusive"""
+        if self._sections is None:
+            sections = []
+            start = None
+            for i, line in enumerate(self.lines):
+                if not line.strip():
+                    if start is not None:
+                        sections.append((start, i - 1))
+                        start = None
+                    continue
+                if start is not None and HEADING.match(line):
+                    sections.append((start, i - 1))
+                    start = None
+                if start is None:
+                    start = i
+            if start is not None:
+                sections.append((start, len(self.lines) - 1))
+            self._sections = sections
+        return self._sections
+
+    def section_lines(self, section: int) -> Tuple[int, int]:
+        sections = self.sections()
+        if not 1 <= section <= len(sections):
+            raise ValueError(f"There is no section {section}, the document has {len(sections)} sections")
+        return sections[section - 1]
+
+    def _section_at(self, line: int) -> Optional[int]:
+        for number, (first, last) in enumerate(self.sections(), start=1):
+            if line <= last:
+                return number if line >= first else None
+        return None
+
+    # ---- what the model sees ----
+
+    def render(self, first: int, last: int) -> str:
+        """Lines first..last (0 based) with their 1 based numbers, so the model can address them"""
+        return "\n".join(f"{i + 1:>4}| {self.lines[i]}" for i in range(first, min(last, len(self.lines) - 1) + 1))
+
+    def outline(self, preview: int = 60) -> str:
+        entries = []
+        for number, (first, last) in enumerate(self.sections(), start=1):
+            head = self.lines[first].strip()
+            head = head if len(head) <= preview else head[:preview] + "..."
+            entries.append(f"Section {number} (lines {first + 1}-{last + 1}): {head}")
+        return "\n".join(entries)
+
+    def sections_under_edit(self) -> List[int]:
+        found = []
+        for line in reversed(self._anchors):
+            section = self._section_at(line)
+            if section is not None and section not in found:
+                found.append(section)
+        return sorted(found)
+
+    def show(self, sections: Iterable[int]) -> str:
+        """The text of some sections, they count as under edit from now on"""
+        parts = []
+        for section in sections:
+            first, last = self.section_lines(section)
+            self._focus(first)
+            parts.append(f"Section {section}:\n{self.render(first, last)}")
+        return "\n\n".join(parts)
+
+    def prompt_view(self) -> str:
+        if not self.lines:
+            return "The document is empty."
+        if len(self.text) <= self.full_text_chars:
+            return self.render(0, len(self.lines) - 1)
+
+        view = f"Outline ({len(self.lines)} lines, version {self.version}):\n{self.outline()}"
+        editing = self.sections_under_edit()
+        if editing:
+            text = "\n\n".join(f"Section {section}:\n{self.render(*self.section_lines(section))}" for section in editing)
+            view += f"\n\nSections under edit:\n{text}"
+        return view
+
+    # ---- edits ----
+
+    def _focus(self, line: int) -> None:
+        if line in self._anchors:
+            self._anchors.remove(line)
+        self._anchors.append(line)
+        del self._anchors[:-self.working_set]
+
+    def _splice(self, start: int, end: int, inserted: List[str]) -> Edit:
+        """Replaces lines start..end-1 (0 based) with `inserted`, every edit goes through here"""
+        removed = self.lines[start:end]
+        self.lines[start:end] = inserted
+        self.version += 1
+        edit = Edit(self.version, start, tuple(removed), tuple(inserted))
+        self.history.append(edit)
+        self._sections = None
+
+        shift = len(inserted) - len(removed)
+        self._anchors = [line + shift if line >= end else min(line, start) for line in self._anchors]
+        offset = next((i for i, line in enumerate(inserted) if line.strip()), 0)  # append starts with a blank line
+        self._focus(min(start + offset, max(len(self.lines) - 1, 0)))
+        return edit
+
+    def _check_line(self, line: int) -> None:
+        if not 1 <= line <= len(self.lines):
+            raise ValueError(f"Line {line} is out of range, the document has {len(self.lines)} lines")
+
+    def replace_lines(self, first: int, last: int, content: str) -> Edit:
+        """Lines first..last (1 based, inclusive) become `content`, an empty content deletes them"""
+        self._check_line(first)
+        self._check_line(last)
+        if last < first:
+            raise ValueError(f"last_line ({last}) comes before first_line ({first})")
+        return self._splice(first - 1, last, _lines_of(content))
+
+    def insert_lines(self, after: int, content: str) -> Edit:
+        """`content` goes after line `after` (1 based), after=0 puts it at the top"""
+        if after != 0:
+            self._check_line(after)
+        return self._splice(after, after, _lines_of(content))
+
+    def append(self, content: str) -> Edit:
+        # A blank line in between, so the new text becomes its own section
+        separator = [""] if self.lines and self.lines[-1].strip() else []
+        return self._splice(len(self.lines), len(self.lines), separator + _lines_of(content))
+
+    def replace_section(self, section: int, content: str) -> Edit:
+        first, last = self.section_lines(section)
+        return self._splice(first, last + 1, _lines_of(content))
+
+    def set_text(self, content: str) -> Edit:
+        return self._splice(0, len(self.lines), _lines_of(content))
+
+    def undo(self) -> Optional[Edit]:
+        """Reverts the last edit, the version number still goes up so the version always names one state"""
+        if not self.history:
+            return None
+        last = self.history.pop()
+        edit = self._splice(last.start, last.start + len(last.inserted), list(last.removed))
+        self.history.pop()  # the revert itself isn't something to undo
+        return edit
+
+    def describe(self, edit: Edit) -> str:
+        """The short confirmation the tools send back instead of the document"""
+        if edit.inserted:
+            where = f"lines {edit.start + 1}-{edit.start + len(edit.inserted)} now hold the new text"
+        else:
+            where = f"{len(edit.removed)} lines removed at line {edit.start + 1}"
+        return f"Version {edit.version}: {where}. The document has {len(self.lines)} lines in {len(self.sections())} sections."
@@ -0,0 +1,244 @@
+"""
+Persistent embedding cache
+
+Every embedding call to OpenAI costs time and money, and Agent-5 keeps embedding the same text:
+the same chunks when the index is rebuilt and the same questions over and over from the agent loop.
+
+CachedEmbeddings wraps any LangChain Embeddings object and remembers the vectors it got back.
+    - Key => sha256 of (model name, query/document, normalized text), so "How was the S&P 500? " and "How was the S&P 500?" share an entry
+    - Memory tier => a small LRU dictionary for the hot queries of the current process
+    - Disk tier => a SQLite table with the float32 vector stored as a blob, shared between restarts
+    - Eviction => when the disk tier grows above max_disk_bytes the least recently used rows are dropped.
+                  The size of the tier is summed once when the cache opens and kept up to date after that,
+                  and the last_used of disk hits is written with the next store (or close), not on every hit
+
+    embeddings = CachedEmbeddings(OpenAIEmbeddings(model="text-embedding-3-small"), "EmbeddingCache.sqlite3")
+    embeddings.embed_query("how was the s&p 500?")  # network call
+    embeddings.embed_query("how was the s&p 500?")  # served from memory
+"""
+
+import hashlib
+import sqlite3
+import threading
+import time
+import unicodedata
+from array import array
+from collections import OrderedDict
+from typing import Dict, List, Optional
+
+from langchain_core.embeddings import Embeddings
+
+
+def normalize_text(text: str) -> str:
+    """Unicode normalization + collapsing whitespace, the parts of a text that never change its meaning"""
+    return " ".join(unicodedata.normalize("NFC", text).split())
+
+
+def cache_key(model: str, text: str, kind: str = "document") -> str:
+    # Some embedding models embed queries and documents differently, so the kind is part of the key too
+    return hashlib.sha256(f"{model}\x00{kind}\x00{normalize_text(text)}".encode("utf-8")).hexdigest()
+
+
+def _to_blob(vector: List[float]) -> bytes:
+    return array("f", vector).tobytes()
+
+
+def _from_blob(blob: bytes) -> List[float]:
+    vector = array("f")
+    vector.frombytes(blob)
+    return vector.tolist()
+
+
+class CachedEmbeddings(Embeddings):
+    def __init__(
+        self,
+        underlying: Embeddings,
+        cache_path: Optional[str] = None,
+        model: Optional[str] = None,
+        max_memory_items: int = 4096,
+        max_disk_bytes: int = 512 * 1024 * 1024,
+        max_pending_touches: int = 1024,
+    ):
+        self.underlying = underlying
+        # The model name is part of the key so two embedding models never share vectors
+        self.model = model or getattr(underlying, "model", type(underlying).__name__)
+        self.max_memory_items = max_memory_items
+        self.max_disk_bytes = max_disk_bytes
+        self.max_pending_touches = max_pending_touches
+        self.hits = 0
+        self.misses = 0
+
+        self._memory: "OrderedDict[str, List[float]]" = OrderedDict()
+        self._lock = threading.Lock()
+        self._conn = None
+        self._disk_bytes = 0
+        self._touched: Dict[str, float] = {}  # key => last_used of the disk hits not written yet
+        if cache_path:
+            self._conn = sqlite3.connect(cache_path, check_same_thread=False)
+            self._conn.execute("PRAGMA journal_mode=WAL")
+            self._conn.execute("PRAGMA synchronous=NORMAL")
+            self._conn.execute(
+                """
+                CREATE TABLE IF NOT EXISTS embeddings (
+                    key TEXT PRIMARY KEY,
+                    model TEXT NOT NULL,
+                    vector BLOB NOT NULL,
+                    size INTEGER NOT NULL,
+                    last_used REAL NOT NULL
+                )
+                """
+            )
+            self._conn.execute("CREATE INDEX IF NOT EXISTS embeddings_last_used ON embeddings(last_used)")
+            self._conn.commit()
+            self._disk_bytes = self._conn.execute("SELECT COALESCE(SUM(size), 0) FROM embeddings").fetchone()[0]
+
+    # ---- cache tiers ----
+
+    def _remember(self, key: str, vector: List[float]) -> None:
+        self._memory[key] = vector
+        self._memory.move_to_end(key)
+        while len(self._memory) > self.max_memory_items:
+            self._memory.popitem(last=False)
+
+    def _lookup(self, keys: List[str]) -> Dict[str, List[float]]:
+        found = {}
+        missing_in_memory = []
+        with self._lock:
+            for key in keys:
+                if key in self._memory:
+                    self._memory.move_to_end(key)
+                    found[key] = self._memory[key]
+                else:
+                    missing_in_memory.append(key)
+
+            if self._conn is not None and missing_in_memory:
+                unique = list(dict.fromkeys(missing_in_memory))
+                for start in range(0, len(unique), 500):  # SQLite limits the number of bound parameters
+                    batch = unique[start:start + 500]
+                    placeholders = ",".join("?" * len(batch))
+                    rows = self._conn.execute(
+                        f"SELECT key, vector FROM embeddings WHERE key IN ({placeholders})", batch
+                    ).fetchall()
+                    for key, blob in rows:
+                        vector = _from_blob(blob)
+                        found[key] = vector
+                        self._remember(key, vector)
+
+                # A hit is only a read, its last_used waits in memory for the next write
+                now = time.time()
+                for key in unique:
+                    if key in found:
+                        self._touched[key] = now
+                if len(self._touched) >= self.max_pending_touches:
+                    self._flush_touched()
+                    self._conn.commit()
+        return found
+
+    def _flush_touched(self) -> None:
+        if self._touched:
+            self._conn.executemany(
+                "UPDATE embeddings SET last_used = ? WHERE key = ?",
+                [(used, key) for key, used in self._touched.items()],
+            )
+            self._touched.clear()
+
+    def _sizes(self, keys: List[str]) -> Dict[str, int]:
+        sizes = {}
+        for start in range(0, len(keys), 500):
+            batch = keys[start:start + 500]
+            placeholders = ",".join("?" * len(batch))
+            sizes.update(self._conn.execute(f"SELECT key, size FROM embeddings WHERE key IN ({placeholders})", batch).fetchall())
+        return sizes
+
+    def _store(self, items: Dict[str, List[float]]) -> None:
+        with self._lock:
+            for key, vector in items.items():
+                self._remember(key, vector)
+
+            if self._conn is None or not items:
+                return
+            now = time.time()
+            rows = []
+            for key, vector in items.items():
+                blob = _to_blob(vector)
+                rows.append((key, self.model, blob, len(blob), now))
+            replaced = self._sizes(list(items))  # usually none, another process or thread may have stored the same text
+            self._conn.executemany(
+                "INSERT OR REPLACE INTO embeddings (key, model, vector, size, last_used) VALUES (?, ?, ?, ?, ?)",
+                rows,
+            )
+            self._disk_bytes += sum(row[3] for row in rows) - sum(replaced.values())
+            self._flush_touched()  # before evicting, so the rows hit since the last store count as recently used
+            self._evict()
+            self._conn.commit()
+
+    def _evict(self) -> None:
+        """Drops the least recently used rows until the disk tier fits in max_disk_bytes"""
+        if self._disk_bytes <= self.max_disk_bytes:
+            return
+        excess = self._disk_bytes - self.max_disk_bytes
+        freed = 0
+        victims = []
+        for key, size in self._conn.execute("SELECT key, size FROM embeddings ORDER BY last_used ASC"):
+            victims.append((key,))
+            freed += size
+            if freed >= excess:
+                break
+        self._conn.executemany("DELETE FROM embeddings WHERE key = ?", victims)
+        self._disk_bytes -= freed
+
+    # ---- Embeddings interface ----
+
+    def _split(self, texts: List[str], kind: str = "document"):
+        keys = [cache_key(self.model, text, kind) for text in texts]
+        found = self._lookup(keys)
+        # Duplicates inside one call are only embedded once
+        missing = {}
+        for key, text in zip(keys, texts):
+            if key not in found and key not in missing:
+                missing[key] = text
+        self.hits += sum(1 for key in keys if key in found)
+        self.misses += len(missing)
+        return keys, found, missing
+
+    def embed_documents(self, texts: List[str]) -> List[List[float]]:
+        keys, found, missing = self._split(texts)
+        if missing:
+            vectors = self.underlying.embed_documents(list(missing.values()))
+            new_items = dict(zip(missing.keys(), vectors))
+            self._store(new_items)
+            found.update(new_items)
+        return [found[key] for key in keys]
+
+    def embed_query(self, text: str) -> List[float]:
+        keys, found, missing = self._split([text], kind="query")
+        if missing:
+            vector = self.underlying.embed_query(text)
+            self._store({keys[0]: vector})
+            return vector
+        return found[keys[0]]
+
+    async def aembed_documents(self, texts: List[str]) -> List[List[float]]:
+        keys, found, missing = self._split(texts)
+        if missing:
+            vectors = await self.underlying.aembed_documents(list(missing.values()))
+            new_items = dict(zip(missing.keys(), vectors))
+            self._store(new_items)
+            found.update(new_items)
+        return [found[key] for key in keys]
+
+    async def aembed_query(self, text: str) -> List[float]:
+        keys, found, missing = self._split([text], kind="query")
+        if missing:
+            vector = await self.underlying.aembed_query(text)
+            self._store({keys[0]: vector})
+            return vector
+        return found[keys[0]]
+
+    def close(self) -> None:
+        if self._conn is not None:
+            with self._lock:
+                self._flush_touched()
+                self._conn.commit()
+            self._conn.close()
+            self._conn = None
@@ -0,0 +1,138 @@
+"""
+Local stand-ins for the OpenAI models so the pipelines can be run and benchmarked offline
+
+HashEmbeddings => every text gets a deterministic unit vector built from its sha256,
+the same text always gives the same vector and no network or API key is needed.
+`latency` simulates the round trip of one embedding request, the async version sleeps
+without blocking the event loop so concurrency behaves like it does against the real API.
+
+ScriptedChatModel => a chat model that plays a script instead of calling gpt-4o. The n-th answer after the last
+human message is script[n] (the last step repeats once the script runs out), so every question of a conversation
+replays the script from its first step. A step is an AIMessage, or a function that builds one from the messages:
+
+    model = ScriptedChatModel(script=[
+        AIMessage(content="", tool_calls=[tool_call("add", a=40, b=12)]),
+        lambda messages: AIMessage(content="", tool_calls=[tool_call("multiply", a=int(messages[-1].content), b=5)]),
+        AIMessage(content="The result is 260"),
+    ]).bind_tools(tools)
+"""
+
+import asyncio
+import hashlib
+import json
+import random
+import time
+import uuid
+from typing import Any, Iterator, List, Optional
+
+import numpy as np
+from langchain_core.embeddings import Embeddings
+from langchain_core.language_models.chat_models import BaseChatModel
+from langchain_core.messages import AIMessage, AIMessageChunk, BaseMessage, HumanMessage
+from langchain_core.outputs import ChatGeneration, ChatGenerationChunk, ChatResult
+from langchain_core.utils.function_calling import convert_to_openai_tool
+
+
+class HashEmbeddings(Embeddings):
+    def __init__(self, size: int = 256, latency: float = 0.0, failure_rate: float = 0.0, model: str = "hash-embeddings"):
+        self.size = size
+        self.latency = latency  # seconds per request, not per text
+        self.failure_rate = failure_rate  # share of requests that raise, to exercise retries
+        self.model = model
+        self.requests = 0
+
+    def _vector(self, text: str) -> List[float]:
+        seed = int.from_bytes(hashlib.sha256(text.encode("utf-8")).digest()[:8], "big")
+        vector = np.random.default_rng(seed).standard_normal(self.size, dtype=np.float32)
+        return (vector / np.linalg.norm(vector)).tolist()
+
+    def _maybe_fail(self) -> None:
+        self.requests += 1
+        if self.failure_rate and random.random() < self.failure_rate:
+            raise RuntimeError("simulated rate limit")
+
+    def embed_documents(self, texts: List[str]) -> List[List[float]]:
+        self._maybe_fail()
+        if self.latency:
+            time.sleep(self.latency)
+        return [self._vector(text) for text in texts]
+
+    def embed_query(self, text: str) -> List[float]:
+        return self.embed_documents([text])[0]
+
+    async def aembed_documents(self, texts: List[str]) -> List[List[float]]:
+        self._maybe_fail()
+        if self.latency:
+            await asyncio.sleep(self.latency)
+        return [self._vector(text) for text in texts]
+
+    async def aembed_query(self, text: str) -> List[float]:
+        return (await self.aembed_documents([text]))[0]
+
+
+def tool_call(name: str, **args) -> dict:
+    return {"name": name, "args": args, "id": "", "type": "tool_call"}  # the model gives it a unique id when it answers
+
+
+def _tokens(text: str) -> int:
+    return max(1, len(text) // 4)  # about 4 characters per token in English, close enough for a fake
+
+
+class ScriptedChatModel(BaseChatModel):
+    script: List[Any]
+    latency: float = 0.0  # seconds per call, the round trip of a real request
+    calls: int = 0
+
+    @property
+    def _llm_type(self) -> str:
+        return "scripted"
+
+    def bind_tools(self, tools, **kwargs):
+        return self.bind(tools=[convert_to_openai_tool(tool) for tool in tools], **kwargs)
+
+    def _answer(self, messages: List[BaseMessage]) -> AIMessage:
+        self.calls += 1
+        step = 0
+        for message in reversed(messages):
+            if isinstance(message, HumanMessage):
+                break
+            step += isinstance(message, AIMessage)
+        answer = self.script[min(step, len(self.script) - 1)]
+        if callable(answer):
+            answer = answer(messages)
+        prompt_tokens = sum(_tokens(str(message.content)) for message in messages)
+        completion_tokens = _tokens(str(answer.content) + str(answer.tool_calls))
+        return AIMessage(
+            content=answer.content,
+            tool_calls=[{**call, "id": call["id"] or f"call_{uuid.uuid4().hex[:12]}"} for call in answer.tool_calls],
+            usage_metadata={"input_tokens": prompt_tokens, "output_tokens": completion_tokens, "total_tokens": prompt_tokens + completion_tokens},
+        )
+
+    def _generate(self, messages: List[BaseMessage], stop: Optional[List[str]] = None, run_manager=None, **kwargs) -> ChatResult:
+        if self.latency:
+            time.sleep(self.latency)
+        return ChatResult(generations=[ChatGeneration(message=self._answer(messages))])
+
+    async def _agenerate(self, messages: List[BaseMessage], stop: Optional[List[str]] = None, run_manager=None, **kwargs) -> ChatResult:
+        if self.latency:
+            await asyncio.sleep(self.latency)
+        return ChatResult(generations=[ChatGeneration(message=self._answer(messages))])
+
+    def _stream(self, messages: List[BaseMessage], stop: Optional[List[str]] = None, run_manager=None, **kwargs) -> Iterator[ChatGenerationChunk]:
+        """Word by word like the real stream, the tool calls and the usage come with the last chunk"""
+        if self.latency:
+            time.sleep(self.latency)
+        answer = self._answer(messages)
+        for word in answer.content.split(" ") if answer.content else []:
+            chunk = ChatGenerationChunk(message=AIMessageChunk(content=word + " "))
+            if run_manager:
+                run_manager.on_llm_new_token(chunk.text, chunk=chunk)
+            yield chunk
+        yield ChatGenerationChunk(message=AIMessageChunk(
+            content="",
+            tool_call_chunks=[
+                {"name": call["name"], "args": json.dumps(call["args"]), "id": call["id"], "index": i}
+                for i, call in enumerate(answer.tool_calls)
+            ],
+            usage_metadata=answer.usage_metadata,
+        ))
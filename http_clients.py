@@ -0,0 +1,37 @@
+"""
+Shared, pooled HTTP clients for the OpenAI models
+
+Every ChatOpenAI / OpenAIEmbeddings object can be given its own httpx client. Handing all of them the same
+pooled client means the TCP + TLS connections to api.openai.com are opened once and reused by every request,
+which matters once one process answers many questions at the same time (rag_server.py).
+
+    ChatOpenAI(model="gpt-4o", http_client=shared_http_client(), http_async_client=shared_async_http_client())
+
+The pool size comes from OPENAI_MAX_CONNECTIONS (default 100).
+"""
+
+import os
+from functools import lru_cache
+
+import httpx
+
+
+def _limits() -> httpx.Limits:
+    max_connections = int(os.getenv("OPENAI_MAX_CONNECTIONS", "100"))
+    return httpx.Limits(max_connections=max_connections, max_keepalive_connections=max_connections, keepalive_expiry=60)
+
+
+# Long completions can take a while, connecting should not
+TIMEOUT = httpx.Timeout(120.0, connect=10.0)
+
+
+@lru_cache(maxsize=None)
+def shared_http_client() -> httpx.Client:
+    return httpx.Client(limits=_limits(), timeout=TIMEOUT)
+
+
+@lru_cache(maxsize=None)
+def shared_async_http_client() -> httpx.AsyncClient:
+    # Connections of an AsyncClient belong to the event loop that opened them,
+    # so this one should only be used from one long running loop (the server's)
+    return httpx.AsyncClient(limits=_limits(), timeout=TIMEOUT)
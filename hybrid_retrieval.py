@@ -0,0 +1,265 @@
+"""
+Hybrid (lexical + dense) retrieval for the RAG agent
+
+Dense search finds chunks that mean the same thing as the question, but it is bad at exact tokens:
+"Nvidia Q3 revenue" or "$152" embed close to every chunk about revenue in general. BM25 is the opposite,
+it only matches words, but tickers, numbers and names are exactly what it is good at. HybridRetriever asks both:
+
+    - BM25Index => a compact inverted index (term -> chunk, term frequency) in SQLite, filled by
+      rag_ingestion.sync_sources while the same chunks are embedded, so it is always in line with the vector store
+    - both searches return `fetch_k` candidates, merged with reciprocal rank fusion (score = sum of 1 / (rrf_k + rank)),
+      which needs no score calibration between the two
+    - an optional reranker orders the fused candidates again, only the best `k` reach gpt-4o
+      (overlap_reranker is local and costs nothing, cross_encoder_reranker needs sentence-transformers)
+
+    retriever = HybridRetriever(vectorstore=vectorstore, lexical_index=BM25Index("ChromaDB/stock_market.bm25.sqlite3"), k=4)
+    retriever.invoke("Nvidia Q3 revenue")
+    retriever.invoke("Nvidia Q3 revenue", filter={"year": 2024})  # both searches only look at the matching chunks
+"""
+
+import json
+import math
+import re
+import sqlite3
+import threading
+from collections import Counter
+from typing import Any, Callable, Dict, List, Optional, Sequence, Tuple
+
+from langchain_core.callbacks import CallbackManagerForRetrieverRun
+from langchain_core.documents import Document
+from langchain_core.retrievers import BaseRetriever
+
+from vector_index import dense_filter, json_field, metadata_indexes, metadata_where
+
+STOPWORDS = frozenset(
+    "a an and are as at be by did do does for from has have how in is it its of on or that the this to was were what when "
+    "which who why will with about during s".split()  # "s" is what is left of "Nvidia's"
+)
+
+# Words, numbers with their decimals, percentages and dollar amounts stay one token: "q3", "23.5%", "$152"
+TOKEN = re.compile(r"\$?\d+(?:[.,]\d+)*%?|[a-z0-9]+(?:&[a-z0-9]+)*")
+
+
+def tokenize(text: str) -> List[str]:
+    return [token for token in TOKEN.findall(text.lower()) if token not in STOPWORDS]
+
+
+def reciprocal_rank_fusion(rankings: Sequence[Sequence[str]], rrf_k: int = 60) -> List[Tuple[str, float]]:
+    """Ids ordered by the sum of 1 / (rrf_k + rank) over every ranking they appear in"""
+    scores: Dict[str, float] = {}
+    for ranking in rankings:
+        for rank, doc_id in enumerate(ranking, start=1):
+            scores[doc_id] = scores.get(doc_id, 0.0) + 1.0 / (rrf_k + rank)
+    return sorted(scores.items(), key=lambda item: item[1], reverse=True)
+
+
+class BM25Index:
+    def __init__(self, path: str = ":memory:", k1: float = 1.5, b: float = 0.75):
+        self.k1 = k1
+        self.b = b
+        self._lock = threading.Lock()  # ingestion writes from worker threads
+        self.conn = sqlite3.connect(path, check_same_thread=False)
+        self.conn.execute("PRAGMA journal_mode=WAL")
+        self.conn.execute("PRAGMA synchronous=NORMAL")
+        self.conn.executescript(
+            """
+            CREATE TABLE IF NOT EXISTS documents (
+                id TEXT PRIMARY KEY,
+                text TEXT NOT NULL,
+                metadata TEXT NOT NULL,
+                length INTEGER NOT NULL
+            );
+            CREATE TABLE IF NOT EXISTS postings (
+                term TEXT NOT NULL,
+                doc_id TEXT NOT NULL,
+                tf INTEGER NOT NULL,
+                PRIMARY KEY (term, doc_id)
+            ) WITHOUT ROWID;
+            CREATE INDEX IF NOT EXISTS postings_by_doc ON postings(doc_id);
+            """
+            + metadata_indexes("documents")
+        )
+        self.conn.commit()
+        self._count, self._total_length = self.conn.execute("SELECT COUNT(*), COALESCE(SUM(length), 0) FROM documents").fetchone()
+
+    def __len__(self) -> int:
+        return self._count
+
+    def _remove(self, ids: Sequence[str]) -> None:
+        for doc_id in ids:
+            row = self.conn.execute("SELECT length FROM documents WHERE id = ?", (doc_id,)).fetchone()
+            if row is None:
+                continue
+            self.conn.execute("DELETE FROM postings WHERE doc_id = ?", (doc_id,))
+            self.conn.execute("DELETE FROM documents WHERE id = ?", (doc_id,))
+            self._count -= 1
+            self._total_length -= row[0]
+
+    def upsert(self, ids: Sequence[str], texts: Sequence[str], metadatas: Optional[Sequence[dict]] = None) -> None:
+        metadatas = metadatas or [{} for _ in ids]
+        with self._lock:
+            self._remove(ids)
+            postings = []
+            documents = []
+            for doc_id, text, metadata in zip(ids, texts, metadatas):
+                terms = Counter(tokenize(text))
+                length = sum(terms.values())
+                documents.append((doc_id, text, json.dumps(metadata), length))
+                postings.extend((term, doc_id, tf) for term, tf in terms.items())
+                self._count += 1
+                self._total_length += length
+            self.conn.executemany("INSERT INTO documents (id, text, metadata, length) VALUES (?, ?, ?, ?)", documents)
+            self.conn.executemany("INSERT INTO postings (term, doc_id, tf) VALUES (?, ?, ?)", postings)
+            self.conn.commit()
+
+    def delete(self, ids: Sequence[str]) -> None:
+        with self._lock:
+            self._remove(ids)
+            self.conn.commit()
+
+    def idf(self, term: str) -> float:
+        with self._lock:
+            df = self.conn.execute("SELECT COUNT(*) FROM postings WHERE term = ?", (term,)).fetchone()[0]
+        return math.log(1 + (self._count - df + 0.5) / (df + 0.5))
+
+    def document_frequencies(self, terms: Sequence[str]) -> Dict[str, int]:
+        """How many chunks contain each term, one lookup in the postings index per term"""
+        with self._lock:
+            return {term: self.conn.execute("SELECT COUNT(*) FROM postings WHERE term = ?", (term,)).fetchone()[0] for term in terms}
+
+    def facets(self, field: str) -> set:
+        """The distinct values of a metadata field (the sources, the years, ...), read from its index"""
+        with self._lock:
+            rows = self.conn.execute(f"SELECT DISTINCT {json_field(field)} FROM documents").fetchall()
+        return {value for value, in rows if value is not None}
+
+    def filter_ids(self, filter: dict) -> set:
+        where, params = metadata_where(filter)
+        with self._lock:
+            return {doc_id for doc_id, in self.conn.execute(f"SELECT id FROM documents WHERE {where}", params)}
+
+    def search(self, query: str, k: int = 20, filter: Optional[dict] = None) -> List[Tuple[str, float]]:
+        """(chunk id, BM25 score) of the best k chunks, only chunks whose metadata matches `filter` if given"""
+        terms = set(tokenize(query))
+        if not terms or not self._count:
+            return []
+        average_length = self._total_length / self._count
+        allowed = self.filter_ids(filter) if filter else None
+        if allowed is not None and not allowed:
+            return []
+
+        with self._lock:
+            matches: Dict[str, List[Tuple[float, int]]] = {}
+            for term in terms:
+                rows = self.conn.execute("SELECT doc_id, tf FROM postings WHERE term = ?", (term,)).fetchall()
+                # The idf stays the one of the whole index, a filter doesn't make a common word rare
+                idf = math.log(1 + (self._count - len(rows) + 0.5) / (len(rows) + 0.5))
+                for doc_id, tf in rows:
+                    if allowed is None or doc_id in allowed:
+                        matches.setdefault(doc_id, []).append((idf, tf))
+            lengths = dict(self._lengths(list(matches)))
+
+        scores = {}
+        for doc_id, term_matches in matches.items():
+            norm = self.k1 * (1 - self.b + self.b * lengths.get(doc_id, average_length) / average_length)
+            scores[doc_id] = sum(idf * tf * (self.k1 + 1) / (tf + norm) for idf, tf in term_matches)
+        return sorted(scores.items(), key=lambda item: item[1], reverse=True)[:k]
+
+    def _lengths(self, ids: List[str]) -> List[Tuple[str, int]]:
+        rows = []
+        for start in range(0, len(ids), 500):  # SQLite limits the number of bound parameters
+            batch = ids[start:start + 500]
+            rows += self.conn.execute(f"SELECT id, length FROM documents WHERE id IN ({','.join('?' * len(batch))})", batch).fetchall()
+        return rows
+
+    def documents(self, ids: Sequence[str]) -> Dict[str, Document]:
+        found = {}
+        with self._lock:
+            for start in range(0, len(ids), 500):
+                batch = list(ids[start:start + 500])
+                rows = self.conn.execute(
+                    f"SELECT id, text, metadata FROM documents WHERE id IN ({','.join('?' * len(batch))})", batch
+                ).fetchall()
+                for doc_id, text, metadata in rows:
+                    found[doc_id] = Document(id=doc_id, page_content=text, metadata=json.loads(metadata))
+        return found
+
+    def close(self) -> None:
+        self.conn.close()
+
+
+Reranker = Callable[[str, List[Document]], List[float]]
+
+
+def overlap_reranker(index: BM25Index) -> Reranker:
+    """
+    Scores a chunk by the share of the question's rare terms it contains (idf weighted), plus a bonus for
+    every pair of question words that appears next to each other. No model, a few microseconds per chunk
+    """
+    def rerank(query: str, documents: List[Document]) -> List[float]:
+        terms = list(dict.fromkeys(tokenize(query)))
+        if not terms:
+            return [0.0] * len(documents)
+        weights = {term: index.idf(term) for term in terms}
+        total = sum(weights.values()) or 1.0
+        pairs = [f"{first} {second}" for first, second in zip(terms, terms[1:])]
+
+        scores = []
+        for document in documents:
+            tokens = tokenize(document.page_content)
+            present = set(tokens)
+            joined = " ".join(tokens)
+            coverage = sum(weight for term, weight in weights.items() if term in present) / total
+            scores.append(coverage + 0.1 * sum(pair in joined for pair in pairs))
+        return scores
+
+    return rerank
+
+
+def cross_encoder_reranker(model_name: str = "cross-encoder/ms-marco-MiniLM-L-6-v2") -> Reranker:
+    """A small local cross-encoder, more accurate than overlap_reranker (needs `pip install sentence-transformers`)"""
+    try:
+        from sentence_transformers import CrossEncoder
+    except ImportError as e:
+        raise ImportError("cross_encoder_reranker needs sentence-transformers: pip install sentence-transformers") from e
+
+    model = CrossEncoder(model_name)
+
+    def rerank(query: str, documents: List[Document]) -> List[float]:
+        return [float(score) for score in model.predict([(query, document.page_content) for document in documents])]
+
+    return rerank
+
+
+class HybridRetriever(BaseRetriever):
+    vectorstore: Any
+    lexical_index: Any
+    k: int = 4
+    fetch_k: int = 20  # candidates taken from each search before fusion
+    rrf_k: int = 60
+    reranker: Optional[Reranker] = None
+    rerank_k: int = 12  # only the best fused candidates are reranked, the tail is mostly noise from one of the searches
+
+    def _get_relevant_documents(
+        self, query: str, *, run_manager: CallbackManagerForRetrieverRun, filter: Optional[dict] = None
+    ) -> List[Document]:
+        if filter:
+            dense = self.vectorstore.similarity_search(query, k=self.fetch_k, filter=dense_filter(self.vectorstore, filter))
+        else:
+            dense = self.vectorstore.similarity_search(query, k=self.fetch_k)
+        lexical = self.lexical_index.search(query, k=self.fetch_k, filter=filter)
+
+        documents = {document.id or document.metadata.get("chunk_id"): document for document in dense}
+        fused = reciprocal_rank_fusion([list(documents), [doc_id for doc_id, _ in lexical]], self.rrf_k)
+        missing = [doc_id for doc_id, _ in fused if doc_id not in documents]
+        documents.update(self.lexical_index.documents(missing))
+
+        candidates = [documents[doc_id] for doc_id, _ in fused if doc_id in documents]
+        if self.reranker is None:
+            return candidates[: self.k]
+
+        # The fused order breaks ties, so chunks the reranker can't tell apart keep their fusion rank
+        candidates = candidates[: self.rerank_k]
+        scores = self.reranker(query, candidates)
+        order = sorted(range(len(candidates)), key=lambda i: (-scores[i], i))
+        return [candidates[i] for i in order[: self.k]]
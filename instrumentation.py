@@ -0,0 +1,294 @@
+"""
+Per node metrics for the compiled graphs
+
+The graphs only printed things like `Result length: ...`, so there was no way to tell which hop of a question
+(the model, the retrieval, the tools) makes the slow ones slow. instrument_graph wraps every node of a StateGraph
+before it is compiled, and every run of a node records:
+
+    - wall time                                  => agent_node_seconds (histogram, p50 / p95 in summary())
+    - prompt / completion tokens of its answers  => agent_llm_tokens_total (answers served by llm_cache.py count as cache hits instead,
+                                                    kind="cached_prompt" is the part OpenAI served from its prefix cache)
+    - tool calls the model asked for             => agent_tool_calls_total
+    - tool results, retrieved chunks and bytes   => agent_tool_results_total, agent_retrieved_chunks_total, agent_retrieved_bytes_total
+    - cache hits                                 => agent_cache_hits_total / agent_cache_misses_total (record_cache for the caches outside the graph)
+    - exceptions                                 => agent_node_errors_total
+
+Everything lands in a MetricsRegistry in the process, which renders the Prometheus text format (rag_server.py serves it
+on /metrics) and, with a jsonl_path (or AGENT_METRICS_JSONL=metrics.jsonl), appends one JSON line per node run.
+
+    graph = StateGraph(AgentState)
+    graph.add_node("llm", call_llm)
+    ...
+    app = instrument_graph(graph, "rag").compile()
+    print(format_summary(metrics.summary()))
+"""
+
+import json
+import os
+import threading
+import time
+from collections import deque
+from typing import Any, Deque, Dict, Iterable, List, Optional, Tuple
+
+from langchain_core.messages import AIMessage, BaseMessage, ToolMessage
+from langgraph.errors import GraphBubbleUp
+from langgraph.types import Command
+from langgraph.utils.runnable import RunnableCallable
+
+BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0)
+
+HELP = {
+    "agent_node_seconds": ("histogram", "Wall time of one run of a graph node"),
+    "agent_node_errors_total": ("counter", "Node runs that raised"),
+    "agent_llm_calls_total": ("counter", "Model answers returned by a node"),
+    "agent_llm_tokens_total": ("counter", "Tokens billed for the model answers of a node"),
+    "agent_tool_calls_total": ("counter", "Tool calls the model asked for"),
+    "agent_tool_results_total": ("counter", "Tool results a node returned"),
+    "agent_retrieved_chunks_total": ("counter", "Chunks in the tool results of a node"),
+    "agent_retrieved_bytes_total": ("counter", "Bytes of tool results sent back to the model"),
+    "agent_cache_hits_total": ("counter", "Cache lookups that were hits"),
+    "agent_cache_misses_total": ("counter", "Cache lookups that were misses"),
+    "agent_prompt_tokens_total": ("counter", "Prompt tokens by part: total, shared with the previous call, cacheable by the provider (prompt_builder.py)"),
+    "agent_routed_queries_total": ("counter", "Retrieval queries routed to collections (collection_router.py)"),
+    "agent_collection_searches_total": ("counter", "Searches of a collection the router chose"),
+    "agent_speculative_retrievals_total": ("counter", "Searches started for the raw question, and tool calls they answered or not (speculative_retrieval.py)"),
+}
+
+Labels = Tuple[Tuple[str, str], ...]
+
+
+def _labels(labels: Dict[str, Any]) -> Labels:
+    return tuple(sorted((key, str(value)) for key, value in labels.items()))
+
+
+def _render(labels: Labels) -> str:
+    if not labels:
+        return ""
+    escaped = (value.replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n") for _, value in labels)
+    return "{" + ",".join(f'{key}="{value}"' for (key, _), value in zip(labels, escaped)) + "}"
+
+
+def _percentile(values: List[float], q: float) -> float:
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, int(q * len(ordered)))]
+
+
+class MetricsRegistry:
+    def __init__(self, jsonl_path: Optional[str] = None, window: int = 1000):
+        self._lock = threading.Lock()
+        self._counters: Dict[Tuple[str, Labels], float] = {}
+        self._histograms: Dict[Tuple[str, Labels], list] = {}  # [count per bucket, sum, count]
+        self._recent: Dict[Labels, Deque[float]] = {}  # the last `window` wall times of every node, for the percentiles
+        self.window = window
+        self._jsonl = open(jsonl_path, "a", encoding="utf-8") if jsonl_path else None
+
+    def inc(self, name: str, value: float = 1.0, **labels) -> None:
+        key = (name, _labels(labels))
+        with self._lock:
+            self._counters[key] = self._counters.get(key, 0.0) + value
+
+    def observe(self, name: str, seconds: float, **labels) -> None:
+        key = (name, _labels(labels))
+        with self._lock:
+            histogram = self._histograms.setdefault(key, [[0] * len(BUCKETS), 0.0, 0])
+            for i, bound in enumerate(BUCKETS):
+                if seconds <= bound:
+                    histogram[0][i] += 1
+            histogram[1] += seconds
+            histogram[2] += 1
+            self._recent.setdefault(key[1], deque(maxlen=self.window)).append(seconds)
+
+    def event(self, record: dict) -> None:
+        """One JSON line in the jsonl file, if there is one"""
+        if self._jsonl is None:
+            return
+        line = json.dumps(record, default=str)
+        with self._lock:
+            self._jsonl.write(line + "\n")
+            self._jsonl.flush()
+
+    def summary(self) -> List[dict]:
+        """Runs, p50, p95 and the share of the total wall time of every node, slowest p95 first"""
+        with self._lock:
+            recent = {labels: list(values) for labels, values in self._recent.items()}
+            totals = {labels: histogram[1] for (name, labels), histogram in self._histograms.items() if name == "agent_node_seconds"}
+        overall = sum(totals.values()) or 1.0
+        rows = []
+        for labels, values in recent.items():
+            rows.append({
+                **dict(labels),
+                "runs": len(values),
+                "p50_ms": _percentile(values, 0.5) * 1000,
+                "p95_ms": _percentile(values, 0.95) * 1000,
+                "share": totals.get(labels, 0.0) / overall,
+            })
+        return sorted(rows, key=lambda row: row["p95_ms"], reverse=True)
+
+    def prometheus_text(self) -> str:
+        with self._lock:
+            counters = dict(self._counters)
+            histograms = {key: (list(value[0]), value[1], value[2]) for key, value in self._histograms.items()}
+
+        lines = []
+        for name in sorted({name for name, _ in counters} | {name for name, _ in histograms}):
+            kind, description = HELP.get(name, ("counter", name))
+            lines += [f"# HELP {name} {description}", f"# TYPE {name} {kind}"]
+            for (metric, labels), value in sorted(counters.items()):
+                if metric == name:
+                    lines.append(f"{name}{_render(labels)} {value:g}")
+            for (metric, labels), (buckets, total, count) in sorted(histograms.items()):
+                if metric != name:
+                    continue
+                for bound, bucket in zip(BUCKETS, buckets):
+                    lines.append(f"{name}_bucket{_render(labels + (('le', f'{bound:g}'),))} {bucket}")
+                lines.append(f"{name}_bucket{_render(labels + (('le', '+Inf'),))} {count}")
+                lines.append(f"{name}_sum{_render(labels)} {total:g}")
+                lines.append(f"{name}_count{_render(labels)} {count}")
+        return "\n".join(lines) + "\n"
+
+    def write_prometheus(self, path: str) -> None:
+        """For the node_exporter textfile collector, written to a temp file first so it is never read half written"""
+        with open(f"{path}.tmp", "w", encoding="utf-8") as file:
+            file.write(self.prometheus_text())
+        os.replace(f"{path}.tmp", path)
+
+    def reset(self) -> None:
+        with self._lock:
+            self._counters.clear()
+            self._histograms.clear()
+            self._recent.clear()
+
+    def close(self) -> None:
+        if self._jsonl is not None:
+            self._jsonl.close()
+            self._jsonl = None
+
+
+# Shared by every graph of the process
+metrics = MetricsRegistry(jsonl_path=os.getenv("AGENT_METRICS_JSONL"))
+
+
+def record_cache(cache: str, hit: bool, registry: Optional[MetricsRegistry] = None) -> None:
+    """For the caches that answer outside of a node, like the response cache of Agent-5"""
+    (registry or metrics).inc("agent_cache_hits_total" if hit else "agent_cache_misses_total", cache=cache)
+
+
+def _new_messages(state: Any, update: Any) -> List[BaseMessage]:
+    """The messages a node added: a node may also return the whole history followed by its new messages"""
+    if isinstance(update, Command):
+        update = update.update
+    if not isinstance(update, dict):
+        return []
+    messages = update.get("messages")
+    if messages is None:
+        return []
+    if not isinstance(messages, (list, tuple)):
+        messages = [messages]
+    history = (state.get("messages") or []) if isinstance(state, dict) else []
+    if history and len(messages) >= len(history) and messages[len(history) - 1] is history[-1]:
+        messages = messages[len(history):]  # history + new ones, checked in O(1) so a long thread costs nothing extra
+    return [message for message in messages if isinstance(message, BaseMessage)]
+
+
+def _message_stats(messages: Iterable[BaseMessage]) -> dict:
+    stats = dict.fromkeys(("llm_calls", "prompt_tokens", "cached_prompt_tokens", "completion_tokens", "llm_cache_hits", "tool_calls",
+                           "tool_results", "retrieved_chunks", "retrieved_bytes"), 0)
+    for message in messages:
+        if isinstance(message, AIMessage):
+            stats["llm_calls"] += 1
+            stats["tool_calls"] += len(message.tool_calls)
+            if message.response_metadata.get("cache_hit"):
+                stats["llm_cache_hits"] += 1  # nothing was billed for it
+            elif message.usage_metadata:
+                stats["prompt_tokens"] += message.usage_metadata.get("input_tokens", 0)
+                # the part of the prompt OpenAI served from its prefix cache (faster, and billed at half price)
+                stats["cached_prompt_tokens"] += (message.usage_metadata.get("input_token_details") or {}).get("cache_read", 0)
+                stats["completion_tokens"] += message.usage_metadata.get("output_tokens", 0)
+        elif isinstance(message, ToolMessage):
+            stats["tool_results"] += 1
+            stats["retrieved_bytes"] += len(str(message.content).encode())
+            if isinstance(message.artifact, dict):
+                stats["retrieved_chunks"] += len(message.artifact.get("chunk_ids", []))  # packed by context_packing.py
+            elif isinstance(message.artifact, list):
+                stats["retrieved_chunks"] += len(message.artifact)
+    return stats
+
+
+class _NodeRecorder:
+    def __init__(self, registry: MetricsRegistry, graph: str, node: str):
+        self.registry = registry
+        self.graph = graph
+        self.node = node
+
+    def record(self, state: Any, config: dict, seconds: float, update: Any = None, error: Optional[BaseException] = None) -> None:
+        labels = {"graph": self.graph, "node": self.node}
+        registry = self.registry
+        registry.observe("agent_node_seconds", seconds, **labels)
+        stats = _message_stats(_new_messages(state, update)) if error is None else {}
+
+        if error is not None and not isinstance(error, GraphBubbleUp):  # interrupts are control flow, not failures
+            registry.inc("agent_node_errors_total", **labels)
+        if stats.get("llm_calls"):
+            registry.inc("agent_llm_calls_total", stats["llm_calls"], **labels)
+            registry.inc("agent_llm_tokens_total", stats["prompt_tokens"], kind="prompt", **labels)
+            registry.inc("agent_llm_tokens_total", stats["cached_prompt_tokens"], kind="cached_prompt", **labels)
+            registry.inc("agent_llm_tokens_total", stats["completion_tokens"], kind="completion", **labels)
+            registry.inc("agent_cache_hits_total", stats["llm_cache_hits"], cache="llm")
+            registry.inc("agent_cache_misses_total", stats["llm_calls"] - stats["llm_cache_hits"], cache="llm")
+        if stats.get("tool_calls"):
+            registry.inc("agent_tool_calls_total", stats["tool_calls"], **labels)
+        if stats.get("tool_results"):
+            registry.inc("agent_tool_results_total", stats["tool_results"], **labels)
+            registry.inc("agent_retrieved_chunks_total", stats["retrieved_chunks"], **labels)
+            registry.inc("agent_retrieved_bytes_total", stats["retrieved_bytes"], **labels)
+
+        registry.event({
+            "ts": time.time(),
+            **labels,
+            "thread_id": (config or {}).get("configurable", {}).get("thread_id"),
+            "seconds": round(seconds, 6),
+            **stats,
+            "error": type(error).__name__ if error is not None else None,
+        })
+
+
+def instrument_node(runnable: Any, graph: str, node: str, registry: Optional[MetricsRegistry] = None) -> RunnableCallable:
+    """Wraps a node's runnable (a function, ToolNode, RunnableLambda, ...) so that each run is recorded"""
+    recorder = _NodeRecorder(registry or metrics, graph, node)
+
+    def run(state, config):
+        start = time.perf_counter()
+        try:
+            update = runnable.invoke(state, config)
+        except BaseException as e:
+            recorder.record(state, config, time.perf_counter() - start, error=e)
+            raise
+        recorder.record(state, config, time.perf_counter() - start, update)
+        return update
+
+    async def arun(state, config):
+        start = time.perf_counter()
+        try:
+            update = await runnable.ainvoke(state, config)
+        except BaseException as e:
+            recorder.record(state, config, time.perf_counter() - start, error=e)
+            raise
+        recorder.record(state, config, time.perf_counter() - start, update)
+        return update
+
+    # trace=False: the wrapped runnable already shows up in the traces, the wrapper would only add a level
+    return RunnableCallable(run, arun, name=node, trace=False)
+
+
+def instrument_graph(graph, name: str, registry: Optional[MetricsRegistry] = None):
+    """Wraps every node added to the StateGraph so far, call it right before compile()"""
+    for node, spec in list(graph.nodes.items()):
+        graph.nodes[node] = spec._replace(runnable=instrument_node(spec.runnable, name, node, registry))
+    return graph
+
+
+def format_summary(rows: List[dict]) -> str:
+    lines = [f"{'graph':>10} {'node':>16} {'runs':>6} {'p50 ms':>9} {'p95 ms':>9} {'share':>6}"]
+    for row in rows:
+        lines.append(f"{row['graph']:>10} {row['node']:>16} {row['runs']:>6} {row['p50_ms']:>9.1f} {row['p95_ms']:>9.1f} {row['share']:>6.0%}")
+    return "\n".join(lines)
@@ -0,0 +1,95 @@
+"""
+Lazy resources for the agent scripts
+
+Agent-5 used to do all of its work at import: import langchain_openai and langchain_chroma, open the vector store,
+hash and maybe re-embed the PDF, build the graph. The user waited seconds for the first prompt, and so did every
+script, server or test that only wanted one function out of it.
+
+LazyResources is a small registry of named factories. A resource is created the first time it is asked for,
+exactly once even when several threads ask at the same time, and the heavy imports live inside the factories:
+
+    resources = LazyResources()
+
+    @resources.register("llm")
+    def make_llm():
+        from langchain_openai import ChatOpenAI  # only imported when the model is needed
+        return ChatOpenAI(model="gpt-4o")
+
+    resources.get("llm")         # created now
+    resources.warmup()           # or: create everything in a background thread while the user is typing
+
+    __getattr__ = resources.module_getattr(__name__)   # `module.llm` keeps working for code that imports the script
+"""
+
+import threading
+import time
+from typing import Any, Callable, Dict, Iterable, Optional
+
+
+class LazyResources:
+    def __init__(self):
+        self._factories: Dict[str, Callable[[], Any]] = {}
+        self._values: Dict[str, Any] = {}
+        self._locks: Dict[str, threading.RLock] = {}
+        self.timings: Dict[str, float] = {}  # seconds each factory took, handy to see what startup costs
+
+    def register(self, name: str, factory: Optional[Callable[[], Any]] = None):
+        """resources.register("name", factory), or @resources.register("name") on the factory"""
+        if factory is None:
+            return lambda function: self.register(name, function)
+        self._factories[name] = factory
+        self._locks[name] = threading.RLock()  # reentrant: a factory may ask for the resources it depends on
+        return factory
+
+    def __contains__(self, name: str) -> bool:
+        return name in self._factories
+
+    def ready(self, name: str) -> bool:
+        return name in self._values
+
+    def get(self, name: str) -> Any:
+        if name in self._values:
+            return self._values[name]
+        if name not in self._factories:
+            raise KeyError(f"Unknown resource: {name}")
+        with self._locks[name]:
+            if name not in self._values:  # another thread may have created it while we waited
+                start = time.perf_counter()
+                self._values[name] = self._factories[name]()
+                self.timings[name] = time.perf_counter() - start
+        return self._values[name]
+
+    def set(self, name: str, value: Any) -> None:
+        """Puts a ready made value in place of the factory's, benchmarks use it to swap in the fake models"""
+        if name not in self._factories:
+            self.register(name, lambda: value)
+        with self._locks[name]:
+            self._values[name] = value
+
+    def warmup(self, names: Optional[Iterable[str]] = None, background: bool = True) -> Optional[threading.Thread]:
+        """Creates the resources (all of them by default) ahead of time, in a daemon thread unless background=False"""
+        names = list(names or self._factories)
+
+        def run():
+            for name in names:
+                try:
+                    self.get(name)
+                except Exception as e:
+                    # Not fatal here, the first real use calls the factory again and raises where it matters
+                    print(f"Warmup of {name} failed: {e}")
+
+        if not background:
+            run()
+            return None
+        thread = threading.Thread(target=run, name="warmup", daemon=True)
+        thread.start()
+        return thread
+
+    def module_getattr(self, module_name: str) -> Callable[[str], Any]:
+        """A module level __getattr__ (PEP 562) that resolves the module's missing attributes from the registry"""
+        def __getattr__(name: str) -> Any:
+            if name in self._factories:
+                return self.get(name)
+            raise AttributeError(f"module {module_name!r} has no attribute {name!r}")
+
+        return __getattr__
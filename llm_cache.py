@@ -0,0 +1,195 @@
+"""
+Exact match cache for deterministic model calls
+
+Agent-5 (and Agent-3 with --deterministic) call gpt-4o with temperature = 0, so the same prompt gets the same answer,
+yet replaying a conversation or asking the same question again sends the same request again.
+LLMCache plugs into LangChain's own cache hook:
+
+    llm = ChatOpenAI(model="gpt-4o", temperature=0, cache=LLMCache("LLMCache.sqlite3"))
+
+    - Key => sha256 of the canonical prompt (every message, including tool calls and tool results) and the
+      llm string LangChain builds from the model parameters and the bound tool schemas,
+      so a different model, temperature or set of tools never shares an entry
+    - Canonical => message ids, response metadata and token usage are left out of the key, and the random
+      tool call ids ("call_RvIG7...") are renumbered in order, so the replay of a conversation hits too
+    - The whole generation is stored, so an AIMessage asking for tools comes back with its tool_calls
+    - Memory tier => LRU dictionary, Disk tier => optional SQLite table shared between restarts
+    - Only calls with temperature = 0 are cached, anything else is sampled and should stay that way
+"""
+
+import hashlib
+import json
+import re
+import sqlite3
+import threading
+import time
+import uuid
+import warnings
+from collections import OrderedDict
+from typing import Any, Dict, Optional, Sequence
+
+from langchain_core._api import LangChainBetaWarning
+from langchain_core.caches import BaseCache
+from langchain_core.load import dumps, loads
+from langchain_core.outputs import ChatGeneration, Generation
+
+# Parts of a message that change from run to run without changing what the model sees
+VOLATILE_FIELDS = ("id", "response_metadata", "usage_metadata")
+
+
+def _canonical_message(kwargs: Dict[str, Any], call_ids: Dict[str, str]) -> Dict[str, Any]:
+    kwargs = {key: value for key, value in kwargs.items() if key not in VOLATILE_FIELDS}
+
+    def rename(call_id):
+        if call_id not in call_ids:
+            call_ids[call_id] = f"call_{len(call_ids)}"
+        return call_ids[call_id]
+
+    if kwargs.get("tool_calls"):
+        kwargs["tool_calls"] = [{**call, "id": rename(call.get("id"))} for call in kwargs["tool_calls"]]
+    if "tool_call_id" in kwargs:
+        kwargs["tool_call_id"] = rename(kwargs["tool_call_id"])
+    additional = dict(kwargs.get("additional_kwargs") or {})
+    if additional.get("tool_calls"):
+        # The raw OpenAI copy of the tool calls carries the same ids
+        additional["tool_calls"] = [{**call, "id": rename(call.get("id"))} for call in additional["tool_calls"]]
+    if additional:
+        kwargs["additional_kwargs"] = additional
+    else:
+        kwargs.pop("additional_kwargs", None)
+    return kwargs
+
+
+def canonical_prompt(prompt: str) -> str:
+    """The prompt LangChain hands to the cache is the serialized message list, this strips what doesn't matter from it"""
+    try:
+        messages = json.loads(prompt)
+    except ValueError:
+        return prompt  # a plain text prompt
+    if not isinstance(messages, list):
+        return prompt
+
+    call_ids: Dict[str, str] = {}
+    canonical = []
+    for message in messages:
+        if isinstance(message, dict) and isinstance(message.get("kwargs"), dict):
+            message = {**message, "kwargs": _canonical_message(message["kwargs"], call_ids)}
+        canonical.append(message)
+    return json.dumps(canonical, sort_keys=True, separators=(",", ":"))
+
+
+def cache_key(prompt: str, llm_string: str) -> str:
+    return hashlib.sha256(f"{canonical_prompt(prompt)}\x00{llm_string}".encode("utf-8")).hexdigest()
+
+
+def is_deterministic(llm_string: str) -> bool:
+    """llm_string is '<serialized model>---<sorted call kwargs>', the temperature lives in the first part"""
+    try:
+        params = json.loads(llm_string.split("---", 1)[0]).get("kwargs", {})
+    except (ValueError, AttributeError):
+        # Models that can't be serialized use the repr of their sorted parameters instead
+        return re.search(r"\('temperature', 0(\.0)?\)", llm_string) is not None
+    return params.get("temperature") == 0
+
+
+def _fresh(generations: Sequence[Generation]) -> list:
+    """
+    Copies of the cached generations with new message ids. add_messages replaces a message with the same id,
+    so the same cached answer given twice in one thread would otherwise overwrite the first one.
+    They are marked with response_metadata["cache_hit"], so their usage_metadata isn't counted as billed (instrumentation.py)
+    """
+    fresh = []
+    for generation in generations:
+        if isinstance(generation, ChatGeneration):
+            metadata = {**generation.message.response_metadata, "cache_hit": True}
+            message = generation.message.model_copy(update={"id": f"run-{uuid.uuid4()}", "response_metadata": metadata})
+            generation = generation.model_copy(update={"message": message})
+        fresh.append(generation)
+    return fresh
+
+
+class LLMCache(BaseCache):
+    def __init__(self, cache_path: Optional[str] = None, max_memory_items: int = 1024, deterministic_only: bool = True):
+        self.max_memory_items = max_memory_items
+        self.deterministic_only = deterministic_only
+        self.hits = 0
+        self.misses = 0
+
+        self._memory: "OrderedDict[str, Sequence[Generation]]" = OrderedDict()
+        self._lock = threading.Lock()
+        self._conn = None
+        if cache_path:
+            self._conn = sqlite3.connect(cache_path, check_same_thread=False)
+            self._conn.execute("PRAGMA journal_mode=WAL")
+            self._conn.execute("PRAGMA synchronous=NORMAL")
+            self._conn.execute(
+                """
+                CREATE TABLE IF NOT EXISTS generations (
+                    key TEXT PRIMARY KEY,
+                    generations TEXT NOT NULL,
+                    created_at REAL NOT NULL
+                )
+                """
+            )
+            self._conn.commit()
+
+    def _remember(self, key: str, generations: Sequence[Generation]) -> None:
+        self._memory[key] = generations
+        self._memory.move_to_end(key)
+        while len(self._memory) > self.max_memory_items:
+            self._memory.popitem(last=False)
+
+    def _cacheable(self, llm_string: str) -> bool:
+        return not self.deterministic_only or is_deterministic(llm_string)
+
+    def lookup(self, prompt: str, llm_string: str) -> Optional[Sequence[Generation]]:
+        if not self._cacheable(llm_string):
+            return None
+        key = cache_key(prompt, llm_string)
+        with self._lock:
+            generations = self._memory.get(key)
+            if generations is not None:
+                self._memory.move_to_end(key)
+            elif self._conn is not None:
+                row = self._conn.execute("SELECT generations FROM generations WHERE key = ?", (key,)).fetchone()
+                if row:
+                    with warnings.catch_warnings():
+                        warnings.simplefilter("ignore", LangChainBetaWarning)  # loads is marked beta, it has been stable for a long time
+                        generations = loads(row[0])
+                    self._remember(key, generations)
+
+            if generations is None:
+                self.misses += 1
+            else:
+                self.hits += 1
+                generations = _fresh(generations)
+            return generations
+
+    def update(self, prompt: str, llm_string: str, return_val: Sequence[Generation]) -> None:
+        if not self._cacheable(llm_string):
+            return
+        key = cache_key(prompt, llm_string)
+        with self._lock:
+            self._remember(key, return_val)
+            if self._conn is not None:
+                self._conn.execute(
+                    "INSERT OR REPLACE INTO generations (key, generations, created_at) VALUES (?, ?, ?)",
+                    (key, dumps(list(return_val)), time.time()),
+                )
+                self._conn.commit()
+
+    def clear(self, **kwargs: Any) -> None:
+        with self._lock:
+            self._memory.clear()
+            if self._conn is not None:
+                self._conn.execute("DELETE FROM generations")
+                self._conn.commit()
+
+    def stats(self) -> dict:
+        total = self.hits + self.misses
+        return {"entries": len(self._memory), "hits": self.hits, "misses": self.misses, "hit_rate": self.hits / total if total else 0.0}
+
+    def close(self) -> None:
+        if self._conn is not None:
+            self._conn.close()
+            self._conn = None
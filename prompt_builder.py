@@ -0,0 +1,132 @@
+"""
+Cache friendly prompts
+
+OpenAI reuses the work for the start of a prompt it has seen recently (prompts of 1024+ tokens, in steps of 128):
+those input tokens come back faster and are billed at half price. That only works while the start of the prompt
+stays exactly the same from call to call, and Agent-4 pasted the current draft into the middle of its system prompt,
+so every edit changed the prompt from its second line on and nothing was ever reused.
+
+PromptBuilder always puts the parts of a prompt in the same order, from the most to the least stable:
+
+    static instructions  => one SystemMessage built once and reused for every call
+    tool schemas         => bound once to the model, in a fixed order (they are sent ahead of the messages)
+    history              => only ever grows at its end, so everything before the new messages is shared with the last call
+    volatile tail        => what changes every call (the current document of Agent-4), after the newest message
+
+and reports per call how much of the prompt is shared with the previous call of the same session:
+
+    prompt = PromptBuilder(system_prompt, tools, name="rag")
+    messages = prompt.build(state["messages"], volatile=None, session=thread_id)
+    prompt.last  # {"prompt_tokens": 5210, "stable_prefix_tokens": 4950, "cacheable_tokens": 4864}
+
+The same numbers go to instrumentation.py as agent_prompt_tokens_total.
+"""
+
+import hashlib
+import json
+import threading
+from collections import OrderedDict
+from typing import Dict, List, Optional, Sequence
+
+from langchain_core.messages import BaseMessage, SystemMessage
+from langchain_core.utils.function_calling import convert_to_openai_tool
+
+from conversation_memory import count_text_tokens
+from instrumentation import MetricsRegistry, metrics
+
+MIN_CACHED_PREFIX = 1024  # OpenAI caches prompts from 1024 tokens on
+CACHE_STEP = 128  # and then in steps of 128 tokens
+
+
+def cacheable_tokens(prefix_tokens: int) -> int:
+    """How many tokens of a shared prefix the provider can serve from its cache"""
+    if prefix_tokens < MIN_CACHED_PREFIX:
+        return 0
+    return MIN_CACHED_PREFIX + (prefix_tokens - MIN_CACHED_PREFIX) // CACHE_STEP * CACHE_STEP
+
+
+def _fingerprint(message: BaseMessage) -> str:
+    parts = [message.type, message.content if isinstance(message.content, str) else json.dumps(message.content, sort_keys=True)]
+    parts.append(json.dumps(getattr(message, "tool_calls", None) or [], sort_keys=True, default=str))
+    parts.append(getattr(message, "tool_call_id", "") or "")
+    return hashlib.sha1("\x00".join(parts).encode("utf-8")).hexdigest()
+
+
+class PromptBuilder:
+    def __init__(
+        self,
+        instructions: str,
+        tools: Sequence = (),
+        name: str = "prompt",
+        model: str = "gpt-4o",
+        registry: Optional[MetricsRegistry] = None,
+        max_sessions: int = 1000,
+    ):
+        self.name = name
+        self.model = model
+        self.registry = registry or metrics
+        self.system = SystemMessage(content=instructions.strip())  # the same object for every call
+        self.tools = list(tools)
+        self._tool_tokens: Optional[int] = None  # counted on the first build(), tiktoken isn't loaded when an agent is imported
+
+        self._lock = threading.Lock()
+        self._tokens: "OrderedDict[str, int]" = OrderedDict()  # fingerprint => tokens, history messages are counted once
+        self._previous: "OrderedDict[str, List[str]]" = OrderedDict()  # session => fingerprints of its last prompt
+        self._volatile: Optional[SystemMessage] = None
+        self.max_sessions = max_sessions
+        self.last: Optional[dict] = None
+
+    @property
+    def tool_tokens(self) -> int:
+        if self._tool_tokens is None:
+            schemas = json.dumps([convert_to_openai_tool(tool) for tool in self.tools], sort_keys=True)
+            self._tool_tokens = count_text_tokens(schemas, self.model) if self.tools else 0
+        return self._tool_tokens
+
+    def _volatile_message(self, content: str) -> SystemMessage:
+        # An unchanged tail (the draft between two questions about it) is the same object as last time
+        if self._volatile is None or self._volatile.content != content:
+            self._volatile = SystemMessage(content=content)
+        return self._volatile
+
+    def _count(self, fingerprint: str, message: BaseMessage) -> int:
+        tokens = self._tokens.get(fingerprint)
+        if tokens is None:
+            text = message.content if isinstance(message.content, str) else str(message.content)
+            tokens = 4 + count_text_tokens(text, self.model)  # a few tokens for the role, like count_tokens
+            if getattr(message, "tool_calls", None):
+                tokens += count_text_tokens(json.dumps(message.tool_calls, default=str), self.model)
+            self._tokens[fingerprint] = tokens
+            if len(self._tokens) > 10000:
+                self._tokens.popitem(last=False)
+        return tokens
+
+    def build(self, history: Sequence[BaseMessage], volatile: Optional[str] = None, session: str = "default") -> List[BaseMessage]:
+        """instructions, history, volatile tail, and the prefix report of this call in `last`"""
+        messages = [self.system, *history]
+        if volatile:
+            messages.append(self._volatile_message(volatile))
+        self._report(messages, session)
+        return messages
+
+    def _report(self, messages: List[BaseMessage], session: str) -> None:
+        with self._lock:
+            fingerprints = [_fingerprint(message) for message in messages]
+            sizes = [self._count(fingerprint, message) for fingerprint, message in zip(fingerprints, messages)]
+            previous = self._previous.pop(session, [])
+            self._previous[session] = fingerprints
+            if len(self._previous) > self.max_sessions:
+                self._previous.popitem(last=False)
+
+        shared = 0
+        for before, now in zip(previous, fingerprints):
+            if before != now:
+                break
+            shared += 1
+        total = self.tool_tokens + sum(sizes)
+        # The tools come first, so with a prompt seen before they are part of the shared prefix
+        prefix = self.tool_tokens + sum(sizes[:shared]) if shared else 0
+        self.last = {"prompt_tokens": total, "stable_prefix_tokens": prefix, "cacheable_tokens": cacheable_tokens(prefix)}
+
+        for part, tokens in (("total", total), ("stable_prefix", prefix), ("cacheable", self.last["cacheable_tokens"])):
+            self.registry.inc("agent_prompt_tokens_total", tokens, prompt=self.name, part=part)
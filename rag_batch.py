@@ -0,0 +1,180 @@
+"""
+Batch question answering with the RAG agent (Agent-5)
+
+running_agent() answers what one person types, one question at a time. For a file of analyst questions:
+
+    python rag_batch.py questions.jsonl --output answers.jsonl --concurrency 16
+
+    - questions.jsonl has one {"question": ..., "id": optional} (or a plain string) per line,
+      a .csv needs a `question` column and may have an `id` column
+    - up to --concurrency questions run at once (rag_agent.ainvoke under abatch_as_completed), so the throughput grows
+      with the concurrency until OpenAI's rate limit, instead of being one question per human. The model is awaited
+      on the async client and the searches (sync tools) get a thread pool sized to the concurrency, asyncio's
+      default one only has min(32, cpus + 4) threads
+    - the same retrieval query asked by several questions is only searched once (SharedQueryRetriever)
+    - every answer is appended to the output as soon as it is done, with its citations and timing:
+          {"id": ..., "question": ..., "answer": ..., "citations": [...], "seconds": 3.1, "error": null}
+    - running the same command again skips what is already answered, so an interrupted batch picks up where it
+      stopped (failed questions are tried again). Without an id the id is a hash of the question, so a question
+      that is in the file twice is only answered once
+"""
+
+import argparse
+import asyncio
+import contextlib
+import csv
+import hashlib
+import json
+import os
+import sys
+import threading
+import time
+from concurrent.futures import Future, ThreadPoolExecutor
+from typing import Dict, Iterator, List, Optional
+
+import numpy as np
+from langchain_core.messages import HumanMessage
+from langchain_core.runnables import RunnableLambda
+
+from agent_loader import load_agent
+
+
+def question_id(question: str) -> str:
+    return hashlib.sha1(question.strip().encode("utf-8")).hexdigest()[:12]
+
+
+def read_questions(path: str) -> Iterator[dict]:
+    """{"id", "question"} for every question of a .jsonl or .csv file"""
+    with open(path, newline="", encoding="utf-8") as file:
+        if path.lower().endswith(".csv"):
+            rows = csv.DictReader(file)
+            if "question" not in (rows.fieldnames or []):
+                raise ValueError(f"{path} needs a 'question' column")
+        else:
+            rows = (json.loads(line) for line in file if line.strip())
+        for row in rows:
+            row = {"question": row} if isinstance(row, str) else row
+            question = (row.get("question") or "").strip()
+            if question:
+                yield {"id": str(row.get("id") or question_id(question)), "question": question}
+
+
+def answered_ids(path: str) -> set:
+    """Ids that already have an answer in the output, a line cut off by an interruption is ignored"""
+    done = set()
+    if not os.path.exists(path):
+        return done
+    with open(path, encoding="utf-8") as file:
+        for line in file:
+            try:
+                record = json.loads(line)
+            except json.JSONDecodeError:
+                continue
+            if record.get("error") is None:
+                done.add(record["id"])
+    return done
+
+
+class SharedQueryRetriever:
+    """
+    Runs every distinct query (after lower-casing and squeezing the spaces) and filter through the retriever once per batch.
+    A question that asks while the same query is still running waits for that search instead of starting another one
+    """
+
+    def __init__(self, retriever):
+        self.retriever = retriever
+        self._lock = threading.Lock()
+        self._results: Dict[tuple, Future] = {}
+        self.searches = 0
+        self.shared = 0
+
+    def invoke(self, query: str, *args, **kwargs):
+        key = (" ".join(query.lower().split()), json.dumps(kwargs, sort_keys=True, default=str))  # filters are part of the search
+        with self._lock:
+            future = self._results.get(key)
+            owner = future is None
+            if owner:
+                future = self._results[key] = Future()
+                self.searches += 1
+            else:
+                self.shared += 1
+        if owner:
+            try:
+                future.set_result(self.retriever.invoke(query, *args, **kwargs))
+            except Exception as e:
+                with self._lock:
+                    del self._results[key]  # a failed search is tried again by the next question that needs it
+                future.set_exception(e)
+        return future.result()
+
+
+async def run_batch(rag, questions: List[dict], output: str, concurrency: int = 8) -> List[float]:
+    """Answers the questions, appends every result to `output` as soon as it is done, returns the timings"""
+    rag_agent = rag.build_rag_agent()  # no checkpointer, every question stands on its own
+    # The sync tools run in the loop's default executor, a turn of one question can search for a few queries at once
+    executor = ThreadPoolExecutor(max_workers=concurrency * 4, thread_name_prefix="rag-batch")
+    asyncio.get_running_loop().set_default_executor(executor)
+
+    async def answer(item: dict) -> dict:
+        start = time.perf_counter()
+        try:
+            result = await rag_agent.ainvoke({"messages": [HumanMessage(content=item["question"])]}, {"configurable": {"thread_id": f"batch-{item['id']}"}})
+            messages = result["messages"]
+            record = {"answer": messages[-1].content, "citations": rag.cited_chunks(messages), "error": None}
+        except Exception as e:
+            record = {"answer": None, "citations": [], "error": f"{type(e).__name__}: {e}"}
+        return {"id": item["id"], "question": item["question"], **record, "seconds": round(time.perf_counter() - start, 3)}
+
+    timings = []
+    with open(output, "a+", encoding="utf-8") as file:
+        file.seek(0, os.SEEK_END)
+        if file.tell():
+            file.seek(file.tell() - 1)
+            if file.read(1) != "\n":
+                file.write("\n")  # the last run was interrupted in the middle of a line
+
+        runner = RunnableLambda(answer)
+        async for _, record in runner.abatch_as_completed(questions, {"max_concurrency": concurrency}):
+            file.write(json.dumps(record, ensure_ascii=False) + "\n")
+            file.flush()
+            timings.append(record["seconds"])
+            status = "failed" if record["error"] else "done"
+            print(f"[{len(timings)}/{len(questions)}] {status} in {record['seconds']:.1f}s: {record['question'][:60]}", file=sys.stderr)
+    return timings
+
+
+def main(argv: Optional[List[str]] = None) -> None:
+    parser = argparse.ArgumentParser(description="Answer a file of questions with the RAG agent")
+    parser.add_argument("questions", help=".jsonl or .csv file of questions")
+    parser.add_argument("--output", default="answers.jsonl", help="JSONL file the answers are appended to")
+    parser.add_argument("--concurrency", type=int, default=8, help="questions answered at the same time")
+    parser.add_argument("--verbose", action="store_true", help="show the agent's own prints (tool calls, result sizes)")
+    args = parser.parse_args(argv)
+
+    done = answered_ids(args.output)
+    questions = list({item["id"]: item for item in read_questions(args.questions) if item["id"] not in done}.values())
+    print(f"{len(questions)} questions to answer, {len(done)} already in {args.output}", file=sys.stderr)
+    if not questions:
+        return
+
+    rag = load_agent("Agent-5.py")
+    # The index is synced and the model created once, before the questions start
+    shared = SharedQueryRetriever(rag.resources.get("retriever"))
+    rag.resources.set("retriever", shared)
+    rag.resources.get("llm")
+
+    start = time.perf_counter()
+    with open(os.devnull, "w") as devnull, contextlib.nullcontext() if args.verbose else contextlib.redirect_stdout(devnull):
+        timings = asyncio.run(run_batch(rag, questions, args.output, args.concurrency))
+    elapsed = time.perf_counter() - start
+
+    p50, p95 = np.percentile(timings, [50, 95])
+    print(
+        f"{len(timings)} questions in {elapsed:.1f}s ({len(timings) / elapsed:.2f}/s), p50 {p50:.1f}s, p95 {p95:.1f}s, "
+        f"{shared.searches} searches, {shared.shared} answered from another question's search",
+        file=sys.stderr,
+    )
+
+
+if __name__ == "__main__":
+    main()
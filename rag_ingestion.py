@@ -0,0 +1,540 @@
+"""
+Ingestion stage for the RAG agent (Agent-5)
+
+Before this, Agent-5 loaded the PDF, split it and called Chroma.from_documents on every start,
+which means every restart paid for embedding the whole corpus again and the persisted
+collection kept growing with duplicate chunks.
+
+Now every chunk gets a stable id (source:page:offset) and a content hash, and a small
+manifest is kept per collection inside the persist directory (<collection>.manifest.json):
+
+    {
+        "version": 2,
+        "settings": {...},                      # collection, embedding model, chunk sizes
+        "sources": {
+            "Stock_Market_Performance_2024.pdf": {
+                "sha256": "<hash of the file>",
+                "chunks": {"<chunk id>": "<hash of the chunk text>", ...}
+            }
+        }
+    }
+
+On start we only hash the source files. If a file did not change we don't even open it with the
+PDF loader, if it did change we split it again and only embed the chunks whose hash is new,
+and chunks that disappeared are deleted from the collection.
+
+Every chunk also carries the metadata the retriever can filter on (vector_index.py indexes these fields):
+source (the file), page, year (from the file name, or the most frequent year on the first page)
+and section (the last heading line before the chunk, carried over from the pages before).
+
+The embedding itself is a streaming pipeline so it also works for thousands of PDFs:
+
+    pages (lazy PDF loader) -> chunks (splitter, one page at a time) -> token sized batches
+        -> embedded concurrently (asyncio, bounded by a semaphore, retries with backoff)
+        -> bulk upsert into the vector store as soon as each batch is done
+
+For a whole directory of PDFs the parsing and splitting is fanned out over a process pool:
+
+    python rag_ingestion.py --dir reports/ --workers 8
+
+The files already in the collection that are not in --dir are kept (Agent-5 keeps its own PDF in "stock_market"),
+--prune deletes them so the collection is exactly the directory.
+"""
+
+import asyncio
+import hashlib
+import json
+import os
+import random
+import re
+import time
+from collections import Counter, deque
+from concurrent.futures import ProcessPoolExecutor
+from typing import Callable, Dict, Iterable, Iterator, List, Optional, Sequence, Tuple, TypedDict
+
+from langchain_core.documents import Document
+
+MANIFEST_VERSION = 3  # 2: chunks have year and section metadata, 3: the year of names like Report_2024.pdf. Older collections are ingested again
+MANIFEST_FILENAME = "manifest.json"  # before collections had their own manifest
+MANIFEST_SUFFIX = ".manifest.json"
+
+YEAR = re.compile(r"(?<!\d)(19[5-9]\d|20\d\d)(?!\d)")  # not \b, "_" is a word character and file names are full of them
+SMALL_WORDS = frozenset("a an and as at by for from in of on or the to vs with".split())
+
+
+class IngestReport(TypedDict):
+    added: int  # chunks that were embedded (new or changed)
+    deleted: int  # stale chunks removed from the collection
+    unchanged_sources: int  # files skipped because their hash matched the manifest
+    total_chunks: int
+
+
+def file_sha256(path: str) -> str:
+    """Hash of the raw file, used to skip parsing files that did not change"""
+    digest = hashlib.sha256()
+    with open(path, "rb") as file:
+        for block in iter(lambda: file.read(1 << 20), b""):
+            digest.update(block)
+    return digest.hexdigest()
+
+
+def chunk_hash(text: str) -> str:
+    return hashlib.sha256(text.encode("utf-8")).hexdigest()
+
+
+def chunk_id(source: str, page: int, start_index: int) -> str:
+    """Stable id of a chunk, the same chunk of the same file always gets the same id"""
+    return f"{source}:{page}:{start_index}"
+
+
+def manifest_path_for(persist_directory: str, collection_name: str) -> str:
+    return os.path.join(persist_directory, f"{collection_name}{MANIFEST_SUFFIX}")
+
+
+def load_manifest(path: str) -> dict:
+    if not os.path.exists(path) and path.endswith(MANIFEST_SUFFIX):
+        # Before manifests were per collection there was only one collection, its chunks are still found (and pruned)
+        legacy = os.path.join(os.path.dirname(path), MANIFEST_FILENAME)
+        if os.path.exists(legacy):
+            path = legacy
+    if not os.path.exists(path):
+        return {"version": MANIFEST_VERSION, "settings": None, "sources": {}}
+
+    with open(path, "r", encoding="utf-8") as file:
+        manifest = json.load(file)
+
+    if manifest.get("version") != MANIFEST_VERSION:
+        # An old layout is treated like a changed setting: everything gets re-ingested
+        manifest["settings"] = None
+    manifest.setdefault("sources", {})
+    return manifest
+
+
+def save_manifest(path: str, manifest: dict) -> None:
+    """Writes to a temp file first so a crash never leaves a half written manifest"""
+    tmp_path = f"{path}.tmp"
+    with open(tmp_path, "w", encoding="utf-8") as file:
+        json.dump(manifest, file, indent=2, sort_keys=True)
+    os.replace(tmp_path, path)
+
+
+def manifest_fingerprint(manifest: dict) -> str:
+    """One hash for the whole indexed corpus, it changes whenever any chunk changes"""
+    digest = hashlib.sha256(json.dumps(manifest.get("settings"), sort_keys=True).encode("utf-8"))
+    for source in sorted(manifest.get("sources", {})):
+        for cid, h in sorted(manifest["sources"][source]["chunks"].items()):
+            digest.update(f"{cid}={h};".encode("utf-8"))
+    return digest.hexdigest()
+
+
+def fingerprint_reader(*manifest_paths: str) -> Callable[[], str]:
+    """
+    Returns a function giving the current fingerprint of one or more manifests (one per collection),
+    a manifest is only re-read when its file changed
+    """
+    last = {"stat": None, "fingerprint": ""}
+
+    def read() -> str:
+        key = []
+        for path in manifest_paths:
+            try:
+                stat = os.stat(path)
+                key.append((stat.st_mtime_ns, stat.st_size))
+            except FileNotFoundError:
+                key.append(None)
+        if key != last["stat"]:
+            last["stat"] = key
+            fingerprints = [manifest_fingerprint(load_manifest(path)) for path in manifest_paths]
+            last["fingerprint"] = fingerprints[0] if len(fingerprints) == 1 else hashlib.sha256("".join(fingerprints).encode("utf-8")).hexdigest()
+        return last["fingerprint"]
+
+    return read
+
+
+def assign_chunk_ids(chunk: Document, source: str, seen_per_page: Dict[int, int]) -> Document:
+    """Puts the stable id and the content hash of a chunk in its metadata"""
+    page = chunk.metadata.get("page", 0)
+    # start_index is only there when the splitter was built with add_start_index=True,
+    # otherwise we fall back to the position of the chunk inside its page
+    offset = chunk.metadata.get("start_index", seen_per_page.get(page, 0))
+    seen_per_page[page] = seen_per_page.get(page, 0) + 1
+
+    chunk.metadata["source"] = source
+    chunk.metadata["chunk_id"] = chunk_id(source, page, offset)
+    chunk.metadata["chunk_hash"] = chunk_hash(chunk.page_content)
+    chunk.id = chunk.metadata["chunk_id"]
+    return chunk
+
+
+def document_year(source: str, first_page: str = "") -> Optional[int]:
+    """The year a report is about: the one in its file name, otherwise the most frequent one on its first page"""
+    found = YEAR.findall(os.path.basename(source))
+    if found:
+        return int(found[-1])
+    years = Counter(YEAR.findall(first_page))
+    return int(years.most_common(1)[0][0]) if years else None
+
+
+def is_heading(line: str) -> bool:
+    """A short line in title case without closing punctuation, like "Amazon.com Inc. (AMZN) - 2024 Performance" """
+    line = line.strip()
+    words = line.split()
+    if not 1 <= len(words) <= 12 or len(line) > 90 or line[-1] in ".,;:" or not (line[0].isupper() or line[0].isdigit()):
+        return False
+    words = [word for word in words if word[0].isalpha() and word.lower() not in SMALL_WORDS]
+    return bool(words) and sum(word[0].isupper() for word in words) >= 0.75 * len(words)
+
+
+def page_headings(text: str) -> List[Tuple[int, str]]:
+    """(offset, heading) of every heading line of a page"""
+    found = []
+    offset = 0
+    for line in text.splitlines(keepends=True):
+        if is_heading(line):
+            found.append((offset, line.strip()))
+        offset += len(line)
+    return found
+
+
+def iter_pages(path: str) -> Iterator[Document]:
+    """Yields the pages of a PDF one by one instead of loading the whole file in memory"""
+    from langchain_community.document_loaders import PyPDFLoader  # only needed when a file changed
+
+    yield from PyPDFLoader(path).lazy_load()
+
+
+def iter_chunks(pages: Iterable[Document], text_splitter, source: str) -> Iterator[Document]:
+    """
+    Splits every page as soon as it is loaded, the splitter never sees more than one page at a time.
+    The year of the document and the section of every chunk go into the chunk metadata on the way
+    """
+    seen_per_page: Dict[int, int] = {}
+    year = None
+    section = None  # the last heading of the pages before, a section often goes on over the page break
+    for number, page in enumerate(pages):
+        if number == 0:
+            year = document_year(source, page.page_content)
+        headings = page_headings(page.page_content)
+        for chunk in text_splitter.split_documents([page]):
+            # A chunk belongs to the last heading before its middle, a chunk starting with the tail of the
+            # previous section and then going on with a new heading is mostly about the new one
+            middle = chunk.metadata.get("start_index", 0) + len(chunk.page_content) // 2
+            chunk_section = next((heading for offset, heading in reversed(headings) if offset <= middle), section)
+            chunk = assign_chunk_ids(chunk, source, seen_per_page)
+            if year is not None:
+                chunk.metadata["year"] = year
+            if chunk_section is not None:
+                chunk.metadata["section"] = chunk_section
+            yield chunk
+        if headings:
+            section = headings[-1][1]
+
+
+def split_pdf(path: str, text_splitter) -> List[Document]:
+    """Loads one PDF and splits it, every chunk gets its stable id in the metadata"""
+    return list(iter_chunks(iter_pages(path), text_splitter, os.path.normpath(path)))
+
+
+class FileChunks(TypedDict):
+    path: str
+    pages: int
+    chunks: List[Document]
+    seconds: float  # time spent parsing and splitting this file in the worker
+
+
+def load_and_split(path: str, text_splitter) -> FileChunks:
+    """Parses and splits one whole file, this is what runs inside the worker processes"""
+    start = time.perf_counter()
+    pages = list(iter_pages(path))
+    chunks = list(iter_chunks(pages, text_splitter, os.path.normpath(path)))
+    return FileChunks(path=os.path.normpath(path), pages=len(pages), chunks=chunks, seconds=time.perf_counter() - start)
+
+
+def iter_files_parallel(paths: Sequence[str], text_splitter, max_workers: Optional[int] = None) -> Iterator[FileChunks]:
+    """
+    Fans PDF parsing and splitting out over a process pool (it is pure CPU work, so threads wouldn't help)
+    and yields the results in the same order as `paths`.
+    Only a window of 2 x max_workers files is in flight, so a huge directory doesn't pile up in memory.
+    """
+    max_workers = max_workers or os.cpu_count() or 1
+    window = max_workers * 2
+    with ProcessPoolExecutor(max_workers=max_workers) as executor:
+        in_flight = deque()
+        for path in paths:
+            in_flight.append(executor.submit(load_and_split, path, text_splitter))
+            if len(in_flight) >= window:
+                yield in_flight.popleft().result()
+        while in_flight:
+            yield in_flight.popleft().result()
+
+
+def find_pdfs(directory: str) -> List[str]:
+    """All PDFs below a directory, sorted so chunk ids and ingestion order are stable"""
+    found = []
+    for root, _, files in os.walk(directory):
+        for name in files:
+            if name.lower().endswith(".pdf"):
+                found.append(os.path.join(root, name))
+    return sorted(found)
+
+
+def estimate_tokens(text: str) -> int:
+    # Roughly 4 characters per token for English text, good enough to size a request
+    return len(text) // 4 + 1
+
+
+def batch_by_tokens(chunks: Iterable[Document], max_tokens: int = 20_000, max_items: int = 512) -> Iterator[List[Document]]:
+    """Groups chunks into batches that fit in one embedding request"""
+    batch: List[Document] = []
+    batch_tokens = 0
+    for chunk in chunks:
+        tokens = estimate_tokens(chunk.page_content)
+        if batch and (batch_tokens + tokens > max_tokens or len(batch) >= max_items):
+            yield batch
+            batch, batch_tokens = [], 0
+        batch.append(chunk)
+        batch_tokens += tokens
+    if batch:
+        yield batch
+
+
+def upsert_embeddings(vectorstore, ids: List[str], texts: List[str], metadatas: List[dict], vectors: List[List[float]]) -> None:
+    """Writes already embedded chunks to the store in one bulk call, without embedding them again"""
+    if hasattr(vectorstore, "upsert_embeddings"):
+        vectorstore.upsert_embeddings(ids=ids, texts=texts, metadatas=metadatas, embeddings=vectors)
+    elif hasattr(vectorstore, "_collection"):
+        # langchain_chroma only exposes add_texts, which would embed the texts a second time
+        vectorstore._collection.upsert(ids=ids, documents=texts, metadatas=metadatas, embeddings=vectors)
+    else:
+        raise TypeError(f"Don't know how to upsert precomputed embeddings into {type(vectorstore).__name__}")
+
+
+async def embed_with_retry(embeddings, texts: List[str], max_retries: int = 5, base_delay: float = 0.5) -> List[List[float]]:
+    """Exponential backoff with jitter, rate limits and timeouts are expected on big ingestions"""
+    for attempt in range(max_retries + 1):
+        try:
+            return await embeddings.aembed_documents(texts)
+        except Exception as e:
+            if attempt == max_retries:
+                raise
+            delay = base_delay * (2 ** attempt) * (0.5 + random.random())
+            print(f"Embedding batch failed ({e}), retrying in {delay:.1f}s")
+            await asyncio.sleep(delay)
+
+
+async def embed_and_upsert(
+    batches: Iterable[List[Document]],
+    embeddings,
+    upsert: Callable[[List[str], List[str], List[dict], List[List[float]]], None],
+    concurrency: int = 4,
+    max_retries: int = 5,
+) -> int:
+    """
+    Embeds the batches concurrently and upserts every batch as soon as it is done.
+    A new batch is only pulled from the generator when one of the `concurrency` slots is free,
+    so at most `concurrency` batches are in memory no matter how big the corpus is.
+    """
+    semaphore = asyncio.Semaphore(concurrency)
+    pending = set()
+    done_chunks = 0
+    errors = []
+
+    async def run(batch: List[Document]) -> None:
+        nonlocal done_chunks
+        try:
+            texts = [chunk.page_content for chunk in batch]
+            vectors = await embed_with_retry(embeddings, texts, max_retries=max_retries)
+            # The store write is blocking, so it runs in a thread while other batches keep embedding
+            await asyncio.to_thread(
+                upsert, [chunk.id for chunk in batch], texts, [chunk.metadata for chunk in batch], vectors
+            )
+            done_chunks += len(batch)
+        except Exception as e:
+            errors.append(e)
+        finally:
+            semaphore.release()
+
+    batches = iter(batches)
+    while True:
+        await semaphore.acquire()
+        # Loading and splitting PDFs is blocking, in a thread it doesn't stall the batches being embedded
+        batch = await asyncio.to_thread(next, batches, None)
+        if batch is None or errors:
+            semaphore.release()
+            break
+        task = asyncio.create_task(run(batch))
+        pending.add(task)
+        task.add_done_callback(pending.discard)
+
+    if pending:
+        await asyncio.gather(*pending)
+    if errors:
+        raise errors[0]
+    return done_chunks
+
+
+def backfill_lexical_index(vectorstore, lexical_index, ids: List[str], batch_size: int = 500) -> None:
+    for start in range(0, len(ids), batch_size):
+        documents = vectorstore.get_by_ids(ids[start:start + batch_size])
+        lexical_index.upsert([document.id for document in documents], [document.page_content for document in documents], [document.metadata for document in documents])
+
+
+def sync_sources(
+    vectorstore,
+    sources: Sequence[str],
+    text_splitter,
+    manifest_path: str,
+    settings: dict,
+    embeddings=None,
+    concurrency: int = 4,
+    batch_tokens: int = 20_000,
+    max_workers: int = 1,
+    prune: bool = True,
+    lexical_index=None,
+) -> IngestReport:
+    """
+    Brings the vector store in line with the given source files.
+    Only new or changed chunks are embedded and stale chunks are deleted,
+    when nothing changed this is just reading the manifest and hashing the files.
+    With max_workers > 1 the changed files are parsed and split in a process pool.
+    With prune=False files that are in the manifest but not in `sources` are kept instead of deleted.
+    A lexical_index (hybrid_retrieval.BM25Index) gets the same upserts and deletes as the vector store.
+    """
+    manifest = load_manifest(manifest_path)
+    reset = manifest.get("settings") != settings  # different model or chunking => rebuild everything
+    old_sources = manifest["sources"]
+    new_sources = {}
+    unchanged = 0
+
+    # First pass only hashes the files, unchanged files never reach the PDF loader
+    changed = []
+    for path in sources:
+        if not os.path.exists(path):
+            raise FileNotFoundError(f"PDF file not found: {path}")
+
+        key = os.path.normpath(path)
+        digest = file_sha256(path)
+        previous = old_sources.get(key)
+
+        if not reset and previous and previous["sha256"] == digest:
+            new_sources[key] = previous
+            unchanged += 1
+        else:
+            changed.append((key, digest, {} if reset or not previous else previous["chunks"]))
+
+    if not prune and not reset:
+        for key, previous in old_sources.items():
+            new_sources.setdefault(key, previous)
+
+    def split_changed() -> Iterator[Tuple[str, Iterable[Document]]]:
+        if max_workers > 1 and len(changed) > 1:
+            for result in iter_files_parallel([key for key, _, _ in changed], text_splitter, max_workers):
+                print(f"PDF {result['path']}: {result['pages']} pages, {len(result['chunks'])} chunks in {result['seconds']:.2f}s")
+                yield result["path"], result["chunks"]
+        else:
+            for key, _, _ in changed:
+                yield key, iter_chunks(iter_pages(key), text_splitter, key)
+
+    def changed_chunks() -> Iterator[Document]:
+        for (key, digest, old_chunks), (_, chunks) in zip(changed, split_changed()):
+            current = {}
+            for chunk in chunks:
+                cid = chunk.metadata["chunk_id"]
+                current[cid] = chunk.metadata["chunk_hash"]
+                if old_chunks.get(cid) != current[cid]:
+                    yield chunk
+            new_sources[key] = {"sha256": digest, "chunks": current}
+
+    if lexical_index is not None and not len(lexical_index) and not reset:
+        # The lexical index is new (or was deleted), the unchanged chunks are copied over from the vector store
+        backfill_lexical_index(vectorstore, lexical_index, [cid for source in new_sources.values() for cid in source["chunks"]])
+
+    def upsert(ids, texts, metadatas, vectors):
+        upsert_embeddings(vectorstore, ids, texts, metadatas, vectors)
+        if lexical_index is not None:
+            lexical_index.upsert(ids, texts, metadatas)
+
+    # Chunks stream from the PDF loader into token sized batches and are embedded while the next pages load.
+    # Chroma upserts by id, so a changed chunk simply overwrites its old version
+    added = asyncio.run(
+        embed_and_upsert(
+            batch_by_tokens(changed_chunks(), max_tokens=batch_tokens),
+            embeddings if embeddings is not None else vectorstore.embeddings,
+            upsert,
+            concurrency=concurrency,
+        )
+    )
+
+    old_ids = {cid for source in old_sources.values() for cid in source["chunks"]}
+    new_ids = {cid for source in new_sources.values() for cid in source["chunks"]}
+    stale_ids = sorted(old_ids - new_ids)
+    if stale_ids:
+        vectorstore.delete(ids=stale_ids)
+        if lexical_index is not None:
+            lexical_index.delete(stale_ids)
+
+    # The manifest is only written after the store has been updated successfully
+    save_manifest(manifest_path, {"version": MANIFEST_VERSION, "settings": settings, "sources": new_sources})
+
+    return IngestReport(
+        added=added,
+        deleted=len(stale_ids),
+        unchanged_sources=unchanged,
+        total_chunks=len(new_ids),
+    )
+
+
+def main() -> None:
+    import argparse
+
+    from dotenv import load_dotenv
+    from langchain.text_splitter import RecursiveCharacterTextSplitter
+    from langchain_openai import OpenAIEmbeddings
+
+    from embedding_cache import CachedEmbeddings
+    from hybrid_retrieval import BM25Index
+    from vector_index import BACKENDS, open_vectorstore
+
+    parser = argparse.ArgumentParser(description="Ingest a directory of PDFs into the RAG collection")
+    parser.add_argument("--dir", required=True, help="directory that is searched for PDFs")
+    parser.add_argument("--workers", type=int, default=os.cpu_count(), help="processes used to parse and split")
+    parser.add_argument("--concurrency", type=int, default=4, help="embedding requests in flight")
+    parser.add_argument("--backend", choices=BACKENDS, default=os.getenv("RAG_VECTOR_BACKEND", "chroma"))
+    parser.add_argument("--persist-directory", default=None, help="defaults to ./ChromaDB for chroma and ./VectorIndex otherwise")
+    parser.add_argument("--collection", default="stock_market", help="one collection per kind of report, Agent-5 routes every query to the ones that match")
+    parser.add_argument("--prune", action="store_true", help="delete the files of the collection that are not in --dir (off by default, Agent-5's own PDF is in the default collection)")
+    args = parser.parse_args()
+
+    load_dotenv()
+    embeddings = CachedEmbeddings(
+        OpenAIEmbeddings(model="text-embedding-3-small"),
+        cache_path=os.path.join(os.getcwd(), "EmbeddingCache.sqlite3"),
+    )
+    if args.persist_directory is None:
+        args.persist_directory = os.path.join(os.getcwd(), "ChromaDB" if args.backend == "chroma" else "VectorIndex")
+    vectorstore = open_vectorstore(args.backend, embeddings, args.persist_directory, args.collection)
+
+    pdfs = find_pdfs(args.dir)
+    print(f"Found {len(pdfs)} PDFs in {args.dir}")
+    start = time.perf_counter()
+    report = sync_sources(
+        vectorstore,
+        pdfs,
+        RecursiveCharacterTextSplitter(chunk_size=1000, chunk_overlap=200, add_start_index=True),
+        manifest_path_for(args.persist_directory, args.collection),
+        settings={
+            "collection": args.collection,
+            "embedding_model": embeddings.model,
+            "chunk_size": 1000,
+            "chunk_overlap": 200,
+        },
+        concurrency=args.concurrency,
+        max_workers=args.workers,
+        prune=args.prune,
+        lexical_index=BM25Index(os.path.join(args.persist_directory, f"{args.collection}.bm25.sqlite3")),
+    )
+    print(f"{report} in {time.perf_counter() - start:.1f}s")
+
+
+if __name__ == "__main__":
+    main()
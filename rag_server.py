@@ -0,0 +1,201 @@
+"""
+HTTP front-end for the RAG agent (Agent-5)
+
+running_agent() answers one question at a time from input(). This serves the same rag_agent over HTTP,
+so one process can answer many questions at once:
+
+    python rag_server.py --port 8000 --max-in-flight 32
+
+    POST /ask         {"question": "how was the s&p 500?", "thread_id": "optional"}
+                          => {"thread_id": ..., "answer": ..., "citations": [...], "cached": false}
+    POST /ask/stream  same body, the answer comes back as server-sent events:
+                          event: token   data: {"text": "In"}
+                          event: done    data: {"thread_id": ..., "answer": ..., "citations": [...], "cached": false}
+    GET  /health
+    GET  /metrics     Prometheus text: wall time of every node, tokens, retrieval sizes, cache hits (instrumentation.py)
+
+    - the graph runs with ainvoke / astream, so waiting on OpenAI doesn't block the other requests
+    - gpt-4o is called through one pooled HTTP client for the whole process (http_clients.py)
+    - at most --max-in-flight questions run at once, up to --max-queue more wait for a slot,
+      anything beyond that is rejected right away with 503 instead of piling up
+    - with a thread_id the question continues that conversation (async checkpointer, see checkpointing.py)
+    - questions close to one answered before are served from the semantic response cache (response_cache.py)
+"""
+
+import argparse
+import asyncio
+import json
+import uuid
+from contextlib import asynccontextmanager
+from typing import Optional
+
+from fastapi import FastAPI, HTTPException
+from fastapi.responses import PlainTextResponse, StreamingResponse
+from langchain_core.messages import AIMessage, HumanMessage
+from pydantic import BaseModel
+
+from agent_loader import load_agent
+from checkpointing import aget_checkpointer, session_config
+from instrumentation import metrics, record_cache
+from streaming import astream_events
+
+
+class Question(BaseModel):
+    question: str
+    thread_id: Optional[str] = None
+
+
+class InflightLimiter:
+    """Bounded concurrency with a bounded waiting room, the server's backpressure"""
+
+    def __init__(self, max_in_flight: int, max_queue: int):
+        self.semaphore = asyncio.Semaphore(max_in_flight)
+        self.max_queue = max_in_flight + max_queue
+        self.admitted = 0  # running + waiting
+
+    def try_admit(self) -> bool:
+        if self.admitted >= self.max_queue:
+            return False
+        self.admitted += 1
+        return True
+
+    async def acquire(self) -> None:
+        try:
+            await self.semaphore.acquire()
+        except BaseException:
+            self.admitted -= 1
+            raise
+
+    def release(self) -> None:
+        self.semaphore.release()
+        self.admitted -= 1
+
+
+def create_app(max_in_flight: int = 32, max_queue: int = 64) -> FastAPI:
+    state = {}
+
+    @asynccontextmanager
+    async def lifespan(app: FastAPI):
+        # Agent-5 creates its models and syncs the index lazily, the server does it before the first request (blocking, so in a thread)
+        rag = await asyncio.to_thread(load_agent, "Agent-5.py")
+        await asyncio.to_thread(rag.resources.warmup, ["llm", "retriever", "response_cache"], False)
+        checkpointer = await aget_checkpointer()
+        state["rag"] = rag
+        state["rag_agent"] = rag.build_rag_agent(checkpointer=checkpointer)
+        state["limiter"] = InflightLimiter(max_in_flight, max_queue)
+        yield
+        if hasattr(checkpointer, "conn"):
+            await checkpointer.conn.close()
+
+    app = FastAPI(title="RAG agent", lifespan=lifespan)
+
+    def admit() -> InflightLimiter:
+        limiter = state["limiter"]
+        if not limiter.try_admit():
+            raise HTTPException(status_code=503, detail="Too many questions in flight, retry shortly", headers={"Retry-After": "1"})
+        return limiter
+
+    @app.get("/health")
+    async def health():
+        limiter = state["limiter"]
+        return {"status": "ok", "admitted": limiter.admitted}
+
+    @app.get("/metrics", response_class=PlainTextResponse)
+    async def prometheus():
+        # Per node latency histograms, tokens, retrieval sizes and cache hits, see instrumentation.py
+        return PlainTextResponse(metrics.prometheus_text(), media_type="text/plain; version=0.0.4")
+
+    async def from_cache(question: str, config: dict):
+        """A cached answer (response_cache.py) is written into the thread too, so follow up questions see it"""
+        # The embedding client is sync, so the lookup runs in a thread and doesn't block the loop
+        cached = await asyncio.to_thread(state["rag"].response_cache.lookup, question)
+        record_cache("response", bool(cached))
+        if cached:
+            await state["rag_agent"].aupdate_state(
+                config, {"messages": [HumanMessage(content=question), AIMessage(content=cached["answer"])]}, as_node="llm"
+            )
+        return cached
+
+    async def is_standalone(config: dict) -> bool:
+        # Only the first question of a thread is looked up in the cache and cached, a follow up depends on what came before it
+        snapshot = await state["rag_agent"].aget_state(config)
+        return not snapshot.values.get("messages")
+
+    async def remember(question: str, messages: list) -> dict:
+        answer = messages[-1].content
+        citations = state["rag"].cited_chunks(messages)
+        await asyncio.to_thread(state["rag"].response_cache.store, question, answer, citations)
+        return {"answer": answer, "citations": citations}
+
+    @app.post("/ask")
+    async def ask(body: Question):
+        limiter = admit()
+        thread_id = body.thread_id or str(uuid.uuid4())
+        config = session_config(thread_id)
+        await limiter.acquire()
+        try:
+            # A follow up question depends on the earlier turns, so the cache is only asked for the first question of a thread
+            standalone = await is_standalone(config)
+            cached = await from_cache(body.question, config) if standalone else None
+            if cached:
+                return {"thread_id": thread_id, "answer": cached["answer"], "citations": cached["citations"], "cached": True}
+
+            result = await state["rag_agent"].ainvoke({"messages": [HumanMessage(content=body.question)]}, config)
+        finally:
+            limiter.release()
+
+        if standalone:
+            return {"thread_id": thread_id, **await remember(body.question, result["messages"]), "cached": False}
+        return {"thread_id": thread_id, "answer": result["messages"][-1].content, "citations": state["rag"].cited_chunks(result["messages"]), "cached": False}
+
+    @app.post("/ask/stream")
+    async def ask_stream(body: Question):
+        limiter = admit()
+        thread_id = body.thread_id or str(uuid.uuid4())
+        config = session_config(thread_id)
+
+        async def events():
+            await limiter.acquire()
+            try:
+                standalone = await is_standalone(config)
+                cached = await from_cache(body.question, config) if standalone else None
+                if cached:
+                    yield f"event: token\ndata: {json.dumps({'text': cached['answer']})}\n\n"
+                    done = {"thread_id": thread_id, "answer": cached["answer"], "citations": cached["citations"], "cached": True}
+                    yield f"event: done\ndata: {json.dumps(done)}\n\n"
+                    return
+
+                final_state = None
+                async for kind, value in astream_events(
+                    state["rag_agent"], {"messages": [HumanMessage(content=body.question)]}, config, nodes={"llm"}
+                ):
+                    if kind == "token":
+                        yield f"event: token\ndata: {json.dumps({'text': value})}\n\n"
+                    else:
+                        final_state = value
+
+                messages = final_state["messages"]
+                if standalone:
+                    done = await remember(body.question, messages)
+                else:
+                    done = {"answer": messages[-1].content, "citations": state["rag"].cited_chunks(messages)}
+                yield f"event: done\ndata: {json.dumps({'thread_id': thread_id, **done, 'cached': False})}\n\n"
+            finally:
+                limiter.release()
+
+        return StreamingResponse(events(), media_type="text/event-stream", headers={"Cache-Control": "no-cache"})
+
+    return app
+
+
+if __name__ == "__main__":
+    import uvicorn
+
+    parser = argparse.ArgumentParser(description="Serve the RAG agent over HTTP")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8000)
+    parser.add_argument("--max-in-flight", type=int, default=32, help="questions answered at the same time")
+    parser.add_argument("--max-queue", type=int, default=64, help="questions allowed to wait for a free slot")
+    args = parser.parse_args()
+
+    uvicorn.run(create_app(args.max_in_flight, args.max_queue), host=args.host, port=args.port)
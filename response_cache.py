@@ -0,0 +1,124 @@
+"""
+Semantic response cache for the RAG agent
+
+The same questions about the report come in over and over ("how was the S&P 500?", "How did the S&P 500 do?"),
+and every one of them costs call_llm -> retriever_tool -> call_llm. The cache sits in front of rag_agent:
+
+    - the question is embedded and compared (cosine similarity) with the questions answered before
+    - above `threshold` the stored answer and the chunks it cited are returned without running the graph
+    - entries expire after `ttl` seconds, and beyond `max_entries` the least recently used one is dropped
+    - `fingerprint` is a function returning the fingerprint of the indexed corpus (rag_ingestion.fingerprint_reader),
+      when it changes, every cached answer was built on old chunks, so the whole cache is cleared
+    - hits / misses count how well it is doing
+"""
+
+import threading
+import time
+from collections import OrderedDict
+from typing import Callable, List, Optional, TypedDict
+
+import numpy as np
+
+
+class CachedAnswer(TypedDict):
+    question: str
+    answer: str
+    citations: List[str]  # content of the tool results the answer was built from
+    created_at: float
+    similarity: float
+
+
+class SemanticResponseCache:
+    def __init__(
+        self,
+        embeddings,
+        threshold: float = 0.92,
+        ttl: float = 24 * 3600,
+        max_entries: int = 1000,
+        fingerprint: Optional[Callable[[], str]] = None,
+    ):
+        self.embeddings = embeddings
+        self.threshold = threshold
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self.fingerprint = fingerprint
+        self.hits = 0
+        self.misses = 0
+
+        self._entries: "OrderedDict[int, CachedAnswer]" = OrderedDict()
+        self._vectors: "OrderedDict[int, np.ndarray]" = OrderedDict()
+        self._next_id = 0
+        self._lock = threading.Lock()  # the server calls lookup / store from several threads
+        self._corpus = fingerprint() if fingerprint else None
+
+    def __len__(self) -> int:
+        return len(self._entries)
+
+    def clear(self) -> None:
+        self._entries.clear()
+        self._vectors.clear()
+
+    def _check_corpus(self) -> None:
+        if self.fingerprint is None:
+            return
+        current = self.fingerprint()
+        if current != self._corpus:
+            self._corpus = current
+            self.clear()
+
+    def _expire(self) -> None:
+        cutoff = time.time() - self.ttl
+        for entry_id in [entry_id for entry_id, entry in self._entries.items() if entry["created_at"] < cutoff]:
+            del self._entries[entry_id]
+            del self._vectors[entry_id]
+
+    @staticmethod
+    def _normalize(vector) -> np.ndarray:
+        vector = np.asarray(vector, dtype=np.float32)
+        return vector / (np.linalg.norm(vector) or 1.0)
+
+    def _search(self, vector: np.ndarray) -> Optional[CachedAnswer]:
+        self._check_corpus()
+        self._expire()
+        if not self._entries:
+            self.misses += 1
+            return None
+
+        ids = list(self._vectors.keys())
+        similarities = np.stack(list(self._vectors.values())) @ vector
+        best = int(np.argmax(similarities))
+        if similarities[best] < self.threshold:
+            self.misses += 1
+            return None
+
+        entry_id = ids[best]
+        self._entries.move_to_end(entry_id)
+        self._vectors.move_to_end(entry_id)
+        self.hits += 1
+        return CachedAnswer(**{**self._entries[entry_id], "similarity": float(similarities[best])})
+
+    def _store(self, question: str, vector: np.ndarray, answer: str, citations: List[str]) -> None:
+        self._check_corpus()
+        self._entries[self._next_id] = CachedAnswer(
+            question=question, answer=answer, citations=citations, created_at=time.time(), similarity=1.0
+        )
+        self._vectors[self._next_id] = vector
+        self._next_id += 1
+        while len(self._entries) > self.max_entries:
+            entry_id, _ = self._entries.popitem(last=False)
+            del self._vectors[entry_id]
+
+    def lookup(self, question: str) -> Optional[CachedAnswer]:
+        vector = self._normalize(self.embeddings.embed_query(question))
+        with self._lock:
+            return self._search(vector)
+
+    def store(self, question: str, answer: str, citations: List[str]) -> None:
+        # The question was just embedded by lookup, so with CachedEmbeddings this doesn't call the API again
+        vector = self._normalize(self.embeddings.embed_query(question))
+        with self._lock:
+            self._store(question, vector, answer, citations)
+
+    def stats(self) -> dict:
+        total = self.hits + self.misses
+        return {"entries": len(self), "hits": self.hits, "misses": self.misses, "hit_rate": self.hits / total if total else 0.0}
@@ -0,0 +1,110 @@
+"""
+Speculative retrieval for the RAG agent (Agent-5)
+
+A question costs two gpt-4o round trips with the search in between: call_llm decides to call retriever_tool,
+take_action searches, call_llm answers. Nearly every question is searched for, and the model's query is usually the
+question in other words, so the search can start on the question itself while the model is still deciding:
+
+    - start(session, question) => call_llm submits a search for the raw question to a small thread pool,
+                                  right before it calls the model
+    - take(session, query)     => take_action asks for the prefetched documents for every retriever_tool call.
+                                  The query has to be close enough to the question: the idf weighted share of
+                                  the words of both that they have in common ("How did Tesla do?" and
+                                  "Tesla stock performance 2024" share the one rare word, so they match)
+    - a query that isn't close enough, a call with filters, or a prefetch that failed => None,
+      the tool call runs a real search as before. A prefetch serves one tool call at most
+
+Off by default, the search is wasted when the model answers without one:
+
+    RAG_SPECULATIVE_RETRIEVAL=1 python Agent-5.py   (or python Agent-5.py --speculative)
+
+agent_speculative_retrievals_total{outcome=started|hit|miss} in instrumentation.py shows how often it pays off.
+"""
+
+import asyncio
+import threading
+from collections import OrderedDict
+from concurrent.futures import Future, ThreadPoolExecutor
+from typing import Callable, List, Optional, Tuple
+
+from langchain_core.documents import Document
+
+from hybrid_retrieval import tokenize
+from instrumentation import MetricsRegistry, metrics
+
+
+class SpeculativeRetrieval:
+    def __init__(
+        self,
+        search: Callable[[str], List[Document]],
+        weight: Optional[Callable[[str], float]] = None,
+        threshold: float = 0.6,
+        max_workers: int = 4,
+        max_sessions: int = 1000,
+        registry: Optional[MetricsRegistry] = None,
+    ):
+        self.search = search
+        self.weight = weight or (lambda term: 1.0)  # e.g. BM25Index.idf, so rare words count more than "stock"
+        self.threshold = threshold
+        self.max_sessions = max_sessions
+        self.registry = registry or metrics
+        self._executor = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix="speculative")
+        self._lock = threading.Lock()
+        self._pending: "OrderedDict[str, Tuple[str, Future]]" = OrderedDict()  # session => (question, search)
+
+    def similarity(self, question: str, query: str) -> float:
+        """Weighted Jaccard of the two sets of words: the weight of the shared words over the weight of all of them"""
+        first, second = set(tokenize(question)), set(tokenize(query))
+        if not first or not second:
+            return 0.0
+        weights = {term: self.weight(term) for term in first | second}
+        total = sum(weights.values())
+        return sum(weights[term] for term in first & second) / total if total else 0.0
+
+    def start(self, session: str, question: str) -> None:
+        """Starts the search for the question, a search still pending for the session's last question is dropped"""
+        future = self._executor.submit(self.search, question)
+        with self._lock:
+            previous = self._pending.pop(session, None)
+            self._pending[session] = (question, future)
+            if len(self._pending) > self.max_sessions:
+                _, (_, oldest) = self._pending.popitem(last=False)
+                oldest.cancel()
+        if previous is not None:
+            previous[1].cancel()  # only stops a search that hasn't started yet
+        self.registry.inc("agent_speculative_retrievals_total", outcome="started")
+
+    def claim(self, session: str, query: str, filter: Optional[dict] = None) -> Optional[Future]:
+        """The prefetched search if it can answer this query, it is given out only once"""
+        with self._lock:
+            entry = self._pending.get(session)
+        if entry is None:
+            return None
+        question, future = entry
+        if filter or self.similarity(question, query) < self.threshold:
+            self.registry.inc("agent_speculative_retrievals_total", outcome="miss")
+            return None
+        with self._lock:
+            if self._pending.get(session) is not entry:
+                return None  # another tool call of the turn took it in the meantime
+            del self._pending[session]
+        self.registry.inc("agent_speculative_retrievals_total", outcome="hit")
+        return future
+
+    def take(self, session: str, query: str, filter: Optional[dict] = None) -> Optional[List[Document]]:
+        future = self.claim(session, query, filter)
+        if future is None:
+            return None
+        try:
+            return future.result()
+        except Exception:
+            return None  # the tool call searches again like without a prefetch
+
+    async def atake(self, session: str, query: str, filter: Optional[dict] = None) -> Optional[List[Document]]:
+        future = self.claim(session, query, filter)
+        if future is None:
+            return None
+        try:
+            return await asyncio.wrap_future(future)
+        except Exception:
+            return None
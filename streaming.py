@@ -0,0 +1,64 @@
+"""
+Token streaming for the compiled graphs
+
+llm.invoke(...) inside a node only returns when the whole completion has arrived, so the user stares at
+an empty prompt for the full generation time. When the graph is run with stream_mode="messages", LangGraph
+hooks into the model call and hands us every token as soon as OpenAI produces it, even though the node
+itself still calls llm.invoke and still puts the complete AIMessage into the state.
+
+    final_state = print_stream_reply(agent, {"messages": [HumanMessage(content="hi")]})
+
+stream_events / astream_events yield ("token", text) for every AI token and ("state", values) for the
+state after every step, the last "state" event is the final state of the run.
+"""
+
+from typing import AsyncIterator, Iterable, Iterator, Optional, Tuple
+
+from langchain_core.messages import AIMessage
+
+
+def _token(chunk, nodes: Optional[Iterable[str]]) -> str:
+    message, metadata = chunk
+    if nodes is not None and metadata.get("langgraph_node") not in nodes:
+        return ""
+    # Tool messages and tool-call-only AI messages have no text to show
+    if isinstance(message, AIMessage) and isinstance(message.content, str):
+        return message.content
+    return ""
+
+
+def stream_events(graph, inputs, config=None, nodes: Optional[Iterable[str]] = None) -> Iterator[Tuple[str, object]]:
+    for mode, chunk in graph.stream(inputs, config, stream_mode=["messages", "values"]):
+        if mode == "messages":
+            token = _token(chunk, nodes)
+            if token:
+                yield "token", token
+        else:
+            yield "state", chunk
+
+
+async def astream_events(graph, inputs, config=None, nodes: Optional[Iterable[str]] = None) -> AsyncIterator[Tuple[str, object]]:
+    async for mode, chunk in graph.astream(inputs, config, stream_mode=["messages", "values"]):
+        if mode == "messages":
+            token = _token(chunk, nodes)
+            if token:
+                yield "token", token
+        else:
+            yield "state", chunk
+
+
+def print_stream_reply(graph, inputs, config=None, nodes: Optional[Iterable[str]] = None, prefix: str = "\nAI: ") -> dict:
+    """Prints the reply token by token and returns the final state of the graph"""
+    final_state = None
+    started = False
+    for kind, value in stream_events(graph, inputs, config, nodes):
+        if kind == "token":
+            if not started:
+                print(prefix, end="", flush=True)
+                started = True
+            print(value, end="", flush=True)
+        else:
+            final_state = value
+    if started:
+        print()
+    return final_state
@@ -0,0 +1,133 @@
+"""
+Parallel execution of tool calls
+
+When the model asks for several tools in one turn (3-5 retrieval queries in Agent-5, or add + multiply in Agent-3)
+running them one after the other costs the sum of all the calls, while they don't depend on each other.
+
+run_tool_calls / arun_tool_calls run all the calls of one AIMessage at the same time:
+    - at most `max_concurrency` calls run at once
+    - every call gets `timeout` seconds, a slow call turns into an error ToolMessage instead of blocking the turn
+    - async tools are awaited on the event loop, sync tools (a plain @tool function) run in a thread pool
+    - the ToolMessages come back in the same order as the tool calls, so every tool_call_id lines up
+    - every call runs with the node's RunnableConfig and a copy of its contextvars, so callbacks, tracing
+      and the thread_id reach the tools like with ToolNode
+
+parallel_tool_node(tools) wraps both into a node that can be added to a graph like ToolNode,
+graph.invoke uses the thread pool version and graph.ainvoke / graph.astream the asyncio one.
+"""
+
+import asyncio
+import time
+from contextvars import copy_context
+from concurrent.futures import ThreadPoolExecutor, TimeoutError as FutureTimeoutError
+from typing import Dict, List, Optional, Sequence
+
+from langchain_core.messages import ToolMessage
+from langchain_core.runnables import RunnableConfig, RunnableLambda
+from langchain_core.tools import BaseTool
+
+UNKNOWN_TOOL_MESSAGE = "Incorrect Tool Name, Please Retry and Select tool from List of Available tools."
+
+
+def _error_message(call: dict, content: str) -> ToolMessage:
+    return ToolMessage(tool_call_id=call["id"], name=call["name"], content=content, status="error")
+
+
+def _as_tool_message(call: dict, result) -> ToolMessage:
+    """Invoking a tool with the whole tool call already gives a ToolMessage, anything else gets wrapped"""
+    if isinstance(result, ToolMessage):
+        return result
+    return ToolMessage(tool_call_id=call["id"], name=call["name"], content=str(result))
+
+
+def _is_async(tool: BaseTool) -> bool:
+    # @tool on an `async def` sets `coroutine`, a plain function leaves it empty
+    return getattr(tool, "coroutine", None) is not None
+
+
+def run_tool_calls(
+    tool_calls: Sequence[dict],
+    tools_by_name: Dict[str, BaseTool],
+    timeout: float = 30.0,
+    max_concurrency: int = 8,
+    config: Optional[RunnableConfig] = None,
+) -> List[ToolMessage]:
+    """Runs the tool calls in a thread pool and returns their ToolMessages in call order"""
+    results: List[ToolMessage] = [None] * len(tool_calls)
+    futures = {}
+
+    executor = ThreadPoolExecutor(max_workers=max(1, min(max_concurrency, len(tool_calls))))
+    for i, call in enumerate(tool_calls):
+        tool = tools_by_name.get(call["name"])
+        if tool is None:
+            results[i] = _error_message(call, UNKNOWN_TOOL_MESSAGE)
+        elif _is_async(tool) and getattr(tool, "func", None) is None:
+            # An async-only tool gets its own event loop inside the worker thread
+            # (a context can only be entered by one thread at a time, so every call gets its own copy)
+            futures[i] = executor.submit(copy_context().run, asyncio.run, tool.ainvoke({**call, "type": "tool_call"}, config))
+        else:
+            futures[i] = executor.submit(copy_context().run, tool.invoke, {**call, "type": "tool_call"}, config)
+
+    # All calls start together, so one shared deadline gives every call the same timeout
+    deadline = time.monotonic() + timeout
+    for i, future in futures.items():
+        call = tool_calls[i]
+        try:
+            results[i] = _as_tool_message(call, future.result(timeout=max(0.0, deadline - time.monotonic())))
+        except FutureTimeoutError:
+            future.cancel()
+            results[i] = _error_message(call, f"Tool {call['name']} timed out after {timeout}s.")
+        except Exception as e:
+            results[i] = _error_message(call, f"Error running tool {call['name']}: {e}")
+
+    # Don't wait for a call that timed out, its thread finishes in the background
+    executor.shutdown(wait=False)
+    return results
+
+
+async def arun_tool_calls(
+    tool_calls: Sequence[dict],
+    tools_by_name: Dict[str, BaseTool],
+    timeout: float = 30.0,
+    max_concurrency: int = 8,
+    config: Optional[RunnableConfig] = None,
+) -> List[ToolMessage]:
+    """asyncio.gather over the tool calls, latency is the slowest call instead of the sum of all of them"""
+    semaphore = asyncio.Semaphore(max_concurrency)
+    loop = asyncio.get_running_loop()
+
+    async def run_one(call: dict) -> ToolMessage:
+        tool = tools_by_name.get(call["name"])
+        if tool is None:
+            return _error_message(call, UNKNOWN_TOOL_MESSAGE)
+
+        tool_input = {**call, "type": "tool_call"}
+        async with semaphore:
+            try:
+                if _is_async(tool):
+                    result = await asyncio.wait_for(tool.ainvoke(tool_input, config), timeout)
+                else:
+                    # Sync tools would block the event loop, so they go to the default thread pool (which doesn't copy the context itself)
+                    result = await asyncio.wait_for(loop.run_in_executor(None, copy_context().run, tool.invoke, tool_input, config), timeout)
+                return _as_tool_message(call, result)
+            except asyncio.TimeoutError:
+                return _error_message(call, f"Tool {call['name']} timed out after {timeout}s.")
+            except Exception as e:
+                return _error_message(call, f"Error running tool {call['name']}: {e}")
+
+    return list(await asyncio.gather(*(run_one(call) for call in tool_calls)))
+
+
+def parallel_tool_node(tools: Sequence[BaseTool], timeout: float = 30.0, max_concurrency: int = 8) -> RunnableLambda:
+    """A drop-in replacement for ToolNode that runs the tool calls of the last AIMessage concurrently"""
+    tools_by_name = {tool.name: tool for tool in tools}
+
+    def tools_node(state: dict, config: RunnableConfig) -> dict:
+        tool_calls = state["messages"][-1].tool_calls
+        return {"messages": run_tool_calls(tool_calls, tools_by_name, timeout, max_concurrency, config)}
+
+    async def atools_node(state: dict, config: RunnableConfig) -> dict:
+        tool_calls = state["messages"][-1].tool_calls
+        return {"messages": await arun_tool_calls(tool_calls, tools_by_name, timeout, max_concurrency, config)}
+
+    return RunnableLambda(tools_node, afunc=atools_node, name="tools")
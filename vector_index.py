@@ -0,0 +1,387 @@
+"""
+In-process vector index
+
+Chroma is a whole database (server-style client, SQLite, HNSW index, telemetry) for what is a few hundred
+vectors from one PDF. NumpyVectorStore keeps the same interface as any LangChain vector store
+(as_retriever, similarity_search, delete) on top of plain NumPy:
+
+    - every chunk embedding is a row of one contiguous float32 matrix, normalized when it is added,
+      so cosine similarity is a single matrix product
+    - the matrix is memory-mapped from <persist_directory>/<collection>.f32, so opening the index reads nothing
+      and the OS only pages in what a search touches
+    - top-k uses argpartition (O(n)) instead of sorting every score, block by block so memory stays flat
+    - several questions are answered with one matrix product (similarity_search_batch)
+    - ids, texts and metadata live next to it in <collection>.sqlite3, only the top-k rows are read back
+    - deleted rows are reused by the next inserts
+    - metadata filters ({"year": 2024, "source": [...]}) are answered by SQLite expression indexes first,
+      then only the matching rows are scored
+
+    store = open_vectorstore("numpy", embeddings, "VectorIndex", "stock_market")
+    retriever = store.as_retriever(search_kwargs={"k": 5})
+
+open_vectorstore picks the backend, so Agent-5 and rag_ingestion.py can switch with one setting.
+"""
+
+import json
+import os
+import re
+import sqlite3
+import threading
+import uuid
+from typing import Any, Callable, Iterable, List, Optional, Sequence, Tuple
+
+import numpy as np
+from langchain_core.documents import Document
+from langchain_core.embeddings import Embeddings
+from langchain_core.vectorstores import VectorStore
+
+BACKENDS = ("chroma", "numpy", "ivf")
+BLOCK_ROWS = 65536  # rows scored at once, bounds the size of the (queries x rows) score matrix
+INDEXED_FIELDS = ("source", "year", "section", "page")  # metadata fields with an index, rag_ingestion.py fills them
+FIELD = re.compile(r"^[A-Za-z_][A-Za-z0-9_]*$")
+
+
+def json_field(field: str, column: str = "metadata") -> str:
+    """The SQL expression of a metadata field, the field name ends up in the query so it has to be a plain name"""
+    if not FIELD.match(field):
+        raise ValueError(f"Invalid metadata field: {field!r}")
+    return f"json_extract({column}, '$.{field}')"
+
+
+def metadata_where(filter: dict, column: str = "metadata") -> Tuple[str, list]:
+    """
+    SQL condition and parameters for a metadata filter: {field: value} or {field: [values]}, all fields have to match.
+    The expressions are written like the indexes (json_extract(metadata, '$.year')), so SQLite uses them
+    """
+    clauses, params = [], []
+    for field, value in filter.items():
+        values = list(value) if isinstance(value, (list, tuple, set)) else [value]
+        clauses.append(f"{json_field(field, column)} IN ({','.join('?' * len(values))})")
+        params.extend(values)
+    return " AND ".join(clauses) or "1", params
+
+
+def metadata_indexes(table: str, column: str = "metadata") -> str:
+    return "\n".join(
+        f"CREATE INDEX IF NOT EXISTS {table}_by_{field} ON {table}({json_field(field, column)});" for field in INDEXED_FIELDS
+    )
+
+
+def dense_filter(vectorstore: VectorStore, filter: Optional[dict]) -> Optional[dict]:
+    """The filter in the format of the store, Chroma wants {"$and": [{field: {"$in": [...]}}, ...]}"""
+    if not filter or isinstance(vectorstore, NumpyVectorStore):
+        return filter or None
+    clauses = [{field: {"$in": list(value) if isinstance(value, (list, tuple, set)) else [value]}} for field, value in filter.items()]
+    return clauses[0] if len(clauses) == 1 else {"$and": clauses}
+
+
+def normalize_rows(vectors) -> np.ndarray:
+    matrix = np.asarray(vectors, dtype=np.float32)
+    if matrix.ndim == 1:
+        matrix = matrix[None, :]
+    norms = np.linalg.norm(matrix, axis=1, keepdims=True)
+    norms[norms == 0] = 1.0
+    return matrix / norms
+
+
+def top_k(scores: np.ndarray, k: int) -> np.ndarray:
+    """Column indices of the k best scores of every row, best first"""
+    k = min(k, scores.shape[1])
+    if k <= 0:
+        return np.empty((scores.shape[0], 0), dtype=np.int64)
+    best = np.argpartition(-scores, k - 1, axis=1)[:, :k]
+    order = np.argsort(-np.take_along_axis(scores, best, axis=1), axis=1)
+    return np.take_along_axis(best, order, axis=1)
+
+
+def grow_array(array: Optional[np.ndarray], path: Optional[str], capacity: int, width: int, dtype) -> np.ndarray:
+    """
+    A (capacity x width) array keeping the rows of `array`. With a path it is a memmap of that file,
+    which is grown in place, so the rows already on disk are never copied
+    """
+    if path is None:
+        grown = np.zeros((capacity, width), dtype=dtype)
+        if array is not None:
+            grown[: len(array)] = array
+        return grown
+    if isinstance(array, np.memmap):
+        array.flush()
+    with open(path, "r+b" if os.path.exists(path) else "w+b") as f:
+        f.truncate(capacity * width * np.dtype(dtype).itemsize)
+    return np.memmap(path, dtype=dtype, mode="r+", shape=(capacity, width))
+
+
+class NumpyVectorStore(VectorStore):
+    def __init__(
+        self,
+        embedding: Embeddings,
+        persist_directory: Optional[str] = None,
+        collection_name: str = "default",
+    ):
+        self._embedding = embedding
+        self.collection_name = collection_name
+        self._lock = threading.RLock()
+        self._vector_path = None
+        self.dim: Optional[int] = None
+        self._vectors: Optional[np.ndarray] = None
+        self._alive = np.zeros(0, dtype=bool)
+        self._size = 0  # rows in use, alive or deleted
+        self._row_of: dict = {}  # chunk id -> row
+        self._free: List[int] = []  # deleted rows, reused first
+
+        if persist_directory:
+            os.makedirs(persist_directory, exist_ok=True)
+            self._vector_path = os.path.join(persist_directory, f"{collection_name}.f32")
+            db_path = os.path.join(persist_directory, f"{collection_name}.sqlite3")
+        else:
+            db_path = ":memory:"
+        self._conn = sqlite3.connect(db_path, check_same_thread=False)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute("PRAGMA synchronous=NORMAL")
+        self._conn.executescript(
+            """
+            CREATE TABLE IF NOT EXISTS chunks (
+                row INTEGER PRIMARY KEY,
+                id TEXT NOT NULL UNIQUE,
+                text TEXT NOT NULL,
+                metadata TEXT NOT NULL
+            );
+            CREATE TABLE IF NOT EXISTS settings (key TEXT PRIMARY KEY, value TEXT NOT NULL);
+            """
+            + metadata_indexes("chunks")
+        )
+        self._conn.commit()
+        self._open()
+
+    # ---- storage ----
+
+    def _open(self) -> None:
+        row = self._conn.execute("SELECT value FROM settings WHERE key = 'dim'").fetchone()
+        if row is None:
+            return
+        self.dim = int(row[0])
+        rows = self._conn.execute("SELECT row, id FROM chunks").fetchall()
+        self._row_of = {chunk_id: row for row, chunk_id in rows}
+        self._size = max(self._row_of.values(), default=-1) + 1
+        capacity = os.path.getsize(self._vector_path) // (self.dim * 4) if self._vector_path and os.path.exists(self._vector_path) else 0
+        if max(capacity, self._size) == 0:
+            return
+        self._map(max(capacity, self._size))
+        self._alive = np.zeros(len(self._vectors), dtype=bool)
+        self._alive[list(self._row_of.values())] = True
+        self._free = [row for row in range(self._size) if not self._alive[row]]
+
+    def _map(self, capacity: int) -> None:
+        """(Re)maps the matrix with room for `capacity` rows"""
+        self._vectors = grow_array(self._vectors, self._vector_path, capacity, self.dim, np.float32)
+
+    def _reserve(self, count: int) -> List[int]:
+        rows = self._free[:count]
+        del self._free[:count]
+        new = count - len(rows)
+        if new:
+            needed = self._size + new
+            if self._vectors is None or needed > len(self._vectors):
+                # Doubling keeps the number of remaps logarithmic in the size of the index
+                self._map(max(needed, 2 * (len(self._vectors) if self._vectors is not None else 0), 1024))
+                alive = np.zeros(len(self._vectors), dtype=bool)
+                alive[: len(self._alive)] = self._alive
+                self._alive = alive
+            rows.extend(range(self._size, needed))
+            self._size = needed
+        return rows
+
+    def __len__(self) -> int:
+        return len(self._row_of)
+
+    @property
+    def embeddings(self) -> Embeddings:
+        return self._embedding
+
+    # ---- writes ----
+
+    def upsert_embeddings(
+        self,
+        ids: List[str],
+        texts: List[str],
+        metadatas: Optional[List[dict]],
+        embeddings: List[List[float]],
+    ) -> None:
+        """Adds chunks whose vectors are already computed (rag_ingestion.upsert_embeddings calls this)"""
+        if not ids:
+            return
+        metadatas = metadatas or [{} for _ in ids]
+        matrix = normalize_rows(embeddings)
+        with self._lock:
+            if self.dim is None:
+                self.dim = matrix.shape[1]
+                self._conn.execute("INSERT OR REPLACE INTO settings (key, value) VALUES ('dim', ?)", (str(self.dim),))
+            elif matrix.shape[1] != self.dim:
+                raise ValueError(f"Embedding size {matrix.shape[1]} doesn't match the index ({self.dim})")
+
+            # Ids seen again keep their row, a repeated id inside one call keeps its last vector
+            latest = {chunk_id: position for position, chunk_id in enumerate(ids)}
+            new_ids = [chunk_id for chunk_id in latest if chunk_id not in self._row_of]
+            for chunk_id, row in zip(new_ids, self._reserve(len(new_ids))):
+                self._row_of[chunk_id] = row
+
+            positions = list(latest.values())
+            rows = [self._row_of[ids[position]] for position in positions]
+            self._vectors[rows] = matrix[positions]
+            self._alive[rows] = True
+            self._written(np.asarray(rows), matrix[positions])
+            if isinstance(self._vectors, np.memmap):
+                self._vectors.flush()
+            self._conn.executemany(
+                "INSERT OR REPLACE INTO chunks (row, id, text, metadata) VALUES (?, ?, ?, ?)",
+                [(row, ids[position], texts[position], json.dumps(metadatas[position])) for row, position in zip(rows, positions)],
+            )
+            self._conn.commit()
+
+    def _written(self, rows: np.ndarray, vectors: np.ndarray) -> None:
+        """Called with the rows that just got new (normalized) vectors, indexes built on top (ann_index.py) update themselves here"""
+
+    def add_texts(self, texts: Iterable[str], metadatas: Optional[List[dict]] = None, ids: Optional[List[str]] = None, **kwargs: Any) -> List[str]:
+        texts = list(texts)
+        ids = ids or [str(uuid.uuid4()) for _ in texts]
+        self.upsert_embeddings(ids, texts, metadatas, self._embedding.embed_documents(texts))
+        return ids
+
+    def delete(self, ids: Optional[List[str]] = None, **kwargs: Any) -> Optional[bool]:
+        if not ids:
+            return False
+        with self._lock:
+            rows = [self._row_of.pop(chunk_id) for chunk_id in ids if chunk_id in self._row_of]
+            self._alive[rows] = False
+            self._free.extend(rows)
+            self._conn.executemany("DELETE FROM chunks WHERE row = ?", [(row,) for row in rows])
+            self._conn.commit()
+        return True
+
+    # ---- search ----
+
+    def filter_rows(self, filter: dict) -> np.ndarray:
+        """Rows whose metadata matches the filter, found with the metadata indexes without touching the vectors"""
+        where, params = metadata_where(filter)
+        with self._lock:
+            rows = self._conn.execute(f"SELECT row FROM chunks WHERE {where}", params).fetchall()
+        return np.fromiter((row for row, in rows), dtype=np.int64, count=len(rows))
+
+    def _search_rows(self, queries: np.ndarray, rows: np.ndarray, k: int) -> List[List[Tuple[int, float]]]:
+        """Exact search restricted to some rows, costs the number of rows and not the size of the index"""
+        with self._lock:
+            vectors, alive = self._vectors, self._alive
+        rows = rows[alive[rows]] if vectors is not None and len(rows) else rows[:0]
+        if len(rows) == 0:
+            return [[] for _ in queries]
+        scores = queries @ np.asarray(vectors[rows]).T
+        best = top_k(scores, k)
+        return [[(int(rows[i]), float(query_scores[i])) for i in picked] for picked, query_scores in zip(best, scores)]
+
+    def search_vectors(self, queries, k: int = 4, rows: Optional[np.ndarray] = None) -> List[List[Tuple[int, float]]]:
+        """(row, cosine similarity) of the k nearest rows for every query vector, best first, only among `rows` if given"""
+        queries = normalize_rows(queries)
+        if rows is not None:
+            return self._search_rows(queries, rows, k)
+        with self._lock:
+            vectors, alive, size = self._vectors, self._alive, self._size
+        if vectors is None or size == 0:
+            return [[] for _ in queries]
+
+        best_rows = np.empty((len(queries), 0), dtype=np.int64)
+        best_scores = np.empty((len(queries), 0), dtype=np.float32)
+        for start in range(0, size, BLOCK_ROWS):
+            stop = min(start + BLOCK_ROWS, size)
+            scores = queries @ vectors[start:stop].T
+            scores[:, ~alive[start:stop]] = -np.inf
+            picked = top_k(scores, k)
+            # Merge the block's best with the best so far
+            rows = np.concatenate([best_rows, picked + start], axis=1)
+            merged = np.concatenate([best_scores, np.take_along_axis(scores, picked, axis=1)], axis=1)
+            keep = top_k(merged, k)
+            best_rows = np.take_along_axis(rows, keep, axis=1)
+            best_scores = np.take_along_axis(merged, keep, axis=1)
+
+        return [
+            [(int(row), float(score)) for row, score in zip(rows, scores) if score > -np.inf]
+            for rows, scores in zip(best_rows, best_scores)
+        ]
+
+    def _documents(self, rows: Sequence[int]) -> dict:
+        if not rows:
+            return {}
+        placeholders = ",".join("?" * len(rows))
+        found = self._conn.execute(
+            f"SELECT row, id, text, metadata FROM chunks WHERE row IN ({placeholders})", list(rows)
+        ).fetchall()
+        return {row: Document(id=chunk_id, page_content=text, metadata=json.loads(metadata)) for row, chunk_id, text, metadata in found}
+
+    def _results(self, hits: List[List[Tuple[int, float]]]) -> List[List[Tuple[Document, float]]]:
+        documents = self._documents(sorted({row for query_hits in hits for row, _ in query_hits}))
+        return [[(documents[row], score) for row, score in query_hits if row in documents] for query_hits in hits]
+
+    def similarity_search_by_vector_with_score(self, embedding: List[float], k: int = 4, filter: Optional[dict] = None) -> List[Tuple[Document, float]]:
+        rows = self.filter_rows(filter) if filter else None
+        return self._results(self.search_vectors([embedding], k, rows=rows))[0]
+
+    def similarity_search_by_vector(self, embedding: List[float], k: int = 4, filter: Optional[dict] = None, **kwargs: Any) -> List[Document]:
+        return [document for document, _ in self.similarity_search_by_vector_with_score(embedding, k, filter)]
+
+    def similarity_search_with_score(self, query: str, k: int = 4, filter: Optional[dict] = None, **kwargs: Any) -> List[Tuple[Document, float]]:
+        return self.similarity_search_by_vector_with_score(self._embedding.embed_query(query), k, filter)
+
+    def similarity_search(self, query: str, k: int = 4, filter: Optional[dict] = None, **kwargs: Any) -> List[Document]:
+        return [document for document, _ in self.similarity_search_with_score(query, k, filter)]
+
+    def similarity_search_batch(self, queries: List[str], k: int = 4, filter: Optional[dict] = None) -> List[List[Document]]:
+        """Several questions in one matrix product, e.g. for the batch runner or multi-query retrieval"""
+        vectors = [self._embedding.embed_query(query) for query in queries]
+        rows = self.filter_rows(filter) if filter else None
+        return [[document for document, _ in hits] for hits in self._results(self.search_vectors(vectors, k, rows=rows))]
+
+    def _select_relevance_score_fn(self) -> Callable[[float], float]:
+        # Scores are cosine similarities in [-1, 1]
+        return lambda score: (score + 1.0) / 2.0
+
+    def get_by_ids(self, ids: Sequence[str], /) -> List[Document]:
+        with self._lock:
+            rows = [self._row_of[chunk_id] for chunk_id in ids if chunk_id in self._row_of]
+        documents = self._documents(rows)
+        return [documents[row] for row in rows if row in documents]
+
+    @classmethod
+    def from_texts(
+        cls,
+        texts: List[str],
+        embedding: Embeddings,
+        metadatas: Optional[List[dict]] = None,
+        ids: Optional[List[str]] = None,
+        persist_directory: Optional[str] = None,
+        collection_name: str = "default",
+        **kwargs: Any,
+    ) -> "NumpyVectorStore":
+        store = cls(embedding, persist_directory=persist_directory, collection_name=collection_name, **kwargs)
+        store.add_texts(texts, metadatas=metadatas, ids=ids)
+        return store
+
+    def close(self) -> None:
+        with self._lock:
+            if isinstance(self._vectors, np.memmap):
+                self._vectors.flush()
+            self._conn.close()
+
+
+def open_vectorstore(backend: str, embeddings: Embeddings, persist_directory: str, collection_name: str) -> VectorStore:
+    """The vector store of one collection, `backend` is one of BACKENDS"""
+    os.makedirs(persist_directory, exist_ok=True)
+    if backend == "numpy":
+        return NumpyVectorStore(embeddings, persist_directory=persist_directory, collection_name=collection_name)
+    if backend == "ivf":
+        from ann_index import IVFVectorStore
+
+        return IVFVectorStore(embeddings, persist_directory=persist_directory, collection_name=collection_name)
+    if backend == "chroma":
+        from langchain_chroma import Chroma  # heavy import, only paid when Chroma is used
+
+        return Chroma(collection_name=collection_name, embedding_function=embeddings, persist_directory=persist_directory)
+    raise ValueError(f"Unknown vector backend: {backend} (use one of {', '.join(BACKENDS)})")